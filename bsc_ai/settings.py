@@ -80,6 +80,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'bsc_ai.wsgi.application'
+ASGI_APPLICATION = 'bsc_ai.asgi.application'
 
 
 # Database
@@ -270,3 +271,173 @@ CORS_ALLOW_METHODS = [
     'PUT',
 ]
 
+
+
+# =============================================================================
+# Document Retrieval (RAG) Configuration
+# =============================================================================
+
+# Per-user vector indexes kept resident in each worker process (LRU evicted)
+RAG_INDEX_MAX_USERS = int(os.getenv('RAG_INDEX_MAX_USERS', '64'))
+
+# Packed storage format for chunk embeddings: 'float32' (default) or 'float16'
+RAG_EMBEDDING_STORAGE_DTYPE = os.getenv('RAG_EMBEDDING_STORAGE_DTYPE', 'float32')
+
+# Approximate nearest-neighbour (IVF) shards for large document libraries.
+# Exact search is always used below RAG_ANN_MIN_CHUNKS chunks in scope.
+RAG_ANN_ENABLED = os.getenv('RAG_ANN_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RAG_ANN_MIN_CHUNKS = int(os.getenv('RAG_ANN_MIN_CHUNKS', '20000'))
+RAG_ANN_NPROBE = int(os.getenv('RAG_ANN_NPROBE', '8'))
+RAG_ANN_DIR = os.path.join(MEDIA_ROOT, 'vector_index')
+
+# Chunks encoded per forward pass and inserted per bulk_create during ingestion
+RAG_EMBED_BATCH_SIZE = int(os.getenv('RAG_EMBED_BATCH_SIZE', '64'))
+
+# Run document ingestion as a Celery task (falls back to inline if the broker is down)
+RAG_INGEST_ASYNC = os.getenv('RAG_INGEST_ASYNC', 'true').lower() in ('1', 'true', 'yes')
+
+# Sentence embedding model, loaded lazily on first use unless preloaded
+RAG_EMBEDDING_MODEL = os.getenv('RAG_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+RAG_PRELOAD_EMBEDDING_MODEL = os.getenv('RAG_PRELOAD_EMBEDDING_MODEL', 'false').lower() in ('1', 'true', 'yes')
+
+# Embedding backend: 'sentence-transformers' (PyTorch), 'onnx' or 'onnx-int8'.
+# The ONNX backends run the exported model in RAG_ONNX_MODEL_DIR; switching
+# models changes the vector space, so re-ingest documents afterwards.
+RAG_EMBEDDING_BACKEND = os.getenv('RAG_EMBEDDING_BACKEND', 'sentence-transformers')
+RAG_ONNX_MODEL_DIR = os.getenv('RAG_ONNX_MODEL_DIR', os.path.join(BASE_DIR, 'jina_emb'))
+RAG_ONNX_MODEL_FILE = os.getenv('RAG_ONNX_MODEL_FILE', 'model.onnx')
+RAG_ONNX_MAX_LENGTH = int(os.getenv('RAG_ONNX_MAX_LENGTH', '512'))
+RAG_ONNX_THREADS = int(os.getenv('RAG_ONNX_THREADS', '0'))
+
+# Per-process LRU cache of query embeddings, bounded in bytes (0 disables)
+RAG_QUERY_CACHE_BYTES = int(os.getenv('RAG_QUERY_CACHE_BYTES', str(16 * 1024 * 1024)))
+
+# Shared embedding server (manage.py embedding_server), used by every worker
+# when RAG_EMBEDDING_BACKEND=remote. Address is unix:///path or http://127.0.0.1:port
+RAG_EMBEDDING_SERVER = os.getenv('RAG_EMBEDDING_SERVER', 'unix:///tmp/bsc_ai_embeddings.sock')
+RAG_EMBEDDING_SERVER_BACKEND = os.getenv('RAG_EMBEDDING_SERVER_BACKEND', 'sentence-transformers')
+RAG_EMBEDDING_SERVER_TIMEOUT = float(os.getenv('RAG_EMBEDDING_SERVER_TIMEOUT', '30'))
+RAG_EMBEDDING_SERVER_MAX_BATCH = int(os.getenv('RAG_EMBEDDING_SERVER_MAX_BATCH', '64'))
+RAG_EMBEDDING_SERVER_MAX_WAIT_MS = float(os.getenv('RAG_EMBEDDING_SERVER_MAX_WAIT_MS', '5'))
+
+# PDFs with at least RAG_PDF_PARALLEL_MIN_PAGES pages are extracted in a process
+# pool, RAG_PDF_PAGES_PER_TASK pages per task (workers: 0 = one per CPU core).
+# This works inline and inside Celery prefork workers alike
+RAG_EXTRACT_WORKERS = int(os.getenv('RAG_EXTRACT_WORKERS', '0'))
+RAG_PDF_PARALLEL_MIN_PAGES = int(os.getenv('RAG_PDF_PARALLEL_MIN_PAGES', '64'))
+RAG_PDF_PAGES_PER_TASK = int(os.getenv('RAG_PDF_PAGES_PER_TASK', '16'))
+
+# Chunk size and overlap in embedding-model tokens. Chunks are capped at the
+# model's input limit (256 word-pieces for all-MiniLM-L6-v2, minus [CLS]/[SEP])
+RAG_CHUNK_TOKENS = int(os.getenv('RAG_CHUNK_TOKENS', '256'))
+RAG_CHUNK_OVERLAP_TOKENS = int(os.getenv('RAG_CHUNK_OVERLAP_TOKENS', '32'))
+
+# Retrieval mode: 'dense' (score every chunk embedding) or 'hybrid' (BM25
+# full-text candidates first, dense-scored and merged by reciprocal rank fusion)
+RAG_RETRIEVAL_MODE = os.getenv('RAG_RETRIEVAL_MODE', 'dense')
+RAG_HYBRID_CANDIDATES = int(os.getenv('RAG_HYBRID_CANDIDATES', '200'))
+
+
+# =============================================================================
+# Language Model (Ollama) Configuration
+# =============================================================================
+
+# Context window requested from Ollama; prompts are budgeted to fit inside it
+OLLAMA_NUM_CTX = int(os.getenv('OLLAMA_NUM_CTX', '8192'))
+
+# tokenizer.json of the chat model, used to count prompt tokens exactly.
+# Not shipped: unless this is set, every token count (and so the prompt
+# budget) is an approximate characters-per-token estimate, kept on the low
+# side so prompts still fit num_ctx
+LLM_TOKENIZER_PATH = os.getenv('LLM_TOKENIZER_PATH', '')
+
+# Tokens of num_ctx kept free for the answer, the share of the remaining
+# budget retrieved context may use, and how many past messages to consider
+# (3, as before budgeting; more history means more prompt evaluation)
+PROMPT_RESPONSE_TOKENS = int(os.getenv('PROMPT_RESPONSE_TOKENS', '1024'))
+PROMPT_CONTEXT_SHARE = float(os.getenv('PROMPT_CONTEXT_SHARE', '0.75'))
+PROMPT_HISTORY_MESSAGES = int(os.getenv('PROMPT_HISTORY_MESSAGES', '3'))
+
+# Ollama server, default chat model and keep_alive sent with every request
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'llama3.3:70b')
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '10m')
+
+# Model per task kind (see chat.ollama_client.get_model_profile). Tool routing
+# only returns a short JSON decision, so a small model such as llama3.2:3b can
+# serve it while OLLAMA_MODEL writes the answers
+OLLAMA_TASK_MODELS = {
+    'chat': OLLAMA_MODEL,
+    'tool_routing': os.getenv('OLLAMA_ROUTER_MODEL', OLLAMA_MODEL),
+    'summarization': os.getenv('OLLAMA_SUMMARY_MODEL', OLLAMA_MODEL),
+    'title': os.getenv('OLLAMA_TITLE_MODEL', OLLAMA_MODEL),
+}
+
+# Per-task overrides of the default sampling options,
+# e.g. {'tool_routing': {'num_ctx': 2048}}
+OLLAMA_TASK_OPTIONS = {}
+
+# Pooled keep-alive connections to Ollama per process; connection failures are
+# retried OLLAMA_RETRIES times with exponential backoff (seconds)
+OLLAMA_POOL_SIZE = int(os.getenv('OLLAMA_POOL_SIZE', '16'))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '5'))
+OLLAMA_READ_TIMEOUT = float(os.getenv('OLLAMA_READ_TIMEOUT', '120'))
+OLLAMA_RETRIES = int(os.getenv('OLLAMA_RETRIES', '2'))
+OLLAMA_RETRY_BACKOFF = float(os.getenv('OLLAMA_RETRY_BACKOFF', '0.5'))
+
+# Upper bound on concurrent Ollama streams per event loop for the async chat
+# endpoint (/api/chat/stream/); further streams wait for a connection
+OLLAMA_ASYNC_MAX_CONNECTIONS = int(os.getenv('OLLAMA_ASYNC_MAX_CONNECTIONS', '256'))
+
+# Cache alias through which /api/chat/<id>/cancel/ reaches streams served by
+# other worker processes; with several processes it must be a shared backend
+CHAT_CANCEL_CACHE = os.getenv('CHAT_CANCEL_CACHE', 'default')
+
+# Streamed answer tokens are merged into one SSE frame per interval or once
+# this many bytes are pending (0 and 0 sends every token as its own frame)
+SSE_FLUSH_INTERVAL_MS = float(os.getenv('SSE_FLUSH_INTERVAL_MS', '50'))
+SSE_FLUSH_BYTES = int(os.getenv('SSE_FLUSH_BYTES', '512'))
+
+# Admission control: at most LLM_SLOTS requests reach each Ollama model at
+# once across all worker processes on this host (match the server's
+# OLLAMA_NUM_PARALLEL; 0 disables). Calls to the same model share its slots
+# whatever the task. Others wait in a fair queue; beyond LLM_QUEUE_MAX waiting
+# requests, new chats get 503 with Retry-After: LLM_QUEUE_RETRY_AFTER seconds
+LLM_ADMISSION_DIR = os.getenv('LLM_ADMISSION_DIR', '/tmp/bsc_ai_llm_admission')
+LLM_SLOTS = int(os.getenv('LLM_SLOTS', os.getenv('OLLAMA_NUM_PARALLEL', '1')))
+LLM_QUEUE_MAX = int(os.getenv('LLM_QUEUE_MAX', '64'))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '300'))
+LLM_QUEUE_RETRY_AFTER = int(os.getenv('LLM_QUEUE_RETRY_AFTER', '10'))
+LLM_QUEUE_POLL_INTERVAL = float(os.getenv('LLM_QUEUE_POLL_INTERVAL', '0.1'))
+# Slot count per model where it differs from LLM_SLOTS,
+# e.g. {'llama3.2:3b': 4} for a small router model
+LLM_MODEL_SLOTS = {}
+# Seconds after which a waiting background request ranks with interactive chat
+LLM_BACKGROUND_MAX_WAIT = float(os.getenv('LLM_BACKGROUND_MAX_WAIT', '120'))
+
+# Web tool router decisions cached per normalized message (LRU, entries)
+WEB_ROUTER_CACHE_SIZE = int(os.getenv('WEB_ROUTER_CACHE_SIZE', '1024'))
+
+# Context for a chat answer (web tools, document retrieval, chart data) is
+# gathered concurrently on a pool of CONTEXT_POOL_SIZE threads per process.
+# Each source has its own deadline in seconds; the answer starts without a
+# source that misses it
+CONTEXT_POOL_SIZE = int(os.getenv('CONTEXT_POOL_SIZE', '16'))
+CONTEXT_TOOLS_TIMEOUT = float(os.getenv('CONTEXT_TOOLS_TIMEOUT', '20'))
+CONTEXT_DOCUMENTS_TIMEOUT = float(os.getenv('CONTEXT_DOCUMENTS_TIMEOUT', '10'))
+CONTEXT_CHART_TIMEOUT = float(os.getenv('CONTEXT_CHART_TIMEOUT', '5'))
+
+# Seconds of silence on a chat stream (context gathering, queueing) before an
+# SSE keep-alive comment is sent, so proxies don't drop the connection
+SSE_HEARTBEAT_INTERVAL = float(os.getenv('SSE_HEARTBEAT_INTERVAL', '15'))
+
+# Opt-in semantic answer cache (see chat.answer_cache): a question whose
+# embedding reaches ANSWER_CACHE_THRESHOLD cosine similarity with one answered
+# under an identical prompt context (history, documents, web data) gets the
+# cached answer, for the listed chat types. Per process; TTL in seconds
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+ANSWER_CACHE_CHAT_TYPES = [t.strip() for t in os.getenv('ANSWER_CACHE_CHAT_TYPES', 'general').split(',') if t.strip()]
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', '86400'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '2000'))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv('ANSWER_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
@@ -15,8 +15,8 @@ class ChatMessageAdmin(admin.ModelAdmin):
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
-    list_display = ['title', 'user', 'file_type', 'processed', 'uploaded_at']
-    list_filter = ['file_type', 'processed', 'uploaded_at']
+    list_display = ['title', 'user', 'file_type', 'status', 'progress', 'chunk_count', 'uploaded_at']
+    list_filter = ['file_type', 'status', 'uploaded_at']
     search_fields = ['title', 'user__username']
 
 @admin.register(DocumentChunk)
@@ -0,0 +1,414 @@
+"""
+Cross-process admission control for LLM generation.
+
+At most ``LLM_SLOTS`` requests (the Ollama server's parallelism per model,
+``OLLAMA_NUM_PARALLEL``) are sent to a model at once, across every worker
+process on the host; ``LLM_MODEL_SLOTS`` overrides the count per model.
+Every call to a model takes a slot from that model's pool, so when tool
+routing runs on the chat model it shares the chat slots, and a separate
+router model has slots of its own. Each slot is a lock file under
+``LLM_ADMISSION_DIR/<model>``; a request holds an exclusive ``flock`` on one
+for as long as it talks to Ollama, and the kernel releases it if the
+process dies.
+
+Requests that find every slot busy wait in a queue of ticket files in the
+same directory. Tickets are ordered by priority class, then by a start-time
+fair queueing tag, then by arrival. Short task calls (tool routing, titles)
+come first since an answer is waiting on them, then interactive chat, then
+background work; a background ticket that has waited
+``LLM_BACKGROUND_MAX_WAIT`` seconds is ranked with interactive chat so it
+is not starved. A ticket's tag is one past the later of the shared virtual clock
+(the tag of the last admitted ticket) and its user's newest waiting ticket
+in the same class, so a user with many waiting requests is served in turn
+with everyone else rather than ahead of them. A waiter holds a lock on its
+own ticket, so tickets left behind by a dead process are recognisable and
+removed. When the queue already holds ``LLM_QUEUE_MAX`` tickets, new
+requests are refused with ``QueueFull`` instead of waiting.
+
+Admission needs ``fcntl`` (POSIX); elsewhere, or with ``LLM_SLOTS = 0``,
+every request is admitted immediately.
+"""
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Iterator, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {'task': 0, 'interactive': 1, 'background': 2}
+
+QUEUE_DIR = 'queue'
+CLOCK_FILE = 'clock'
+
+
+class QueueFull(Exception):
+    """The admission queue is at its limit; retry after ``retry_after`` seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f'LLM queue is full, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Exception):
+    """A request waited longer than ``LLM_QUEUE_TIMEOUT`` for a slot."""
+
+
+def _try_lock(path: str) -> Optional[int]:
+    """Open ``path`` and take an exclusive flock without waiting; None if held."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+class Ticket:
+    """A request's place in the queue, and later its slot."""
+
+    def __init__(self, controller, user_id, priority, tag):
+        self.controller = controller
+        self.rank = PRIORITIES[priority]
+        self.tag = tag
+        self.user = str(user_id if user_id is not None else '-')
+        self.enqueued = time.monotonic()
+        self.name = f'{self.rank}-{tag:012d}-{time.time_ns():020d}-{self.user}-{uuid.uuid4().hex[:8]}'
+        self.path = os.path.join(controller.queue_dir, self.name)
+        self._fd = None         # lock on the ticket file while queued
+        self._slot_fd = None    # lock on a slot file once admitted
+        self.position = None
+        self.released = False
+
+    @property
+    def admitted(self) -> bool:
+        return self._slot_fd is not None
+
+    def _enqueue(self):
+        # Lock under a hidden name first so the ticket is never visible
+        # unlocked (which would make it look abandoned)
+        hidden = os.path.join(self.controller.queue_dir, '.' + self.name)
+        self._fd = _try_lock(hidden)
+        os.rename(hidden, self.path)
+
+    def try_admit(self) -> bool:
+        """Take a slot if one is free and this ticket is at the front; else update ``position``."""
+        if self.admitted:
+            return True
+        controller = self.controller
+        free = controller.free_slots()
+        position = controller.position(self.name, prune=bool(free))
+        self.position = position + 1
+        if position >= len(free):
+            return False
+        for slot in free:
+            fd = _try_lock(slot)
+            if fd is not None:
+                self._slot_fd = fd
+                self._leave_queue()
+                controller.advance_clock(self.tag)
+                waited = time.monotonic() - self.enqueued
+                metrics.observe('admission.wait', waited)
+                return True
+        return False
+
+    def _timed_out(self, timeout, cancelled) -> Optional[QueueTimeout]:
+        if cancelled is not None and cancelled():
+            metrics.increment('admission.abandoned')
+            return QueueTimeout('Gave up waiting for an LLM slot')
+        timeout = self.controller.timeout if timeout is None else timeout
+        if time.monotonic() - self.enqueued <= timeout:
+            return None
+        metrics.increment('admission.timeouts')
+        return QueueTimeout(f'No LLM slot free after {timeout:.0f}s')
+
+    def wait(self, timeout: Optional[float] = None, cancelled: Callable[[], bool] = None) -> Iterator[int]:
+        """
+        Block until admitted, yielding the 1-based queue position after every
+        unsuccessful poll (so callers can report it or give up by closing
+        the generator). Raises ``QueueTimeout`` after ``timeout`` seconds, or
+        as soon as ``cancelled()`` is true; the ticket is released either way.
+        """
+        while not self.try_admit():
+            error = self._timed_out(timeout, cancelled)
+            if error:
+                self.release()
+                raise error
+            yield self.position
+            time.sleep(self.controller.poll_interval)
+
+    async def await_positions(self, timeout: Optional[float] = None, cancelled: Callable[[], bool] = None):
+        """Async version of ``wait``; the lock and file polling run off the event loop."""
+        try_admit = sync_to_async(self.try_admit, thread_sensitive=False)
+        while not await try_admit():
+            error = self._timed_out(timeout, cancelled)
+            if error:
+                await self.arelease()
+                raise error
+            yield self.position
+            await asyncio.sleep(self.controller.poll_interval)
+
+    def _leave_queue(self):
+        if self._fd is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            os.close(self._fd)
+            self._fd = None
+
+    def release(self):
+        """Give up the slot or the queue place; safe to call more than once."""
+        if self.released:
+            return
+        self.released = True
+        self._leave_queue()
+        if self._slot_fd is not None:
+            os.close(self._slot_fd)
+            self._slot_fd = None
+
+    async def arelease(self):
+        """``release`` off the event loop; completes even if the caller is cancelled."""
+        await asyncio.shield(sync_to_async(self.release, thread_sensitive=False)())
+
+
+class _Admitted:
+    """Stand-in ticket when admission control is off."""
+    admitted = True
+    position = None
+
+    def try_admit(self):
+        return True
+
+    def wait(self, timeout=None, cancelled=None):
+        return iter(())
+
+    async def await_positions(self, timeout=None, cancelled=None):
+        return
+        yield
+
+    def release(self):
+        pass
+
+    async def arelease(self):
+        pass
+
+
+class AdmissionController:
+    """Slot and queue files for one Ollama server, shared by every process."""
+
+    def __init__(
+        self,
+        directory: str,
+        slots: int,
+        max_queue: int = 64,
+        timeout: float = 300.0,
+        retry_after: int = 10,
+        poll_interval: float = 0.1,
+        background_max_wait: float = 120.0,
+    ):
+        self.directory = directory
+        self.queue_dir = os.path.join(directory, QUEUE_DIR)
+        self.slots = [os.path.join(directory, f'slot-{i}.lock') for i in range(slots)]
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.poll_interval = poll_interval
+        self.background_max_wait = background_max_wait
+        self.enabled = bool(slots) and fcntl is not None
+        if self.enabled:
+            os.makedirs(self.queue_dir, exist_ok=True)
+        elif slots:
+            logger.error("fcntl is unavailable on this platform; LLM admission control disabled")
+
+    def _tickets(self) -> List[str]:
+        return [name for name in os.listdir(self.queue_dir) if not name.startswith('.')]
+
+    def free_slots(self) -> List[str]:
+        """Slot files nobody holds right now."""
+        free = []
+        for slot in self.slots:
+            fd = _try_lock(slot)
+            if fd is not None:
+                os.close(fd)
+                free.append(slot)
+        return free
+
+    def queue_length(self) -> int:
+        return len(self._tickets()) if self.enabled else 0
+
+    def _prune(self, names):
+        """Remove tickets whose owner process is gone (nobody holds their lock)."""
+        alive = []
+        for name in names:
+            path = os.path.join(self.queue_dir, name)
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                alive.append(name)
+            else:
+                logger.info(f"Removing abandoned LLM queue ticket {name}")
+                os.unlink(path)
+            finally:
+                os.close(fd)
+        return alive
+
+    def _parsed_tickets(self):
+        """``(rank, tag, arrival, user, name)`` of every waiting ticket."""
+        tickets = []
+        for name in self._tickets():
+            try:
+                rank, tag, arrival, user, _ = name.split('-', 4)
+                tickets.append((int(rank), int(tag), int(arrival), user, name))
+            except ValueError:
+                continue
+        return tickets
+
+    def _clock_path(self):
+        return os.path.join(self.directory, CLOCK_FILE)
+
+    def clock(self) -> int:
+        try:
+            with open(self._clock_path()) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def advance_clock(self, tag: int):
+        if tag <= self.clock():
+            return
+        temporary = f'{self._clock_path()}.{os.getpid()}.{threading.get_ident()}'
+        with open(temporary, 'w') as f:
+            f.write(str(tag))
+        os.replace(temporary, self._clock_path())
+
+    def next_tag(self, user_id, priority: str) -> int:
+        user, rank = str(user_id if user_id is not None else '-'), PRIORITIES[priority]
+        newest = max(
+            (tag for r, tag, _, owner, _ in self._parsed_tickets() if (r, owner) == (rank, user)),
+            default=0,
+        )
+        return max(self.clock(), newest) + 1
+
+    def _order_key(self, ticket, now_ns: int):
+        rank, tag, arrival, _, name = ticket
+        if rank == PRIORITIES['background'] and now_ns - arrival > self.background_max_wait * 1e9:
+            rank = PRIORITIES['interactive']  # waited long enough; no more starving
+        return rank, tag, arrival, name
+
+    def position(self, name: str, prune: bool = False) -> int:
+        """0-based place of ticket ``name`` in the fair order."""
+        now_ns = time.time_ns()
+        tickets = sorted(self._parsed_tickets(), key=lambda ticket: self._order_key(ticket, now_ns))
+        names = [ticket[-1] for ticket in tickets]
+        index = names.index(name) if name in names else len(names)
+        if prune and index:
+            # Slots are free but tickets are ahead: drop any whose owner died
+            ahead = self._prune(names[:index])
+            index = len(ahead)
+        return index
+
+    def enqueue(self, user_id=None, priority: str = 'interactive'):
+        """
+        Join the queue (raising ``QueueFull`` when it is at its limit) and
+        return a ticket; call ``wait`` or ``try_admit`` on it, then ``release``.
+        """
+        if not self.enabled:
+            return _Admitted()
+        if self.queue_length() >= self.max_queue:
+            metrics.increment('admission.shed')
+            raise QueueFull(self.retry_after)
+        ticket = Ticket(self, user_id, priority, self.next_tag(user_id, priority))
+        ticket._enqueue()
+        metrics.increment(f'admission.{priority}')
+        return ticket
+
+    async def aenqueue(self, user_id=None, priority: str = 'interactive'):
+        """``enqueue`` off the event loop."""
+        return await sync_to_async(self.enqueue, thread_sensitive=False)(user_id, priority)
+
+    def check_capacity(self):
+        """Raise ``QueueFull`` now if a new request would be refused."""
+        if self.enabled and self.queue_length() >= self.max_queue:
+            metrics.increment('admission.shed')
+            raise QueueFull(self.retry_after)
+
+    async def acheck_capacity(self):
+        """``check_capacity`` off the event loop."""
+        await sync_to_async(self.check_capacity, thread_sensitive=False)()
+
+    @contextmanager
+    def admit(self, user_id=None, priority: str = 'interactive', cancelled: Callable[[], bool] = None):
+        """
+        Hold a slot for the duration of the block, waiting for it if needed
+        (see ``Ticket.wait`` for ``cancelled``).
+        """
+        ticket = self.enqueue(user_id, priority)
+        try:
+            for _ in ticket.wait(cancelled=cancelled):
+                pass
+            yield ticket
+        finally:
+            ticket.release()
+
+    @asynccontextmanager
+    async def aadmit(self, user_id=None, priority: str = 'interactive'):
+        ticket = await self.aenqueue(user_id, priority)
+        try:
+            async for _ in ticket.await_positions():
+                pass
+            yield ticket
+        finally:
+            await ticket.arelease()
+
+
+_controllers = {}
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller(model: Optional[str] = None) -> AdmissionController:
+    """
+    Controller of the slots for ``model``, by default the chat model
+    (``LLM_MODEL_SLOTS.get(model, LLM_SLOTS)`` slots).
+    """
+    if model is None:
+        from .ollama_client import TASK_CHAT, get_model_profile
+
+        model = get_model_profile(TASK_CHAT).model
+    controller = _controllers.get(model)
+    if controller is None:
+        with _controller_lock:
+            controller = _controllers.get(model)
+            if controller is None:
+                root = getattr(settings, 'LLM_ADMISSION_DIR', '/tmp/bsc_ai_llm_admission')
+                slots = getattr(settings, 'LLM_SLOTS', 1)
+                controller = AdmissionController(
+                    directory=os.path.join(root, re.sub(r'[^\w.-]', '_', model)),
+                    slots=getattr(settings, 'LLM_MODEL_SLOTS', {}).get(model, slots) if slots else 0,
+                    max_queue=getattr(settings, 'LLM_QUEUE_MAX', 64),
+                    timeout=getattr(settings, 'LLM_QUEUE_TIMEOUT', 300.0),
+                    retry_after=getattr(settings, 'LLM_QUEUE_RETRY_AFTER', 10),
+                    poll_interval=getattr(settings, 'LLM_QUEUE_POLL_INTERVAL', 0.1),
+                    background_max_wait=getattr(settings, 'LLM_BACKGROUND_MAX_WAIT', 120.0),
+                )
+                _controllers[model] = controller
+    return controller
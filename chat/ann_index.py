@@ -0,0 +1,369 @@
+"""
+Optional approximate-nearest-neighbour (IVF) acceleration for retrieval.
+
+Each user gets an inverted-file shard persisted under ``RAG_ANN_DIR``
+(``MEDIA_ROOT/vector_index`` by default): spherical k-means centroids plus
+the list assignment of every chunk id. A query scores the centroids, probes
+the ``RAG_ANN_NPROBE`` closest lists and runs exact scoring only on those
+rows of the resident ``vector_index`` matrix. Chunks added after the shard
+was built are scanned exactly until the next rebuild, so results never miss
+new content.
+
+Small corpora (below ``RAG_ANN_MIN_CHUNKS``) always use exact search, and
+so does every corpus where ``fcntl`` (POSIX) is unavailable to lock shard
+rewrites.
+"""
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from . import vector_index
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_SHARD_FILE = 'ivf.npz'
+_ASSIGN_BLOCK = 8192
+
+
+def enabled() -> bool:
+    return getattr(settings, 'RAG_ANN_ENABLED', False) and fcntl is not None
+
+
+def _min_chunks() -> int:
+    return getattr(settings, 'RAG_ANN_MIN_CHUNKS', 20000)
+
+
+def _nprobe() -> int:
+    return getattr(settings, 'RAG_ANN_NPROBE', 8)
+
+
+def _shard_dir(user_id: int) -> Path:
+    root = getattr(settings, 'RAG_ANN_DIR', None) or os.path.join(settings.MEDIA_ROOT, 'vector_index')
+    return Path(root) / f'user_{user_id}'
+
+
+def _default_nlist(n_rows: int) -> int:
+    # ~4 * sqrt(N) lists keeps list scans and centroid scoring balanced
+    return int(max(1, min(n_rows // 39, 4 * np.sqrt(n_rows))))
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _assign(vectors, centroids):
+    """Nearest centroid (by cosine) for each row, computed in blocks."""
+    out = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], _ASSIGN_BLOCK):
+        block = vectors[start:start + _ASSIGN_BLOCK]
+        out[start:start + _ASSIGN_BLOCK] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def train_centroids(vectors, nlist: int, iterations: int = 12, seed: int = 0):
+    """Spherical k-means on a sample of the (normalized) vectors."""
+    rng = np.random.default_rng(seed)
+    n = vectors.shape[0]
+    sample_size = min(n, nlist * 64)
+    train = vectors[rng.choice(n, sample_size, replace=False)] if sample_size < n else vectors
+    centroids = train[rng.choice(train.shape[0], nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = _assign(train, centroids)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=nlist)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        present = counts > 0
+        sums[present] = np.add.reduceat(train[order], starts[present], axis=0)
+        # Re-seed empty lists from random training rows
+        empty = ~present
+        if empty.any():
+            sums[empty] = train[rng.choice(train.shape[0], int(empty.sum()))]
+        centroids = _normalize(sums).astype(np.float32)
+    return centroids
+
+
+class IVFShard:
+    """Centroids plus chunk-id -> list assignments for one user."""
+
+    def __init__(self, user_id: int, centroids, chunk_ids, assignments, version=None):
+        self.user_id = user_id
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self.version = version
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    def __len__(self):
+        return self.chunk_ids.shape[0]
+
+    @classmethod
+    def build(cls, user_id: int, snapshot, nlist: Optional[int] = None, seed: int = 0) -> 'IVFShard':
+        vectors = snapshot.matrix
+        nlist = nlist or _default_nlist(vectors.shape[0])
+        centroids = train_centroids(vectors, nlist, seed=seed)
+        return cls(user_id, centroids, snapshot.chunk_ids.copy(), _assign(vectors, centroids))
+
+    def add(self, chunk_ids: Iterable[int], vectors) -> None:
+        chunk_ids = np.asarray(list(chunk_ids), dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(chunk_ids), -1)
+        if not chunk_ids.size or vectors.shape[1] != self.dim:
+            return
+        self.chunk_ids = np.concatenate([self.chunk_ids, chunk_ids])
+        self.assignments = np.concatenate([self.assignments, _assign(vectors, self.centroids)])
+
+    @classmethod
+    def load(cls, user_id: int) -> Optional['IVFShard']:
+        path = _shard_dir(user_id) / _SHARD_FILE
+        try:
+            version = path.stat().st_mtime_ns
+            with np.load(path) as data:
+                return cls(
+                    user_id, data['centroids'], data['chunk_ids'], data['assignments'],
+                    version=version,
+                )
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Failed to load ANN shard for user {user_id}: {e}")
+            return None
+
+    def save(self) -> None:
+        directory = _shard_dir(self.user_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp = directory / f'.{_SHARD_FILE}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, centroids=self.centroids, chunk_ids=self.chunk_ids, assignments=self.assignments)
+        os.replace(tmp, directory / _SHARD_FILE)
+        self.version = (directory / _SHARD_FILE).stat().st_mtime_ns
+
+
+class _ShardView:
+    """Shard lists translated to row positions of one index snapshot."""
+
+    def __init__(self, shard: IVFShard, snapshot):
+        order = np.argsort(snapshot.chunk_ids, kind='stable')
+        sorted_ids = snapshot.chunk_ids[order]
+        pos = np.searchsorted(sorted_ids, shard.chunk_ids)
+        pos = np.minimum(pos, max(sorted_ids.shape[0] - 1, 0))
+        found = sorted_ids.shape[0] > 0
+        live = (sorted_ids[pos] == shard.chunk_ids) if found else np.zeros(len(shard), dtype=bool)
+
+        rows = order[pos[live]]
+        lists = shard.assignments[live]
+        by_list = np.argsort(lists, kind='stable')
+        counts = np.bincount(lists, minlength=shard.nlist)
+        self.list_rows = np.split(rows[by_list], np.cumsum(counts)[:-1])
+
+        covered = np.zeros(snapshot.chunk_ids.shape[0], dtype=bool)
+        covered[rows] = True
+        # Rows added since the shard was built: always scanned exactly
+        self.uncovered_rows = np.flatnonzero(~covered)
+        self.stale_entries = int((~live).sum())
+
+
+_shards: Dict[int, IVFShard] = {}
+_views: Dict[int, Tuple[Tuple, _ShardView]] = {}
+_cache_lock = threading.Lock()
+
+
+def _current_shard(user_id: int) -> Optional[IVFShard]:
+    """Cached shard for a user, reloaded when another process rewrote it."""
+    path = _shard_dir(user_id) / _SHARD_FILE
+    try:
+        version = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        with _cache_lock:
+            _shards.pop(user_id, None)
+            _views.pop(user_id, None)
+        return None
+
+    with _cache_lock:
+        shard = _shards.get(user_id)
+    if shard is not None and shard.version == version:
+        return shard
+
+    shard = IVFShard.load(user_id)
+    with _cache_lock:
+        if shard is None:
+            _shards.pop(user_id, None)
+        else:
+            _shards[user_id] = shard
+    return shard
+
+
+def _view_for(shard: IVFShard, snapshot) -> _ShardView:
+    key = (shard.version, snapshot.generation, snapshot.chunk_ids.shape[0])
+    with _cache_lock:
+        cached = _views.get(shard.user_id)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    view = _ShardView(shard, snapshot)
+    with _cache_lock:
+        _views[shard.user_id] = (key, view)
+    return view
+
+
+def candidate_rows(shard: IVFShard, snapshot, query, nprobe: int):
+    """Row positions in the probed lists plus every uncovered row."""
+    view = _view_for(shard, snapshot)
+    nprobe = min(nprobe, shard.nlist)
+    centroid_scores = shard.centroids @ query
+    probes = np.argpartition(centroid_scores, shard.nlist - nprobe)[shard.nlist - nprobe:]
+    return np.concatenate([view.list_rows[i] for i in probes] + [view.uncovered_rows])
+
+
+def search(
+    index,
+    query_vector,
+    top_k: int,
+    document_ids: Optional[Iterable[int]] = None,
+    per_document_k: Optional[int] = None,
+    nprobe: Optional[int] = None,
+    force: bool = False,
+) -> List[Tuple[int, int, float]]:
+    """
+    Top-k search over a resident ``vector_index`` index, probing the user's
+    IVF shard when one applies and falling back to exact search otherwise.
+    """
+    snapshot = index.snapshot()
+    if document_ids is not None:
+        document_ids = list(document_ids)
+
+    def exact():
+        return vector_index.search_snapshot(
+            snapshot, query_vector, top_k,
+            document_ids=document_ids, per_document_k=per_document_k,
+        )
+
+    if not (enabled() or force):
+        return exact()
+
+    if document_ids is not None:
+        scope = int(np.isin(snapshot.document_ids, np.asarray(document_ids, dtype=np.int64)).sum())
+    else:
+        scope = snapshot.chunk_ids.shape[0]
+    if scope < _min_chunks() and not force:
+        return exact()
+
+    shard = _current_shard(index.user_id)
+    if shard is None or shard.dim != index.dim:
+        return exact()
+
+    query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+    rows = candidate_rows(shard, snapshot, query, nprobe or _nprobe())
+    hits = vector_index.search_snapshot(
+        snapshot, query, top_k,
+        document_ids=document_ids, per_document_k=per_document_k, rows=rows,
+    )
+    if len(hits) < min(top_k, scope) and not per_document_k and not force:
+        # Probed lists did not hold enough in-scope rows
+        return exact()
+    return hits
+
+
+class _ShardLock:
+    """
+    Inter-process lock around shard rewrites. Without ``fcntl`` it only
+    guards the explicit ``ann_index`` management command, and doesn't lock.
+    """
+
+    def __init__(self, user_id: int):
+        self.directory = _shard_dir(user_id)
+
+    def __enter__(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if fcntl is not None:
+            self._file = open(self.directory / '.lock', 'w')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+
+
+def build_user(user_id: int, dim: int, nlist: Optional[int] = None) -> Optional[IVFShard]:
+    """(Re)build and persist a user's shard from their resident index."""
+    index = vector_index.get_user_index(user_id, dim)
+    snapshot = index.snapshot()
+    if not snapshot.chunk_ids.shape[0]:
+        drop_user(user_id)
+        return None
+    with _ShardLock(user_id):
+        shard = IVFShard.build(user_id, snapshot, nlist=nlist)
+        shard.save()
+    logger.info(
+        f"Built ANN shard for user {user_id}: {len(shard)} rows, {shard.nlist} lists"
+    )
+    with _cache_lock:
+        _shards[user_id] = shard
+    return shard
+
+
+def update_user(user_id: int, batches: Iterable[Tuple[List[int], List]], dim: int) -> None:
+    """
+    Called after ``process_document`` commits new chunks, given as
+    ``(chunk_ids, vectors)`` batches: append them to an existing shard, or
+    build the first shard once the corpus is large enough.
+    """
+    if not enabled():
+        return
+    try:
+        if (_shard_dir(user_id) / _SHARD_FILE).exists():
+            with _ShardLock(user_id):
+                shard = IVFShard.load(user_id)
+                if shard is None or shard.dim != dim:
+                    return
+                for chunk_ids, vectors in batches:
+                    shard.add(chunk_ids, vectors)
+                shard.save()
+            with _cache_lock:
+                _shards[user_id] = shard
+        elif len(vector_index.get_user_index(user_id, dim)) >= _min_chunks():
+            build_user(user_id, dim)
+    except Exception as e:
+        # The shard is only an accelerator; exact search still works
+        logger.error(f"Failed to update ANN shard for user {user_id}: {e}")
+
+
+def drop_user(user_id: int) -> None:
+    """Delete a user's persisted shard."""
+    path = _shard_dir(user_id) / _SHARD_FILE
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+    with _cache_lock:
+        _shards.pop(user_id, None)
+        _views.pop(user_id, None)
+
+
+def measure_recall(index, queries, top_k: int = 5, nprobe: Optional[int] = None) -> float:
+    """Mean recall@k of ANN search against exact search for ``queries``."""
+    total = 0.0
+    for query in queries:
+        exact = {h[0] for h in index.search(query, top_k)}
+        approx = {h[0] for h in search(index, query, top_k, nprobe=nprobe, force=True)}
+        total += len(exact & approx) / max(len(exact), 1)
+    return total / max(len(queries), 1)
@@ -0,0 +1,202 @@
+"""
+Opt-in semantic cache of chat answers.
+
+At temperature 0.1 and without external context, a question like "what is
+BSC" gets effectively the same answer every time. With
+``ANSWER_CACHE_ENABLED`` on for the conversation's chat type
+(``ANSWER_CACHE_CHAT_TYPES``), an answer is looked up before the model is
+asked:
+
+- entries are grouped by a hash of everything in the prompt except the
+  question: model and sampling options, system prompt, history, and
+  retrieved or web context. Only answers given under an identical context
+  can match;
+- within the group, the question's embedding (``embeddings.encode_query``)
+  must reach cosine similarity ``ANSWER_CACHE_THRESHOLD`` with a cached
+  question;
+- entries expire after ``ANSWER_CACHE_TTL`` seconds. The least recently
+  used are evicted beyond ``ANSWER_CACHE_MAX_ENTRIES`` entries or
+  ``ANSWER_CACHE_MAX_BYTES``.
+
+Only complete answers are stored, never interrupted or failed ones. Like
+the query embedding cache, each process keeps its own.
+
+Metrics: ``answer_cache.hits``, ``answer_cache.misses`` and
+``answer_cache.stores`` counters, the ``answer_cache.lookup`` timer, and
+gauges ``answer_cache.hit_rate``, ``answer_cache.entries`` and
+``answer_cache.bytes``.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+from .embeddings import encode_query, get_embedding_backend
+from .ollama_client import ERROR_PREFIX, TASK_CHAT, get_model_profile
+from .prompting import QUESTION_HEADER
+
+logger = logging.getLogger(__name__)
+
+# context: embedding backend version and prompt-context hash; vector: the question
+CacheKey = namedtuple('CacheKey', ['context', 'vector'])
+
+_Entry = namedtuple('_Entry', ['context', 'vector', 'answer', 'created', 'cost'])
+
+
+class AnswerCache:
+    """Answers grouped by context, matched by question similarity; LRU within size bounds."""
+    # Entry tuple, OrderedDict node and ndarray header, roughly
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int, max_bytes: int, clock=time.monotonic):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._groups: Dict[str, Dict[int, None]] = {}
+        self._next_id = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        group = self._groups[entry.context]
+        del group[entry_id]
+        if not group:
+            del self._groups[entry.context]
+        self._bytes -= entry.cost
+
+    def _best(self, context, vector) -> Optional[int]:
+        """Closest live entry at or above the threshold; drops expired ones on the way."""
+        now = self.clock()
+        best_id, best_score = None, self.threshold
+        for entry_id in list(self._groups.get(context, ())):
+            entry = self._entries[entry_id]
+            if now - entry.created > self.ttl:
+                self._remove(entry_id)
+                continue
+            score = float(np.dot(entry.vector, vector))
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        return best_id
+
+    def get(self, context: str, vector: np.ndarray) -> Optional[str]:
+        with self._lock:
+            entry_id = self._best(context, vector)
+            if entry_id is None:
+                return None
+            self._entries.move_to_end(entry_id)
+            return self._entries[entry_id].answer
+
+    def put(self, context: str, vector: np.ndarray, answer: str) -> None:
+        cost = self.ENTRY_OVERHEAD + len(answer.encode('utf-8')) + vector.nbytes
+        if cost > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            # A near-identical question answered meanwhile is replaced
+            previous = self._best(context, vector)
+            if previous is not None:
+                self._remove(previous)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(context, vector, answer, self.clock(), cost)
+            self._groups.setdefault(context, {})[entry_id] = None
+            self._bytes += cost
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+            self._bytes = 0
+
+
+_cache = AnswerCache(
+    threshold=getattr(settings, 'ANSWER_CACHE_THRESHOLD', 0.95),
+    ttl=getattr(settings, 'ANSWER_CACHE_TTL', 86400),
+    max_entries=getattr(settings, 'ANSWER_CACHE_MAX_ENTRIES', 2000),
+    max_bytes=getattr(settings, 'ANSWER_CACHE_MAX_BYTES', 32 * 1024 * 1024),
+)
+
+
+def _hit_rate() -> float:
+    hits = metrics.get_counter('answer_cache.hits')
+    lookups = hits + metrics.get_counter('answer_cache.misses')
+    return round(hits / lookups, 3) if lookups else 0.0
+
+
+metrics.register_gauge('answer_cache.hit_rate', _hit_rate)
+metrics.register_gauge('answer_cache.entries', lambda: len(_cache))
+metrics.register_gauge('answer_cache.bytes', lambda: _cache.nbytes)
+
+
+def enabled_for(chat_type: str) -> bool:
+    return (
+        getattr(settings, 'ANSWER_CACHE_ENABLED', False)
+        and chat_type in getattr(settings, 'ANSWER_CACHE_CHAT_TYPES', ['general'])
+    )
+
+
+def cache_key(messages, chat_type: str) -> Optional[CacheKey]:
+    """
+    Key for a prompt from ``prompting.build_chat_messages``, or None when the
+    cache is off for ``chat_type`` or the question cannot be embedded.
+    """
+    if not enabled_for(chat_type) or not messages:
+        return None
+    context, header, question = messages[-1]['content'].rpartition(QUESTION_HEADER)
+    if not header:
+        context, question = '', messages[-1]['content']
+    profile = get_model_profile(TASK_CHAT)
+    prompt_context = json.dumps(
+        [profile.model, profile.options, messages[:-1], context], sort_keys=True, ensure_ascii=False
+    )
+    try:
+        vector = encode_query(question)
+        version = get_embedding_backend().version
+    except Exception as e:
+        logger.error(f"Answer cache bypassed, question embedding failed: {e}")
+        return None
+    digest = hashlib.sha256(prompt_context.encode('utf-8')).hexdigest()
+    return CacheKey(f'{version}:{digest}', vector)
+
+
+def lookup(key: Optional[CacheKey]) -> Optional[str]:
+    if key is None:
+        return None
+    with metrics.timer('answer_cache.lookup'):
+        answer = _cache.get(key.context, key.vector)
+    metrics.increment('answer_cache.hits' if answer is not None else 'answer_cache.misses')
+    return answer
+
+
+def store(key: Optional[CacheKey], answer: str) -> None:
+    """Keep a complete answer; empty answers and Ollama errors are skipped."""
+    if key is None or not answer.strip() or ERROR_PREFIX in answer:
+        return
+    _cache.put(key.context, key.vector, answer)
+    metrics.increment('answer_cache.stores')
+
+
+def replay(answer: str) -> Iterator[str]:
+    """A cached answer in chunk-frame sized pieces (``SSE_FLUSH_BYTES`` characters)."""
+    size = getattr(settings, 'SSE_FLUSH_BYTES', 512) or 512
+    for start in range(0, len(answer), size):
+        yield answer[start:start + size]
@@ -15,6 +15,8 @@ from .api_views import (
     ConversationDetailView,
     # Chat
     SendMessageView,
+    AsyncSendMessageView,
+    CancelGenerationView,
     # Documents
     DocumentListCreateView,
     DocumentDetailView,
@@ -23,6 +25,7 @@ from .api_views import (
     DocumentTablePreviewView,
     # Utility
     HealthCheckView,
+    MetricsView,
 )
 
 app_name = 'api'
@@ -33,6 +36,9 @@ urlpatterns = [
     # ==========================================================================
     path('health/', HealthCheckView.as_view(), name='health'),
     
+    # GET /api/metrics/ - Process metrics (staff only)
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    
     # ==========================================================================
     # Authentication (JWT)
     # ==========================================================================
@@ -72,6 +78,15 @@ urlpatterns = [
     # POST /api/chat/send/<id>/ - Send message to existing conversation
     path('chat/send/<int:conversation_id>/', SendMessageView.as_view(), name='send_message'),
     
+    # POST /api/chat/stream/      - Same as chat/send/, served async (run under ASGI)
+    path('chat/stream/', AsyncSendMessageView.as_view(), name='stream_message_new'),
+    
+    # POST /api/chat/stream/<id>/ - Async send to existing conversation
+    path('chat/stream/<int:conversation_id>/', AsyncSendMessageView.as_view(), name='stream_message'),
+    
+    # POST /api/chat/<id>/cancel/ - Stop the in-flight answer for a conversation
+    path('chat/<int:conversation_id>/cancel/', CancelGenerationView.as_view(), name='cancel_generation'),
+    
     # ==========================================================================
     # Documents
     # ==========================================================================
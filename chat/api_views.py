@@ -1,14 +1,22 @@
 from rest_framework import status, viewsets
 from rest_framework.decorators import api_view, permission_classes, action
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.parsers import MultiPartParser, FormParser
 from django.http import StreamingHttpResponse, JsonResponse, HttpResponseBadRequest
+from django.conf import settings
 from django.shortcuts import get_object_or_404
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
 import json
 import re
+from functools import partial
 
+from . import generation as generations, metrics
 from .models import Conversation, ChatMessage, Document, ChatAttachment
 from .serializers import (
     ConversationListSerializer,
@@ -22,9 +30,12 @@ from .serializers import (
     UserSerializer,
     UserRegistrationSerializer,
 )
-from .ollama_client import get_ai_response_stream, get_web_tool_call
-from .document_service import process_document, search_documents, get_tabular_preview, build_default_chart_from_preview
+from .admission import QueueFull, get_admission_controller
+from .streaming import AnswerStream
+from .prompting import build_chat_messages, format_document_results, load_history
+from .document_service import store_uploaded_document, search_documents, get_tabular_preview, build_default_chart_from_preview
 from .web_search import get_web_context, execute_web_tool_call
+from .tool_routing import route_web_tool
 
 # Import tools if you have them
 try:
@@ -165,117 +176,8 @@ class ConversationDetailView(APIView):
 # CHAT / MESSAGING VIEWS
 # =============================================================================
 
-class SendMessageView(APIView):
-    """
-    POST /api/chat/send/              - Send message (creates new conversation)
-    POST /api/chat/send/<id>/         - Send message to existing conversation
-    
-    Returns: Server-Sent Events (SSE) stream
-    """
-    permission_classes = [IsAuthenticated]
-    
-    def post(self, request, conversation_id=None):
-        serializer = SendMessageSerializer(data=request.data)
-        if not serializer.is_valid():
-            return Response({
-                'success': False,
-                'errors': serializer.errors
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        message_text = serializer.validated_data['message']
-        chat_type = serializer.validated_data.get('chat_type', 'general')
-        
-        # Get or create conversation
-        if conversation_id:
-            conversation = get_object_or_404(
-                Conversation, id=conversation_id, user=request.user
-            )
-        else:
-            title = self._generate_chat_title(message_text)
-            conversation = Conversation.objects.create(
-                user=request.user,
-                title=title,
-                chat_type=chat_type
-            )
-        
-        # Save user message
-        ChatMessage.objects.create(
-            conversation=conversation,
-            user=request.user,
-            is_user_message=True,
-            content=message_text
-        )
-        
-        # === STEP 1: Check for tool use ===
-        print(f"[DEBUG] Checking tool context for message: '{message_text}'")
-        tool_context = self._get_tool_context(request.user, message_text)
-        print(f"[DEBUG] Tool context result: {tool_context[:100] if tool_context else 'None'}...")
-        
-        # === STEP 2: Get document context (RAG) ===
-        doc_context = self._get_document_context(
-            request.user, conversation, message_text, chat_type
-        )
-        
-        # === STEP 3: Combine contexts ===
-        final_context = self._combine_contexts(tool_context, doc_context)
-        
-        # === STEP 4: Build chat history ===
-        messages = self._build_chat_history(conversation, message_text, tool_context=tool_context, doc_context=doc_context)
-        
-        # === STEP 5: Prepare any tabular chart data (for document chats) ===
-        chart_data = None
-        if chat_type == 'document' or conversation.chat_type == 'document':
-            try:
-                # Use the first attached tabular document for a default chart
-                tabular_attachment = ChatAttachment.objects.filter(
-                    conversation=conversation,
-                    document__processed=True,
-                    document__file_type__in=('csv', 'xlsx', 'xls'),
-                ).select_related('document').first()
-
-                if tabular_attachment:
-                    preview = get_tabular_preview(tabular_attachment.document, max_rows=100)
-                    chart_data = build_default_chart_from_preview(preview)
-                    if chart_data:
-                        chart_data['title'] = tabular_attachment.document.title
-                        chart_data['document_id'] = tabular_attachment.document.id
-            except Exception as e:
-                # Chart data is optional; log and continue silently on failure
-                print(f"[WARN] Failed to build chart data: {e}")
-                chart_data = None
-
-        # === STEP 6: Stream response ===
-        def event_stream():
-            full_response = ""
-            try:
-                for chunk in get_ai_response_stream(messages, context=final_context):
-                    full_response += chunk
-                    yield f"data: {json.dumps({'chunk': chunk})}\n\n"
-                
-                # Save AI response
-                ChatMessage.objects.create(
-                    conversation=conversation,
-                    user=request.user,
-                    is_user_message=False,
-                    content=full_response
-                )
-
-                # Optionally send chart data for the client to render
-                if chart_data:
-                    yield f"data: {json.dumps({'chart_data': chart_data})}\n\n"
-                
-                yield f"data: {json.dumps({'done': True, 'conversation_id': conversation.id})}\n\n"
-            
-            except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        
-        response = StreamingHttpResponse(
-            event_stream(),
-            content_type='text/event-stream'
-        )
-        response['Cache-Control'] = 'no-cache'
-        response['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
-        return response
+class ChatMessageMixin:
+    """Title, context and prompt helpers shared by the sync and async send-message views"""
     
     def _generate_chat_title(self, message):
         """Generate a smart title from the first message"""
@@ -301,13 +203,18 @@ class SendMessageView(APIView):
         
         return title if title else 'New Chat'
     
-    def _get_tool_context(self, user, message_text):
-        """Check for tool use (weather/stock/web search)"""
+    def _get_tool_context(self, user, message_text, report=None, deadline=None):
+        """
+        Check for tool use (weather/stock/web search), calling report(stage) as it progresses.
+        Web routing and the Tavily calls give up at ``deadline``; nothing new starts after it.
+        """
+        report = report or (lambda stage: None)
         tool_context = ""
         lower_msg = message_text.lower()
         
         # Weather detection
         if "weather" in lower_msg:
+            report('searching_web')
             city_match = re.search(r"(?:in\s+)([a-zA-Z\s\-']+)", message_text, re.IGNORECASE)
             city = city_match.group(1).strip() if city_match else "Kigali"
             tool_context = get_weather(city) or ""
@@ -316,6 +223,7 @@ class SendMessageView(APIView):
         elif "stock" in lower_msg or "$" in message_text or re.search(r'\b[A-Z]{1,5}\b', message_text):
             tickers = re.findall(r'\b([A-Z]{1,5})\b', message_text)
             if tickers:
+                report('searching_web')
                 tool_context = get_stock_price(tickers[0]) or ""
         
         # Web context: gated model-routed Tavily tool calls
@@ -359,20 +267,24 @@ class SendMessageView(APIView):
             )
 
             if matched_triggers:
-                tool_call = get_web_tool_call(message_text)
+                report('routing')
+                tool_call = route_web_tool(message_text, user_id=user.id, deadline=deadline)
+                if deadline is not None and deadline.expired:
+                    return ""
+                if tool_call.get("tool") not in (None, "", "none"):
+                    report('searching_web')
                 web_context = execute_web_tool_call(
-                    tool_call, original_query=message_text, user_id=user.id
+                    tool_call, original_query=message_text, user_id=user.id, deadline=deadline
                 )
 
                 # Optional fallback: if the router decided "none" but a user pasted a URL,
                 # use the heuristic Tavily context builder.
                 if (
                     not web_context
-                    and "http://" in lower_msg
-                    or "https://" in lower_msg
-                    or "www." in lower_msg
+                    and not (deadline is not None and deadline.expired)
+                    and ("http://" in lower_msg or "https://" in lower_msg or "www." in lower_msg)
                 ):
-                    web_context = get_web_context(message_text, user_id=user.id)
+                    web_context = get_web_context(message_text, user_id=user.id, deadline=deadline)
 
                 if web_context:
                     tool_context = (
@@ -382,84 +294,278 @@ class SendMessageView(APIView):
         
         return tool_context
     
-    def _get_document_context(self, user, conversation, message_text, chat_type):
-        """Get document context via RAG"""
-        context = None
-        
+    def _get_document_context(self, user, conversation, message_text, chat_type, report=None):
+        """Get retrieved document chunks (RAG) as context blocks, best first"""
         if chat_type == 'document' or conversation.chat_type == 'document':
-            attachments = ChatAttachment.objects.filter(
-                conversation=conversation,
-                document__processed=True
-            ).select_related('document')
-            
-            document_ids = [att.document.id for att in attachments]
+            document_ids = list(
+                ChatAttachment.objects.filter(
+                    conversation=conversation,
+                    document__status=Document.STATUS_READY
+                ).values_list('document_id', flat=True)
+            )
             
             if document_ids:
-                results = search_documents(user.id, message_text, top_k=5)
-                results = [r for r in results if r['document_id'] in document_ids]
-                
-                if results:
-                    context_parts = []
-                    for result in results:
-                        context_parts.append(
-                            f"[From: {result['document_title']}]\n{result['content']}\n---"
-                        )
-                    context = "\n\n".join(context_parts)
-                    if len(context) > 12000:
-                        context = context[:12000] + "..."
-        
-        return context
-    
-    def _combine_contexts(self, tool_context, doc_context):
-        """Combine tool and document contexts"""
-        final_context = ""
-        
-        if tool_context and "unavailable" not in tool_context:
-            final_context = f"[Real-time Data]: {tool_context}"
-        
-        if doc_context:
-            if final_context:
-                final_context += f"\n\n[Document Context]: {doc_context}"
-            else:
-                final_context = f"[Document Context]: {doc_context}"
-        
-        return final_context
-    
-    def _build_chat_history(self, conversation, current_message, tool_context=None, doc_context=None):
-        """Build chat history for context"""
-        previous_messages = ChatMessage.objects.filter(
-            conversation=conversation
-        ).order_by('-timestamp')[:4]
-        previous_messages = list(reversed(previous_messages))
-        
-        messages = []
-        for msg in previous_messages[:-1]:  # Exclude current message
-            role = "user" if msg.is_user_message else "assistant"
-            messages.append({"role": role, "content": msg.content})
-        
-        # Build enhanced message with context
-        enhanced_message = current_message
-        
-        # If we have tool context (like web search results), inject it into the user message
-        if tool_context and "[Web Search Results" in tool_context:
-            enhanced_message = (
-                f"{current_message}\n\n"
-                f"[Here are current search results to help answer this question:]\n"
-                f"{tool_context}\n\n"
-                f"[Use the search results above to answer my question about: {current_message}]"
+                if report:
+                    report('retrieving_documents')
+                results = search_documents(
+                    user.id, message_text, top_k=5, document_ids=document_ids
+                )
+                return format_document_results(results)
+        
+        return []
+    
+    def _build_prompt(self, conversation, current_message, tool_context, doc_context):
+        """Build the model messages: system prompt, history, then context and question once"""
+        if tool_context and "unavailable" in tool_context:
+            tool_context = ""
+        messages, _ = build_chat_messages(
+            load_history(conversation),
+            current_message,
+            documents=doc_context,
+            realtime_context=tool_context,
+        )
+        return messages
+    
+    def _get_chart_data(self, conversation, chat_type):
+        """Default chart for the first attached tabular document (document chats only)"""
+        chart_data = None
+        if chat_type == 'document' or conversation.chat_type == 'document':
+            try:
+                # Use the first attached tabular document for a default chart
+                tabular_attachment = ChatAttachment.objects.filter(
+                    conversation=conversation,
+                    document__status=Document.STATUS_READY,
+                    document__file_type__in=('csv', 'xlsx', 'xls'),
+                ).select_related('document').first()
+
+                if tabular_attachment:
+                    preview = get_tabular_preview(tabular_attachment.document, max_rows=100)
+                    chart_data = build_default_chart_from_preview(preview)
+                    if chart_data:
+                        chart_data['title'] = tabular_attachment.document.title
+                        chart_data['document_id'] = tabular_attachment.document.id
+            except Exception as e:
+                # Chart data is optional; log and continue silently on failure
+                print(f"[WARN] Failed to build chart data: {e}")
+                chart_data = None
+        return chart_data
+    
+    def _context_sources(self, user, conversation, message_text, chat_type):
+        """Independent context sources for context_gathering, each with its deadline"""
+        return {
+            'tools': (
+                lambda report, deadline: self._get_tool_context(user, message_text, report, deadline),
+                getattr(settings, 'CONTEXT_TOOLS_TIMEOUT', 20.0),
+            ),
+            'documents': (
+                lambda report, deadline: self._get_document_context(user, conversation, message_text, chat_type, report),
+                getattr(settings, 'CONTEXT_DOCUMENTS_TIMEOUT', 10.0),
+            ),
+            'chart': (
+                lambda report, deadline: self._get_chart_data(conversation, chat_type),
+                getattr(settings, 'CONTEXT_CHART_TIMEOUT', 5.0),
+            ),
+        }
+    
+    def _prompt_from_context(self, conversation, message_text, context):
+        """Prompt messages and chart data from gathered context (sources that missed out count as empty)"""
+        tool_context = context.values.get('tools') or ""
+        print(f"[DEBUG] Tool context result: {tool_context[:100] if tool_context else 'None'}...")
+        messages = self._build_prompt(
+            conversation, message_text, tool_context, context.values.get('documents') or []
+        )
+        return messages, context.values.get('chart')
+    
+    def _busy_response(self):
+        """503 with Retry-After when the generation queue is full, else None"""
+        try:
+            get_admission_controller().check_capacity()
+        except QueueFull as e:
+            response = JsonResponse({
+                'success': False,
+                'error': 'The assistant is busy. Please retry shortly.',
+                'retry_after': e.retry_after
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+        return None
+
+
+class SendMessageView(ChatMessageMixin, APIView):
+    """
+    POST /api/chat/send/              - Send message (creates new conversation)
+    POST /api/chat/send/<id>/         - Send message to existing conversation
+    
+    Returns: Server-Sent Events (SSE) stream
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, conversation_id=None):
+        serializer = SendMessageSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({
+                'success': False,
+                'errors': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        message_text = serializer.validated_data['message']
+        chat_type = serializer.validated_data.get('chat_type', 'general')
+        
+        # Shed load up front rather than queueing without bound
+        busy = self._busy_response()
+        if busy:
+            return busy
+        
+        # Get or create conversation
+        if conversation_id:
+            conversation = get_object_or_404(
+                Conversation, id=conversation_id, user=request.user
             )
-        # If we have document context (RAG), inject it into the user message
-        elif doc_context:
-            enhanced_message = (
-                f"{current_message}\n\n"
-                f"[Here is content from my uploaded documents that is relevant to my question:]\n"
-                f"{doc_context[:4000]}\n\n"
-                f"[Use the document content above to answer my question: {current_message}]"
+        else:
+            title = self._generate_chat_title(message_text)
+            conversation = Conversation.objects.create(
+                user=request.user,
+                title=title,
+                chat_type=chat_type
             )
         
-        messages.append({"role": "user", "content": enhanced_message})
+        # Save user message
+        ChatMessage.objects.create(
+            conversation=conversation,
+            user=request.user,
+            is_user_message=True,
+            content=message_text
+        )
         
-        return messages
+        # === Stream response ===
+        # Tool, document (RAG) and chart context are gathered concurrently inside
+        # the stream, so the client gets the first byte (and progress) at once
+        print(f"[DEBUG] Checking tool context for message: '{message_text}'")
+        answer = AnswerStream(
+            conversation, request.user,
+            sources=self._context_sources(request.user, conversation, message_text, chat_type),
+            build=partial(self._prompt_from_context, conversation, message_text),
+        )
+        
+        response = StreamingHttpResponse(
+            answer.frames(),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
+        return response
+
+
+class AsyncSendMessageView(ChatMessageMixin, View):
+    """
+    POST /api/chat/stream/            - Send message (creates new conversation)
+    POST /api/chat/stream/<id>/       - Send message to existing conversation
+    
+    Same request and SSE stream as SendMessageView, served natively async:
+    under ASGI a stream waiting on the model holds no worker thread. Only
+    JWT bearer authentication is accepted.
+    
+    Returns: Server-Sent Events (SSE) stream
+    """
+    http_method_names = ['post', 'options']
+    
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token-authenticated like the DRF views, so no CSRF cookie is involved
+        return csrf_exempt(super().as_view(**initkwargs))
+    
+    async def _authenticate(self, request):
+        """Return (user, error response) from the Authorization: Bearer header"""
+        try:
+            result = await sync_to_async(JWTAuthentication().authenticate)(request)
+        except (InvalidToken, AuthenticationFailed) as e:
+            detail = e.detail if isinstance(e.detail, dict) else {'detail': e.detail}
+            return None, JsonResponse(detail, status=status.HTTP_401_UNAUTHORIZED)
+        if result is None or not result[0].is_active:
+            return None, JsonResponse(
+                {'detail': 'Authentication credentials were not provided.'},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        return result[0], None
+    
+    async def post(self, request, conversation_id=None):
+        user, error = await self._authenticate(request)
+        if error:
+            return error
+        
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body or b'{}')
+            except ValueError:
+                return JsonResponse({'detail': 'JSON parse error.'}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            data = request.POST
+        serializer = SendMessageSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse({
+                'success': False,
+                'errors': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        message_text = serializer.validated_data['message']
+        chat_type = serializer.validated_data.get('chat_type', 'general')
+        
+        # Shed load up front rather than queueing without bound
+        busy = await sync_to_async(self._busy_response, thread_sensitive=False)()
+        if busy:
+            return busy
+        
+        # Get or create conversation
+        if conversation_id:
+            try:
+                conversation = await Conversation.objects.aget(id=conversation_id, user=user)
+            except Conversation.DoesNotExist:
+                return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        else:
+            conversation = await Conversation.objects.acreate(
+                user=user,
+                title=self._generate_chat_title(message_text),
+                chat_type=chat_type
+            )
+        
+        # Save user message
+        await ChatMessage.objects.acreate(
+            conversation=conversation,
+            user=user,
+            is_user_message=True,
+            content=message_text
+        )
+        
+        answer = AnswerStream(
+            conversation, user,
+            sources=self._context_sources(user, conversation, message_text, chat_type),
+            build=partial(self._prompt_from_context, conversation, message_text),
+        )
+        
+        response = StreamingHttpResponse(
+            answer.aframes(),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
+        return response
+
+
+class CancelGenerationView(APIView):
+    """
+    POST /api/chat/<id>/cancel/ - Stop the answer being generated in a conversation
+    
+    The stream ends with {"done": true, "interrupted": true} and the partial
+    answer is saved flagged as interrupted.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, conversation_id):
+        conversation = get_object_or_404(
+            Conversation, id=conversation_id, user=request.user
+        )
+        generations.cancel(conversation.id)
+        return Response({'success': True})
 
 
 # =============================================================================
@@ -498,24 +604,13 @@ class DocumentListCreateView(APIView):
         file_name = file.name
         file_type = file_name.split('.')[-1].lower()
         
-        # Create document
-        document = Document.objects.create(
-            user=request.user,
-            title=file_name,
-            file=file,
-            file_type=file_type
+        # Create the document and extract, chunk and embed it in the
+        # background (clients poll /api/documents/<id>/status/). Re-uploads
+        # of a file the user already has return the existing document.
+        document, duplicate = store_uploaded_document(
+            request.user, file, file_name, file_type
         )
         
-        # Process document (embeddings)
-        success = process_document(document.id)
-        
-        if not success:
-            document.delete()
-            return Response({
-                'success': False,
-                'error': 'Failed to process document'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
         # Handle conversation linking
         conversation = None
         if conversation_id:
@@ -548,8 +643,9 @@ class DocumentListCreateView(APIView):
         return Response({
             'success': True,
             'document': DocumentSerializer(document, context={'request': request}).data,
-            'conversation_id': conversation.id
-        }, status=status.HTTP_201_CREATED)
+            'conversation_id': conversation.id,
+            'duplicate': duplicate,
+        }, status=status.HTTP_200_OK if duplicate else status.HTTP_201_CREATED)
 
 
 class DocumentDetailView(APIView):
@@ -594,7 +690,12 @@ class DocumentStatusView(APIView):
             'success': True,
             'document_id': document.id,
             'title': document.title,
-            'processed': document.processed
+            'processed': document.processed,
+            'status': document.status,
+            'progress': document.progress,
+            'chunk_count': document.chunk_count,
+            'total_chunks': document.total_chunks,
+            'error': document.error or None,
         })
 
 
@@ -691,4 +792,17 @@ class HealthCheckView(APIView):
             'status': 'healthy',
             'service': 'BSC AI API',
             'version': '1.0.0'
-        })
\ No newline at end of file
+        })
+
+
+class MetricsView(APIView):
+    """
+    GET /api/metrics/  - Counters and timings of the serving process (staff only)
+    """
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        return Response({
+            'success': True,
+            'metrics': metrics.snapshot(),
+        })
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        # Opt-in eager load for web/worker servers; everything else
+        # (migrate, shell, beat) loads the model lazily or never.
+        if getattr(settings, 'RAG_PRELOAD_EMBEDDING_MODEL', False):
+            from .embeddings import get_embedding_backend
+
+            get_embedding_backend()
@@ -0,0 +1,145 @@
+"""
+Token-aware chunking driven by the embedding model's tokenizer.
+
+The model truncates its input at ``max_seq_length`` tokens, so anything past
+that point in a chunk is tokenized and then silently dropped. Chunks here are
+measured in model tokens instead of words and never exceed the model limit.
+
+Text is cut at paragraph breaks when one falls in the second half of a chunk,
+otherwise at the last sentence end, and only a sentence longer than a whole
+chunk is split mid-sentence (at token boundaries). Consecutive chunks share up
+to ``overlap`` tokens of whole trailing sentences.
+
+Character offsets refer to the document text as ``extract_text_from_file``
+returns it: every section followed by a newline.
+"""
+import re
+from bisect import bisect_left
+from collections import namedtuple
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+Chunk = namedtuple('Chunk', 'text page char_start char_end token_count')
+
+# A unit is the smallest piece a chunk is assembled from: a sentence, or a
+# token-bounded slice of a sentence that is too long to fit one chunk.
+_Unit = namedtuple('_Unit', 'start end tokens page paragraph_end')
+
+_BOUNDARY = re.compile(r'\n[ \t]*\n\s*|(?<=[.!?])["\')\]]*\s+')
+
+# [CLS] and [SEP]
+SPECIAL_TOKENS = 2
+
+
+def _section_units(text, base, page, token_starts, offsets, size, overlap):
+    """Split one section into units with absolute offsets and token counts."""
+    position = 0
+    pieces = []
+    for match in _BOUNDARY.finditer(text):
+        pieces.append((position, match.start(), '\n' in match.group(0)))
+        position = match.end()
+    pieces.append((position, len(text), False))
+
+    for start, end, paragraph_end in pieces:
+        # Trim surrounding whitespace so offsets point at real text
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start == end:
+            continue
+        first, last = bisect_left(token_starts, start), bisect_left(token_starts, end)
+        tokens = last - first
+        if tokens <= size:
+            yield _Unit(base + start, base + end, tokens, page, paragraph_end)
+            continue
+        # Oversized sentence: fixed token windows that overlap each other
+        step = max(1, size - overlap)
+        for window in range(first, last, step):
+            stop = min(window + size, last)
+            piece_start = offsets[window][0] if window > first else start
+            piece_end = offsets[stop - 1][1] if stop < last else end
+            yield _Unit(base + piece_start, base + piece_end, stop - window, page,
+                        paragraph_end and stop == last)
+            if stop == last:
+                break
+
+
+def iter_token_chunks(
+    sections: Iterable,
+    token_offsets: Callable[[str], List[Tuple[int, int]]],
+    chunk_tokens: int,
+    overlap_tokens: int = 0,
+) -> Iterator[Chunk]:
+    """
+    Yield ``Chunk`` tuples of at most ``chunk_tokens`` tokens from a stream of
+    ``(page, text)`` sections. ``token_offsets`` maps a text to the character
+    span of each of its tokens (see ``EmbeddingBackend.token_offsets``).
+    """
+    if chunk_tokens < 1:
+        raise ValueError('chunk_tokens must be at least 1')
+    overlap_tokens = max(0, min(overlap_tokens, chunk_tokens // 2))
+
+    buffer = ''         # document text from absolute offset ``buffer_base`` on
+    buffer_base = 0
+    section_base = 0    # absolute offset of the current section
+    pending: List[_Unit] = []
+    pending_tokens = 0
+    carried = 0         # leading units of ``pending`` already emitted (overlap)
+
+    def emit(units):
+        start, end = units[0].start, units[-1].end
+        return Chunk(
+            buffer[start - buffer_base:end - buffer_base],
+            units[0].page,
+            start,
+            end,
+            sum(unit.tokens for unit in units),
+        )
+
+    def cut_point():
+        # Prefer a paragraph break in the second half of the chunk
+        total = 0
+        best = len(pending)
+        for i, unit in enumerate(pending):
+            total += unit.tokens
+            if unit.paragraph_end and i + 1 > carried and i + 1 < len(pending) and total * 2 >= chunk_tokens:
+                best = i + 1
+        return best
+
+    for page, text in sections:
+        buffer += text + '\n'
+        offsets = token_offsets(text)
+        token_starts = [start for start, _ in offsets]
+        units = _section_units(text, section_base, page, token_starts, offsets, chunk_tokens, overlap_tokens)
+        section_base += len(text) + 1
+
+        for unit in units:
+            while pending and pending_tokens + unit.tokens > chunk_tokens:
+                cut = cut_point()
+                yield emit(pending[:cut])
+                rest = pending[cut:]
+                rest_tokens = sum(u.tokens for u in rest)
+                # Carry whole trailing sentences as overlap if they still fit
+                overlap: List[_Unit] = []
+                overlap_size = 0
+                for previous in reversed(pending[:cut]):
+                    if overlap_size + previous.tokens > overlap_tokens:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_size += previous.tokens
+                if overlap_size + rest_tokens + unit.tokens > chunk_tokens:
+                    overlap, overlap_size = [], 0
+                pending = overlap + rest
+                pending_tokens = overlap_size + rest_tokens
+                carried = len(overlap)
+
+            pending.append(unit)
+            pending_tokens += unit.tokens
+
+        # Drop text no pending unit refers to any more
+        keep_from = pending[0].start if pending else section_base
+        buffer = buffer[keep_from - buffer_base:]
+        buffer_base = keep_from
+
+    if len(pending) > carried:
+        yield emit(pending)
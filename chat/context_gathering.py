@@ -0,0 +1,218 @@
+"""
+Concurrent gathering of the context for one chat answer.
+
+Web tools, document retrieval and chart data do not depend on each other,
+so they run side by side on a bounded thread pool instead of one after
+another. Every source has its own deadline, counted from the moment the
+sources are submitted. A source that misses its deadline or raises is left
+out, and the answer starts with whatever finished in time. The wait is
+therefore bounded by the slowest source or its deadline, whichever comes
+first.
+
+Sources are called with a ``report(stage)`` callback and their
+``SourceDeadline``. The stages they report (e.g. ``searching_web``) come out
+of ``ContextGathering.events`` so the chat stream can show progress while it
+waits. The deadline expires when the source misses it or the gathering is
+abandoned (``ContextGathering.cancel``); sources pass it on to bound their
+own waits, e.g. for an LLM admission slot, so a dropped source gives up its
+queue place and pool thread instead of finishing work nobody reads.
+Submitted-but-unstarted sources are cancelled.
+
+Per source ``name``: the ``context.<name>`` timer, and the
+``context.timeouts.<name>`` and ``context.failures.<name>`` counters.
+"""
+import asyncio
+import logging
+import math
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Tuple
+
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# values: name -> result of every source that finished in time
+ContextResult = namedtuple('ContextResult', ['values', 'timed_out', 'failed'])
+
+
+class SourceDeadline:
+    """When a source's result stops being wanted."""
+
+    def __init__(self, at: float):
+        self.at = at
+        self._abandoned = threading.Event()
+
+    def remaining(self) -> float:
+        """Seconds left; 0 once expired."""
+        if self._abandoned.is_set():
+            return 0.0
+        return max(0.0, self.at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def abandon(self):
+        self._abandoned.set()
+
+
+# name -> (func(report, deadline), deadline in seconds)
+Sources = Dict[str, Tuple[Callable[[Callable[[str], None], SourceDeadline], object], float]]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'CONTEXT_POOL_SIZE', 16),
+                    thread_name_prefix='chat-context',
+                )
+    return _pool
+
+
+def _run(name: str, func, report, deadline: SourceDeadline):
+    if deadline.expired:
+        return None  # waited for a pool thread past its deadline; already left out
+    started = time.perf_counter()
+    try:
+        return func(report, deadline)
+    finally:
+        metrics.observe(f'context.{name}', time.perf_counter() - started)
+        # Pool threads outlive requests; don't leave their DB connections open
+        connections.close_all()
+
+
+class ContextGathering:
+    """
+    Sources submitted to the pool. Follow them with ``events`` (or
+    ``aevents`` when created with the running ``loop``), then read
+    ``result()``.
+    """
+
+    def __init__(self, sources: Sources, loop=None):
+        self.started = time.monotonic()
+        self._loop = loop
+        self._events = asyncio.Queue() if loop is not None else queue.Queue()
+        self._pending = {}
+        self._futures = {}
+        self._deadlines = {}
+        self.values, self.timed_out, self.failed = {}, [], []
+        pool = _get_pool()
+        for name, (func, deadline) in sources.items():
+            self._pending[name] = deadline
+            self._deadlines[name] = SourceDeadline(self.started + deadline)
+            future = pool.submit(_run, name, func, self._put, self._deadlines[name])
+            # Wakes the waiting stream as soon as a source ends
+            future.add_done_callback(lambda _: self._put(None))
+            self._futures[name] = future
+
+    def _put(self, event):
+        if self._loop is None:
+            self._events.put(event)
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+        except RuntimeError:
+            pass  # the request's event loop is gone; nobody is listening
+
+    def _collect(self) -> float:
+        """Settle finished and overdue sources; seconds until the next deadline."""
+        now = time.monotonic()
+        next_deadline = math.inf
+        for name, deadline in list(self._pending.items()):
+            future = self._futures[name]
+            if future.done():
+                del self._pending[name]
+                try:
+                    self.values[name] = future.result()
+                except Exception as e:
+                    logger.error(f"Context source '{name}' failed: {e}")
+                    metrics.increment(f'context.failures.{name}')
+                    self.failed.append(name)
+            elif now >= self.started + deadline:
+                del self._pending[name]
+                future.cancel()
+                self._deadlines[name].abandon()
+                logger.warning(f"Context source '{name}' missed its {deadline:g}s deadline; answering without it")
+                metrics.increment(f'context.timeouts.{name}')
+                self.timed_out.append(name)
+            else:
+                next_deadline = min(next_deadline, self.started + deadline - now)
+        return next_deadline
+
+    @property
+    def done(self) -> bool:
+        return not self._pending
+
+    def cancel(self):
+        """Abandon the sources still running, e.g. when the answer is cancelled."""
+        for name in self._pending:
+            self._futures[name].cancel()
+            self._deadlines[name].abandon()
+
+    def _reported(self):
+        """Stages already reported, without waiting."""
+        stages = []
+        while True:
+            try:
+                event = self._events.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                return stages
+            if event:
+                stages.append(event)
+
+    def events(self, tick: float = None):
+        """
+        Yield reported stages as they happen, and None after every ``tick``
+        seconds without one, until every source finished or missed its
+        deadline.
+        """
+        while True:
+            yield from self._reported()
+            wait = self._collect()
+            if self.done:
+                yield from self._reported()
+                return
+            try:
+                event = self._events.get(timeout=wait if tick is None else min(wait, tick))
+            except queue.Empty:
+                if tick is not None:
+                    yield None
+                continue
+            if event:
+                yield event
+
+    async def aevents(self, tick: float = None):
+        """Async version of ``events``."""
+        while True:
+            for stage in self._reported():
+                yield stage
+            wait = self._collect()
+            if self.done:
+                for stage in self._reported():
+                    yield stage
+                return
+            try:
+                event = await asyncio.wait_for(self._events.get(), wait if tick is None else min(wait, tick))
+            except asyncio.TimeoutError:
+                if tick is not None:
+                    yield None
+                continue
+            if event:
+                yield event
+
+    def result(self) -> ContextResult:
+        return ContextResult(self.values, self.timed_out, self.failed)
+
@@ -1,95 +1,61 @@
+import hashlib
+import itertools
 import os
-from PyPDF2 import PdfReader
-from docx import Document as DocxDocument
-from sentence_transformers import SentenceTransformer
-from .models import Document, DocumentChunk
+import re
+from django.conf import settings
+from django.db import transaction
+from .models import Document, DocumentChunk, unpack_embedding
+from . import ann_index, keyword_index, metrics, vector_index
+from .embeddings import encode_query, get_embedding_backend
+from .chunking import SPECIAL_TOKENS, iter_token_chunks
+from .extractors import Section, get_extractor, iter_sections
 import logging
 from typing import Dict, Any, List, Optional
 
-import pandas as pd
+import numpy as np
+
+# PyPDF2, python-docx and pandas are imported inside the extractors and
+# functions that need them so importing this module (from every view) stays cheap.
 
 logger = logging.getLogger(__name__)
 
-# Initialize Sentence Transformer (Standard MiniLM)
-# Robust, fast, and compatible with all versions
-MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+# Packed on-disk format for chunk embeddings ('float32' or 'float16')
+EMBEDDING_STORAGE_DTYPE = getattr(settings, 'RAG_EMBEDDING_STORAGE_DTYPE', 'float32')
+
+# Chunks encoded per forward pass / rows written per bulk insert at ingest
+EMBED_BATCH_SIZE = getattr(settings, 'RAG_EMBED_BATCH_SIZE', 64)
+
+# Run ingestion as a Celery task instead of inside the upload request
+INGEST_ASYNC = getattr(settings, 'RAG_INGEST_ASYNC', True)
+
+# 'dense' scores every chunk; 'hybrid' dense-scores BM25 candidates only
+RETRIEVAL_MODE = getattr(settings, 'RAG_RETRIEVAL_MODE', 'dense')
 
-embedding_model = SentenceTransformer(
-    MODEL_NAME,
-    device='cpu',  # Explicitly use CPU to reserve VRAM for Llama 3.3
-)
+# Chunk size and overlap in embedding-model tokens (capped at the model limit)
+CHUNK_TOKENS = getattr(settings, 'RAG_CHUNK_TOKENS', 256)
+CHUNK_OVERLAP_TOKENS = getattr(settings, 'RAG_CHUNK_OVERLAP_TOKENS', 32)
 
 
 def extract_text_from_file(file_path, file_type):
     """
-    Extract text from uploaded file with error handling.
+    Extract the whole text of an uploaded file as one string.
 
-    For tabular files (CSV/Excel), we generate a concise textual summary that
-    describes the table structure and includes a small sample of rows. This
-    summary is what gets chunked and embedded for RAG, while more detailed
-    tabular access is handled via helper functions below.
+    Ingestion streams sections from ``extractors.iter_sections`` instead;
+    this is for callers that really need the full text at once.
     """
-    text = ""
-    
-    # Image file types - store as-is with descriptive text
-    image_types = ['jpg', 'jpeg', 'png', 'gif', 'webp']
-    tabular_types = ['csv', 'xlsx', 'xls']
-    
     try:
-        if file_type == 'pdf':
-            reader = PdfReader(file_path)
-            for page in reader.pages:
-                extracted = page.extract_text()
-                if extracted:
-                    text += extracted + "\n"
-        elif file_type == 'docx':
-            doc = DocxDocument(file_path)
-            for paragraph in doc.paragraphs:
-                if paragraph.text.strip():
-                    text += paragraph.text + "\n"
-        elif file_type == 'txt':
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                text = f.read()
-        elif file_type in image_types:
-            # For images, create a descriptive placeholder
-            # In the future, this could be enhanced with OCR or vision models
-            import os
-            filename = os.path.basename(file_path)
-            text = (
-                f"[Image: {filename}] - This is an uploaded image file. "
-                f"The image content can be viewed in the chat interface."
-            )
-        elif file_type in tabular_types:
-            # For CSV/Excel, create a structured summary for RAG
-            df = _load_tabular_file(file_path, file_type)
-            if df is not None and not df.empty:
-                # Basic metadata
-                text_lines = []
-                text_lines.append(
-                    f"[Tabular Data Summary] Rows: {len(df)}, Columns: {len(df.columns)}"
-                )
-                text_lines.append(f"Columns: {', '.join(map(str, df.columns))}")
-                
-                # Include a small sample of rows as CSV-like text
-                preview_rows = min(10, len(df))
-                preview_df = df.head(preview_rows)
-                text_lines.append(
-                    "Sample rows (first "
-                    f"{preview_rows}):\n" + preview_df.to_csv(index=False)
-                )
-                text = "\n".join(text_lines)
-            else:
-                text = "[Tabular Data] Empty or unreadable table."
+        return ''.join(section.text + "\n" for section in iter_sections(file_path, file_type))
     except Exception as e:
         logger.error(f"Text extraction failed for {file_path}: {e}")
-        text = ""
-    return text
+        return ""
 
 
 def _load_tabular_file(file_path: str, file_type: str, max_rows: int = 500) -> "pd.DataFrame | None":
     """
     Load a CSV or Excel file into a pandas DataFrame with basic safeguards.
     """
+    import pandas as pd
+
     try:
         if file_type == 'csv':
             df = pd.read_csv(file_path, nrows=max_rows)
@@ -122,6 +88,8 @@ def get_tabular_preview(document: Document, max_rows: int = 50) -> Dict[str, Any
             "dtypes": {},
         }
     
+    import pandas as pd
+
     # Convert to serializable structures
     preview_rows = min(max_rows, len(df))
     preview_df = df.head(preview_rows)
@@ -203,84 +171,353 @@ def build_default_chart_from_preview(preview: Dict[str, Any]) -> Optional[Dict[s
     }
 
 
+def iter_text_chunks(text, chunk_size=500, overlap=50):
+    """
+    Yield overlapping word windows of ``text`` one at a time.
+
+    Produces exactly the chunks of ``chunk_text`` without materializing the
+    full word list, so only one window of words is held in memory.
+    """
+    for content, _ in iter_section_chunks([Section(None, text)], chunk_size, overlap):
+        yield content
+
+
+def iter_section_chunks(sections, chunk_size=500, overlap=50):
+    """
+    Yield ``(content, page)`` word windows across a stream of sections.
+
+    Windows run across section boundaries exactly as if the sections were
+    joined into one text; ``page`` is the page the window starts on.
+    """
+    step = chunk_size - overlap
+    window = []
+    pages = []
+    for section in sections:
+        for match in re.finditer(r'\S+', section.text):
+            window.append(match.group(0))
+            pages.append(section.page)
+            if len(window) == chunk_size:
+                yield ' '.join(window), pages[0]
+                del window[:step]
+                del pages[:step]
+    # Trailing windows that start before the end of the text
+    while window:
+        yield ' '.join(window[:chunk_size]), pages[0]
+        del window[:step]
+        del pages[:step]
+
+
+def chunk_token_budget(backend=None):
+    """Largest chunk, in tokens, the embedding model reads without truncating"""
+    backend = backend or get_embedding_backend()
+    return max(1, min(CHUNK_TOKENS, backend.max_seq_length - SPECIAL_TOKENS))
+
+
+def iter_document_chunks(sections, backend=None):
+    """Token-aware ``Chunk`` tuples for a stream of extracted sections"""
+    backend = backend or get_embedding_backend()
+    return iter_token_chunks(
+        sections,
+        backend.token_offsets,
+        chunk_token_budget(backend),
+        CHUNK_OVERLAP_TOKENS,
+    )
+
+
 def chunk_text(text, chunk_size=500, overlap=50):
     """Split text into overlapping chunks, skipping empty ones"""
-    words = text.split()
-    chunks = []
-    step = chunk_size - overlap
-    for i in range(0, len(words), step):
-        chunk = ' '.join(words[i:i + chunk_size])
-        if chunk.strip():  # Skip empty chunks
-            chunks.append(chunk)
-    return chunks
+    return list(iter_text_chunks(text, chunk_size=chunk_size, overlap=overlap))
+
+
+def _batched(iterable, size):
+    """Yield lists of up to ``size`` items from ``iterable``"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def hash_uploaded_file(file):
+    """SHA-256 of an uploaded file, read in chunks; the file is rewound"""
+    digest = hashlib.sha256()
+    for block in file.chunks():
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def chunk_hash(text, model_version):
+    """
+    Key under which a chunk's embedding can be reused. The model version is
+    part of the key so vectors are never shared between embedding models.
+    """
+    return hashlib.sha256(f"{model_version}\n{text}".encode('utf-8')).hexdigest()
+
+
+def store_uploaded_document(user, file, file_name, file_type):
+    """
+    Create the Document for an upload and schedule its ingestion.
+
+    Re-uploading a file the user already has (by SHA-256) returns the
+    existing document instead, so nothing is stored or embedded again.
+    A failed earlier upload of the same bytes lends its stored file. Files
+    are never shared between users, since the stored name (original file
+    name and upload date) is exposed through ``file_url``; only chunk
+    embeddings are reused across users (see ``process_document``).
+
+    Returns ``(document, reused)``.
+    """
+    content_hash = hash_uploaded_file(file)
+    existing = (
+        Document.objects.filter(user=user, content_hash=content_hash, file_type=file_type)
+        .exclude(status=Document.STATUS_FAILED)
+        .first()
+    )
+    if existing is not None:
+        metrics.increment('ingest.duplicate_uploads')
+        return existing, True
+
+    document = Document(user=user, title=file_name, file_type=file_type, content_hash=content_hash)
+    shared = Document.objects.filter(user=user, content_hash=content_hash).exclude(file='').first()
+    if shared is not None and shared.file.storage.exists(shared.file.name):
+        # Point at the stored copy; deletes are reference counted (see signals)
+        document.file.name = shared.file.name
+        metrics.increment('ingest.shared_files')
+    else:
+        document.file = file
+    document.save()
+
+    schedule_document_processing(document.id)
+    return document, False
+
+
+def _reusable_embeddings(hashes):
+    """Stored embeddings for any of the given chunk hashes, by hash"""
+    rows = DocumentChunk.objects.filter(
+        content_hash__in=set(hashes), embedding_blob__isnull=False
+    ).values_list('content_hash', 'embedding_blob', 'embedding_dtype')
+    return {content_hash: (blob, dtype) for content_hash, blob, dtype in rows}
+
+
+def _stored_vectors(document_id):
+    """``(chunk_ids, vectors)`` of a document's committed chunks, ``EMBED_BATCH_SIZE`` at a time"""
+    rows = DocumentChunk.objects.filter(document_id=document_id).order_by('id').values_list(
+        'id', 'embedding_blob', 'embedding_dtype'
+    )
+    for batch in _batched(rows.iterator(chunk_size=2000), EMBED_BATCH_SIZE):
+        yield [row[0] for row in batch], [unpack_embedding(blob, dtype) for _, blob, dtype in batch]
+
+
+def _update_document(document_id, **fields):
+    """Persist ingestion state without re-saving (or signalling) the whole row"""
+    Document.objects.filter(id=document_id).update(**fields)
+
+
+def _embedding_progress(page, page_count):
+    # Opening the file accounts for the first 10%, pages read for the rest
+    if not page_count or not page:
+        return 10
+    return min(99, 10 + (90 * page) // page_count)
 
 
 def process_document(document_id):
-    """Process uploaded document: extract, chunk, embed"""
+    """
+    Process uploaded document: extract, chunk, embed.
+
+    Extraction, chunking and embedding form one streaming pipeline: the
+    extractor yields pages or sections, the token-aware chunker (see
+    ``chunking``) cuts them to fit the model's input limit, and chunks are
+    encoded ``EMBED_BATCH_SIZE`` at a time, so memory does not grow with the
+    size of the document. Once the document is ready, the resident and ANN
+    indexes are fed from the committed rows, in batches of the same size.
+
+    The document moves through queued -> extracting -> embedding -> ready
+    (or failed), with progress (by page, where the format has pages) and
+    chunk counts kept up to date. Each window is committed with one
+    ``bulk_create`` together with the document's ``chunk_count``, so a run
+    interrupted by a worker crash resumes after the last committed window
+    instead of starting over.
+    """
     try:
         doc = Document.objects.get(id=document_id)
-        text = extract_text_from_file(doc.file.path, doc.file_type)
-        chunks = chunk_text(text)
-
-        for i, chunk in enumerate(chunks):
-            # MiniLM: Normalize for cosine similarity
-            embedding = embedding_model.encode(
-                chunk,
-                normalize_embeddings=True
-            ).tolist()
-
-            DocumentChunk.objects.create(
-                document=doc,
-                content=chunk,
-                chunk_index=i,
-                embedding=embedding
-            )
-
-        doc.processed = True
-        doc.save()
+        if doc.status == Document.STATUS_READY:
+            return True
+
+        _update_document(doc.id, status=Document.STATUS_EXTRACTING, progress=0, error='')
+        extractor = get_extractor(doc.file_type)
+        page_count = extractor.page_count(doc.file.path) if extractor else None
+
+        # Chunking is deterministic, so rows committed by an earlier,
+        # interrupted run line up with the first chunks of this one.
+        resume_from = DocumentChunk.objects.filter(document_id=doc.id).count()
+        if resume_from:
+            logger.info(f"Resuming document {doc.id} after {resume_from} chunks")
+        _update_document(
+            doc.id,
+            status=Document.STATUS_EMBEDDING,
+            total_chunks=None,
+            chunk_count=resume_from,
+            progress=_embedding_progress(None, page_count),
+        )
+
+        chunk_index = resume_from
+        sections = iter_sections(doc.file.path, doc.file_type)
+        chunks = itertools.islice(iter_document_chunks(sections), resume_from, None)
+        backend = get_embedding_backend()
+        for window in _batched(chunks, EMBED_BATCH_SIZE):
+            # Identical chunks (same text, same model) reuse stored vectors
+            hashes = [chunk_hash(chunk.text, backend.version) for chunk in window]
+            known = _reusable_embeddings(hashes)
+            missing = [i for i, h in enumerate(hashes) if h not in known]
+            embeddings = [None] * len(window)
+            for i, h in enumerate(hashes):
+                if h in known:
+                    embeddings[i] = unpack_embedding(*known[h])
+            if missing:
+                # MiniLM: Normalize for cosine similarity
+                encoded = backend.encode(
+                    [window[i].text for i in missing],
+                    batch_size=EMBED_BATCH_SIZE,
+                    normalize_embeddings=True,
+                    convert_to_numpy=True,
+                ).astype(np.float32, copy=False)
+                for i, vector in zip(missing, encoded):
+                    embeddings[i] = vector
+
+            rows = []
+            for chunk, content_hash, embedding in zip(window, hashes, embeddings):
+                row = DocumentChunk(
+                    document=doc,
+                    content=chunk.text,
+                    chunk_index=chunk_index,
+                    page_number=chunk.page,
+                    char_start=chunk.char_start,
+                    char_end=chunk.char_end,
+                    token_count=chunk.token_count,
+                    content_hash=content_hash,
+                )
+                if content_hash in known:
+                    # Copy the stored bytes as they are (no re-quantization)
+                    row.embedding_blob, row.embedding_dtype = known[content_hash]
+                else:
+                    row.set_vector(embedding, EMBEDDING_STORAGE_DTYPE)
+                rows.append(row)
+                chunk_index += 1
+
+            with transaction.atomic():
+                DocumentChunk.objects.bulk_create(rows)
+                _update_document(
+                    doc.id,
+                    chunk_count=chunk_index,
+                    progress=_embedding_progress(window[-1].page, page_count),
+                )
+            metrics.increment('ingest.chunks', len(window))
+            metrics.increment('ingest.chunks_reused', len(window) - len(missing))
+            metrics.increment('ingest.tokens_embedded', sum(window[i].token_count for i in missing))
+
+        _update_document(
+            doc.id,
+            status=Document.STATUS_READY,
+            progress=100,
+            chunk_count=chunk_index,
+            total_chunks=chunk_index,
+        )
+
+        if chunk_index:
+            # Vectors are read back from the committed rows in batches rather
+            # than kept from the loop, which also covers chunks committed by
+            # an interrupted run.
+            vector_index.add_document(doc.user_id, doc.id, _stored_vectors(doc.id))
+            ann_index.update_user(doc.user_id, _stored_vectors(doc.id), backend.dimension)
         return True
 
     except Exception as e:
         logger.error(f"Error processing document {document_id}: {e}")
+        _update_document(document_id, status=Document.STATUS_FAILED, error=str(e)[:1000])
         return False
 
 
-def search_documents(user_id, query, top_k=3):
-    """Search using Jina v2 embeddings (normalized)"""
+def schedule_document_processing(document_id):
+    """
+    Queue background ingestion once the upload transaction commits.
+
+    Falls back to processing inline when ``RAG_INGEST_ASYNC`` is off or the
+    Celery broker cannot be reached.
+    """
+    def enqueue():
+        if INGEST_ASYNC:
+            from .tasks import ingest_document
+            try:
+                ingest_document.delay(document_id)
+                return
+            except Exception as e:
+                logger.error(
+                    f"Could not queue ingestion for document {document_id}, processing inline: {e}"
+                )
+        process_document(document_id)
+
+    transaction.on_commit(enqueue)
+
+
+def search_documents(user_id, query, top_k=3, document_ids=None, per_document_k=None):
+    """
+    Search the user's processed chunks by cosine similarity.
+
+    Scoring runs against the resident per-user index (see ``vector_index``),
+    probing the user's IVF shard for large libraries (see ``ann_index``) or,
+    in hybrid mode, only the BM25 candidates (see ``keyword_index``);
+    only the top ``top_k`` chunks are fetched from the database. Pass
+    ``document_ids`` to score only those documents (e.g. a conversation's
+    attachments) and ``per_document_k`` to cap hits from any one document.
+    """
     try:
-        # Jina v2: normalize query embedding too
-        query_embedding = embedding_model.encode(
-            query,
-            normalize_embeddings=True
-        ).tolist()
-
-        chunks = DocumentChunk.objects.filter(
-            document__user_id=user_id,
-            document__processed=True
-        ).select_related('document')
-
-        if not chunks.exists():
+        # Normalized query embedding: dot product == cosine similarity
+        query_embedding = encode_query(query)
+
+        with metrics.timer('retrieval.vector_search'):
+            index = vector_index.get_user_index(user_id, query_embedding.shape[0])
+            if RETRIEVAL_MODE == 'hybrid':
+                hits = keyword_index.hybrid_search(
+                    index,
+                    query,
+                    query_embedding,
+                    top_k,
+                    document_ids=document_ids,
+                    per_document_k=per_document_k,
+                )
+            else:
+                hits = ann_index.search(
+                    index,
+                    query_embedding,
+                    top_k,
+                    document_ids=document_ids,
+                    per_document_k=per_document_k,
+                )
+        if not hits:
             return []
 
-        from numpy import dot  # Cosine similarity = dot product (since normalized)
+        chunks = DocumentChunk.objects.select_related('document').in_bulk(
+            [chunk_id for chunk_id, _, _ in hits]
+        )
 
         results = []
-        for chunk in chunks:
-            if chunk.embedding:
-                # Safety check: Skip chunks with wrong dimension (from previous model)
-                if len(chunk.embedding) != len(query_embedding):
-                    continue
-                    
-                similarity = dot(query_embedding, chunk.embedding)  # Already normalized
-                results.append({
-                    'document_id': chunk.document.id,
-                    'document_title': chunk.document.title,
-                    'content': chunk.content,
-                    'score': float(similarity)
-                })
-
-        results.sort(key=lambda x: x['score'], reverse=True)
-        return results[:top_k]
+        for chunk_id, _, score in hits:
+            chunk = chunks.get(chunk_id)
+            if chunk is None:
+                # Deleted since the index snapshot was taken
+                continue
+            results.append({
+                'document_id': chunk.document.id,
+                'document_title': chunk.document.title,
+                'content': chunk.content,
+                'page_number': chunk.page_number,
+                'score': score
+            })
+        return results
 
     except Exception as e:
         logger.error(f"Error searching documents: {e}")
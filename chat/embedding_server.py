@@ -0,0 +1,336 @@
+"""
+Shared embedding server and its client backend.
+
+``manage.py embedding_server`` loads one embedding backend and serves it over
+HTTP on a Unix socket or a localhost port, so web and Celery workers configured
+with ``RAG_EMBEDDING_BACKEND=remote`` do not each hold a copy of the model.
+
+Concurrent requests are merged into micro-batches: the batcher thread takes
+the oldest request, then keeps collecting for up to ``max_wait`` seconds or
+until ``max_batch_size`` texts are pending, and encodes them in one forward
+pass. Requests are never split, so a single request larger than the batch
+size is encoded on its own. Tokenize requests share the backend's tokenizer
+with the batcher, so they take turns with the forward passes.
+
+Protocol (HTTP/1.1, keep-alive):
+
+- ``POST /encode`` with JSON ``{"texts": [...], "normalize": true}`` returns
+  the float32 vectors as raw little-endian bytes, shape in ``X-Embedding-Shape``
+- ``POST /tokenize`` with JSON ``{"text": ...}`` returns token character offsets
+- ``GET /health`` returns the backend version, dimension and input limit
+- ``GET /metrics`` returns batching counters and queue depth
+"""
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+from .embeddings import EmbeddingBackend
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Merges concurrent encode requests into batched forward passes."""
+
+    def __init__(self, backend: EmbeddingBackend, max_batch_size: int = 64, max_wait: float = 0.005):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: "queue.Queue" = queue.Queue()
+        self._pending_texts = 0
+        self._pending_lock = threading.Lock()
+        self._carry = None
+        # Fast tokenizers are not safe to share between threads ("Already borrowed")
+        self._backend_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+        metrics.register_gauge('embedding_server.queue_requests', self._queue.qsize)
+        metrics.register_gauge('embedding_server.queue_texts', lambda: self._pending_texts)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, texts, normalize: bool = True) -> Future:
+        future = Future()
+        with self._pending_lock:
+            self._pending_texts += len(texts)
+        self._queue.put((texts, normalize, future, time.perf_counter()))
+        return future
+
+    def tokenize(self, text: str):
+        """Token character offsets of ``text``, between forward passes."""
+        with self._backend_lock:
+            return self.backend.token_offsets(text)
+
+    def _next(self, timeout=None):
+        """The request carried over from the previous batch, else the queue head."""
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self):
+        """Block for the first request, then gather more until full or timed out."""
+        batch = [self._next()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._next(remaining)
+            except queue.Empty:
+                break
+            if size + len(item[0]) > self.max_batch_size:
+                # Keep it for the next batch rather than overshooting this one
+                self._carry = item
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            self._encode(self._collect())
+
+    def _encode(self, batch):
+        texts = [text for item in batch for text in item[0]]
+        with self._pending_lock:
+            self._pending_texts -= len(texts)
+        now = time.perf_counter()
+        for _, _, _, queued_at in batch:
+            metrics.observe('embedding_server.queue_wait', now - queued_at)
+
+        try:
+            with self._backend_lock, metrics.timer('embedding_server.encode'):
+                vectors = self.backend.encode(
+                    texts, batch_size=max(len(texts), 1), normalize_embeddings=False
+                )
+        except Exception as e:
+            logger.error(f"Embedding batch of {len(texts)} texts failed: {e}")
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        metrics.increment('embedding_server.batches')
+        metrics.increment('embedding_server.requests', len(batch))
+        metrics.increment('embedding_server.texts', len(texts))
+        start = 0
+        for item_texts, normalize, future, _ in batch:
+            part = vectors[start:start + len(item_texts)]
+            start += len(item_texts)
+            if normalize:
+                part = part / np.maximum(np.linalg.norm(part, axis=1, keepdims=True), 1e-12)
+            future.set_result(np.ascontiguousarray(part, dtype='<f4'))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'BSCEmbeddingServer/1.0'
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, body: bytes, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload):
+        self._send(status, json.dumps(payload).encode('utf-8'))
+
+    def do_GET(self):
+        backend = self.server.batcher.backend
+        if self.path == '/health':
+            self._send_json(200, {
+                'version': backend.version,
+                'dimension': backend.dimension,
+                'max_seq_length': backend.max_seq_length,
+            })
+        elif self.path == '/metrics':
+            self._send_json(200, metrics.snapshot())
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path == '/tokenize':
+            self._tokenize()
+            return
+        if self.path != '/encode':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            texts = payload['texts']
+            if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                raise ValueError('"texts" must be a list of strings')
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {'error': f'Invalid request: {e}'})
+            return
+
+        try:
+            vectors = self.server.batcher.submit(texts, bool(payload.get('normalize', True))).result()
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send(200, vectors.tobytes(), 'application/octet-stream', {
+            'X-Embedding-Shape': f'{vectors.shape[0]},{vectors.shape[1] if vectors.ndim == 2 else 0}',
+            'X-Embedding-Version': self.server.batcher.backend.version,
+        })
+
+    def _tokenize(self):
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            text = payload['text']
+            if not isinstance(text, str):
+                raise ValueError('"text" must be a string')
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {'error': f'Invalid request: {e}'})
+            return
+        offsets = self.server.batcher.tokenize(text)
+        self._send_json(200, {'offsets': [list(span) for span in offsets]})
+
+
+# Every web and Celery worker thread keeps a connection; the default listen
+# backlog of 5 makes bursts of Unix socket connects fail with EAGAIN
+LISTEN_BACKLOG = 128
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+
+class _TCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+
+def make_server(address: str, batcher: MicroBatcher):
+    """Bind a threaded HTTP server to ``unix:///path`` or ``http://host:port``."""
+    url = urlparse(address)
+    if url.scheme == 'unix':
+        if os.path.exists(url.path):
+            os.unlink(url.path)  # stale socket from a previous run
+        server = _UnixHTTPServer(url.path, _Handler)
+        os.chmod(url.path, 0o660)
+    elif url.scheme == 'http':
+        server = _TCPHTTPServer((url.hostname or '127.0.0.1', url.port or 8765), _Handler)
+    else:
+        raise ValueError(f"Unsupported embedding server address: {address}")
+    server.batcher = batcher
+    return server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class RemoteBackend(EmbeddingBackend):
+    """Client for ``manage.py embedding_server``; one keep-alive connection per thread."""
+    name = 'remote'
+
+    def __init__(self, address: str, timeout: float = 30.0):
+        self.address = address
+        self.timeout = timeout
+        self._url = urlparse(address)
+        self._local = threading.local()
+        self._info = None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._url.scheme == 'unix':
+                conn = _UnixHTTPConnection(self._url.path, self.timeout)
+            else:
+                conn = http.client.HTTPConnection(
+                    self._url.hostname or '127.0.0.1', self._url.port or 8765, timeout=self.timeout
+                )
+            self._local.conn = conn
+        return conn
+
+    def _request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in (1, 2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                return response, response.read()
+            except (ConnectionError, http.client.HTTPException, OSError):
+                # The server may have closed an idle keep-alive connection
+                conn.close()
+                self._local.conn = None
+                if attempt == 2:
+                    raise
+
+    def _health(self):
+        if self._info is None:
+            response, data = self._request('GET', '/health')
+            if response.status != 200:
+                raise RuntimeError(f"Embedding server unhealthy ({response.status})")
+            self._info = json.loads(data)
+        return self._info
+
+    def _encode(self, texts, batch_size):
+        response, data = self._request(
+            'POST', '/encode', json.dumps({'texts': texts, 'normalize': False}).encode('utf-8')
+        )
+        if response.status != 200:
+            raise RuntimeError(f"Embedding server error ({response.status}): {data[:200]!r}")
+        rows, dim = (int(n) for n in response.getheader('X-Embedding-Shape').split(','))
+        return np.frombuffer(data, dtype='<f4').reshape(rows, dim)
+
+    @property
+    def dimension(self):
+        return self._health()['dimension']
+
+    @property
+    def version(self):
+        # The served model's version, so cached query vectors stay comparable
+        return self._health()['version']
+
+    @property
+    def max_seq_length(self):
+        return self._health()['max_seq_length']
+
+    def token_offsets(self, text):
+        response, data = self._request('POST', '/tokenize', json.dumps({'text': text}).encode('utf-8'))
+        if response.status != 200:
+            raise RuntimeError(f"Embedding server error ({response.status}): {data[:200]!r}")
+        return [tuple(span) for span in json.loads(data)['offsets']]
+
+
+def create_remote_backend() -> RemoteBackend:
+    return RemoteBackend(
+        getattr(settings, 'RAG_EMBEDDING_SERVER', 'http://127.0.0.1:8765'),
+        timeout=getattr(settings, 'RAG_EMBEDDING_SERVER_TIMEOUT', 30.0),
+    )
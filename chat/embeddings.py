@@ -0,0 +1,346 @@
+"""
+Lazy, thread-safe access to the sentence embedding backend.
+
+Loading a model pulls in torch or onnxruntime and the weights, which takes
+seconds and hundreds of MB. Nothing here runs at import time, so processes
+that never embed (``migrate``, ``shell``, Celery beat) do not pay for it.
+Servers that want the cost up front can set ``RAG_PRELOAD_EMBEDDING_MODEL``
+or run ``manage.py warmup``.
+
+The backend is chosen with ``RAG_EMBEDDING_BACKEND``:
+
+- ``sentence-transformers``: PyTorch SentenceTransformer (default)
+- ``onnx``: ONNX Runtime over the exported model in ``RAG_ONNX_MODEL_DIR``
+- ``onnx-int8``: the same model dynamically quantized to int8 weights
+- ``remote``: the shared ``manage.py embedding_server`` process
+
+Vectors from different models are not comparable; documents embedded with
+one model must be re-ingested after switching to another.
+"""
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Standard MiniLM: robust, fast, and compatible with all versions
+MODEL_NAME = getattr(settings, 'RAG_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+
+
+class EmbeddingBackend:
+    """
+    Common interface for embedding backends.
+
+    ``encode`` mirrors ``SentenceTransformer.encode``: a single string gives a
+    1-D vector, a list gives a 2-D float32 array.
+    """
+    name = 'base'
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        vectors = self._encode(texts, batch_size).astype(np.float32, copy=False)
+        if normalize_embeddings:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        return vectors[0] if single else vectors
+
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        raise NotImplementedError
+
+    @property
+    def dimension(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def version(self) -> str:
+        """Identifies the vector space; changes whenever vectors would."""
+        raise NotImplementedError
+
+    @property
+    def max_seq_length(self) -> int:
+        """Model input limit in tokens, special tokens included."""
+        raise NotImplementedError
+
+    def token_offsets(self, text: str) -> List[Tuple[int, int]]:
+        """Character span of every token of ``text``, without special tokens."""
+        raise NotImplementedError
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """PyTorch SentenceTransformer on CPU."""
+    name = 'sentence-transformers'
+
+    def __init__(self, model_name_or_path: str = MODEL_NAME, **model_kwargs):
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = str(model_name_or_path)
+        self.model = SentenceTransformer(
+            self.model_name,
+            device='cpu',  # Explicitly use CPU to reserve VRAM for Llama 3.3
+            **model_kwargs,
+        )
+
+    def _encode(self, texts, batch_size):
+        return self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+
+    @property
+    def dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    @property
+    def version(self):
+        return f'{self.name}:{self.model_name}'
+
+    @property
+    def max_seq_length(self):
+        return self.model.max_seq_length
+
+    def token_offsets(self, text):
+        encoded = self.model.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True, truncation=False, verbose=False
+        )
+        return encoded['offset_mapping']
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    ONNX Runtime inference over an exported transformer with mean pooling.
+
+    Works with both the plain export (``last_hidden_state`` output, pooled
+    here) and exports that already include the pooling layer.
+    """
+    name = 'onnx'
+
+    def __init__(
+        self,
+        model_dir,
+        model_file: str = 'model.onnx',
+        quantize: bool = False,
+        max_length: int = 512,
+        threads: int = 0,
+    ):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_dir = str(model_dir)
+        model_path = os.path.join(self.model_dir, model_file)
+        if quantize:
+            model_path = _quantized_model(model_path)
+            self.name = 'onnx-int8'
+        self.model_path = model_path
+
+        tokenizer_path = os.path.join(self.model_dir, 'tokenizer.json')
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id('[PAD]') or 0)
+        # Untruncated copy for measuring and splitting text
+        self._counting_tokenizer = Tokenizer.from_file(tokenizer_path)
+        self._counting_tokenizer.no_truncation()
+        self._counting_tokenizer.no_padding()
+        self.max_length = max_length
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self._dimension = None
+
+    def _run(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if 'token_type_ids' in self.input_names:
+            feeds['token_type_ids'] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        output = self.session.run(None, feeds)[0]
+        if output.ndim == 2:
+            return output
+        # Mean pooling over real (non-padding) tokens
+        mask = attention_mask[:, :, None].astype(np.float32)
+        return (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def _encode(self, texts, batch_size):
+        # Batch texts of similar length together to minimise padding
+        order = np.argsort([-len(t) for t in texts], kind='stable')
+        out = None
+        for start in range(0, len(texts), batch_size):
+            idx = order[start:start + batch_size]
+            vectors = self._run([texts[i] for i in idx])
+            if out is None:
+                out = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            out[idx] = vectors
+        return out
+
+    @property
+    def dimension(self):
+        if self._dimension is None:
+            self._dimension = int(self._run(['dimension probe']).shape[1])
+        return self._dimension
+
+    @property
+    def version(self):
+        return f'{self.name}:{os.path.basename(self.model_dir.rstrip(os.sep))}'
+
+    @property
+    def max_seq_length(self):
+        return self.max_length
+
+    def token_offsets(self, text):
+        return self._counting_tokenizer.encode(text, add_special_tokens=False).offsets
+
+
+def _quantized_model(model_path: str) -> str:
+    """Dynamically quantize weights to int8 once and cache the result."""
+    target = getattr(settings, 'RAG_ONNX_QUANTIZED_PATH', None) or (
+        os.path.splitext(model_path)[0] + '-int8.onnx'
+    )
+    if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(model_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        started = time.perf_counter()
+        quantize_dynamic(model_path, target, weight_type=QuantType.QInt8)
+        logger.info(f"Quantized {model_path} -> {target} in {time.perf_counter() - started:.1f}s")
+    return target
+
+
+def create_backend(name: Optional[str] = None) -> EmbeddingBackend:
+    """Instantiate a backend by name (defaults to ``RAG_EMBEDDING_BACKEND``)."""
+    name = name or getattr(settings, 'RAG_EMBEDDING_BACKEND', 'sentence-transformers')
+    if name == 'sentence-transformers':
+        return SentenceTransformerBackend(MODEL_NAME)
+    if name in ('onnx', 'onnx-int8'):
+        return OnnxBackend(
+            getattr(settings, 'RAG_ONNX_MODEL_DIR', os.path.join(settings.BASE_DIR, 'jina_emb')),
+            model_file=getattr(settings, 'RAG_ONNX_MODEL_FILE', 'model.onnx'),
+            quantize=(name == 'onnx-int8'),
+            max_length=getattr(settings, 'RAG_ONNX_MAX_LENGTH', 512),
+            threads=getattr(settings, 'RAG_ONNX_THREADS', 0),
+        )
+    if name == 'remote':
+        from .embedding_server import create_remote_backend
+
+        return create_remote_backend()
+    raise ValueError(f"Unknown embedding backend: {name}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_embedding_backend() -> EmbeddingBackend:
+    """Return the shared embedding backend, loading it on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                started = time.perf_counter()
+                _backend = create_backend()
+                logger.info(
+                    f"Loaded embedding backend {_backend.version} in {time.perf_counter() - started:.2f}s"
+                )
+    return _backend
+
+
+def is_loaded() -> bool:
+    return _backend is not None
+
+
+class QueryEmbeddingCache:
+    """
+    LRU map of ``(backend version, normalized text)`` to query vectors,
+    bounded by the approximate bytes held rather than by entry count.
+    """
+    # Key tuple, OrderedDict node and ndarray header, roughly
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    @classmethod
+    def _cost(cls, key, vector) -> int:
+        return cls.ENTRY_OVERHEAD + len(key[1].encode('utf-8')) + vector.nbytes
+
+    def get(self, key) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+            return vector
+
+    def put(self, key, vector: np.ndarray) -> None:
+        cost = self._cost(key, vector)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= self._cost(key, previous)
+            self._entries[key] = vector
+            self._bytes += cost
+            while self._bytes > self.max_bytes:
+                old_key, old_vector = self._entries.popitem(last=False)
+                self._bytes -= self._cost(old_key, old_vector)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_query_cache = QueryEmbeddingCache(getattr(settings, 'RAG_QUERY_CACHE_BYTES', 16 * 1024 * 1024))
+metrics.register_gauge('embedding_cache.bytes', lambda: _query_cache.nbytes)
+metrics.register_gauge('embedding_cache.entries', lambda: len(_query_cache))
+
+
+def normalize_query(text: str) -> str:
+    """Canonical form used both as the cache key and as the encoded text."""
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+def encode_query(text: str) -> np.ndarray:
+    """
+    Normalized, read-only embedding of a search query, served from the
+    query cache when the same text was encoded by the same backend before.
+    """
+    backend = get_embedding_backend()
+    key = (backend.version, normalize_query(text))
+    vector = _query_cache.get(key)
+    if vector is not None:
+        metrics.increment('embedding_cache.hits')
+        return vector
+
+    metrics.increment('embedding_cache.misses')
+    with metrics.timer('embedding.encode_query'):
+        vector = np.asarray(backend.encode(key[1], normalize_embeddings=True), dtype=np.float32)
+    # Shared between requests, so nobody may modify it in place
+    vector.setflags(write=False)
+    _query_cache.put(key, vector)
+    return vector
@@ -0,0 +1,190 @@
+"""
+Streaming text extraction for uploaded documents.
+
+Each supported format has an ``Extractor`` that yields ``Section`` tuples
+(page number, text) one at a time, so ingestion can chunk and embed a
+document while it is still being read instead of building one large string.
+Register support for another format with ``@register``.
+
+Large PDFs are split into page ranges that are extracted in a process pool,
+with only a bounded number of ranges in flight so memory stays flat however
+long the document is. The pool is billiard's (Celery's fork of
+multiprocessing), which unlike multiprocessing may start children from the
+daemonic prefork workers that run ingestion.
+"""
+import logging
+import os
+from collections import deque, namedtuple
+from typing import Dict, Iterator, Optional
+
+from billiard import Pool
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# ``page`` is 1-based, or None for formats without pages
+Section = namedtuple('Section', 'page text')
+
+EXTRACTORS: Dict[str, "Extractor"] = {}
+
+
+def register(cls):
+    """Class decorator registering an extractor for its ``file_types``."""
+    extractor = cls()
+    for file_type in cls.file_types:
+        EXTRACTORS[file_type] = extractor
+    return cls
+
+
+def get_extractor(file_type: str) -> Optional["Extractor"]:
+    return EXTRACTORS.get(file_type)
+
+
+class Extractor:
+    file_types = ()
+
+    def page_count(self, file_path) -> Optional[int]:
+        """Number of pages, when the format has them (used for progress)."""
+        return None
+
+    def sections(self, file_path) -> Iterator[Section]:
+        raise NotImplementedError
+
+
+def _extract_pdf_range(file_path, start, end):
+    """Process pool worker: text of pages ``start`` to ``end`` (0-based, exclusive)."""
+    from PyPDF2 import PdfReader
+
+    reader = PdfReader(file_path)
+    return [(number + 1, reader.pages[number].extract_text() or '') for number in range(start, end)]
+
+
+@register
+class PdfExtractor(Extractor):
+    file_types = ('pdf',)
+
+    def page_count(self, file_path):
+        from PyPDF2 import PdfReader
+
+        return len(PdfReader(file_path).pages)
+
+    def sections(self, file_path):
+        from PyPDF2 import PdfReader
+
+        reader = PdfReader(file_path)
+        pages = len(reader.pages)
+        workers = getattr(settings, 'RAG_EXTRACT_WORKERS', 0) or os.cpu_count() or 1
+        if pages < getattr(settings, 'RAG_PDF_PARALLEL_MIN_PAGES', 64) or workers < 2:
+            for number, page in enumerate(reader.pages):
+                text = page.extract_text()
+                if text:
+                    yield Section(number + 1, text)
+            return
+
+        del reader
+        yield from self._parallel_sections(file_path, pages, workers)
+
+    def _parallel_sections(self, file_path, pages, workers):
+        span = getattr(settings, 'RAG_PDF_PAGES_PER_TASK', 16)
+        ranges = iter([(start, min(start + span, pages)) for start in range(0, pages, span)])
+        pool = Pool(processes=workers)
+        try:
+            # Keep a couple of ranges per worker in flight; results are
+            # yielded in page order as the consumer catches up.
+            in_flight = deque()
+            for start, end in ranges:
+                in_flight.append(pool.apply_async(_extract_pdf_range, (file_path, start, end)))
+                if len(in_flight) >= workers * 2:
+                    break
+            while in_flight:
+                for page, text in in_flight.popleft().get():
+                    if text:
+                        yield Section(page, text)
+                next_range = next(ranges, None)
+                if next_range is not None:
+                    in_flight.append(pool.apply_async(_extract_pdf_range, (file_path, *next_range)))
+            pool.close()
+        except BaseException:
+            # Failed, or the consumer stopped reading: drop the remaining ranges
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+@register
+class DocxExtractor(Extractor):
+    file_types = ('docx',)
+
+    def sections(self, file_path):
+        from docx import Document as DocxDocument
+
+        doc = DocxDocument(file_path)
+        for paragraph in doc.paragraphs:
+            if paragraph.text.strip():
+                yield Section(None, paragraph.text)
+
+
+@register
+class TextExtractor(Extractor):
+    file_types = ('txt',)
+    block_size = 1 << 20
+
+    def sections(self, file_path):
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    return
+                # Finish the current line so no word is split across blocks
+                if not block.endswith('\n'):
+                    block += f.readline()
+                yield Section(None, block)
+
+
+@register
+class ImageExtractor(Extractor):
+    file_types = ('jpg', 'jpeg', 'png', 'gif', 'webp')
+
+    def sections(self, file_path):
+        # For images, create a descriptive placeholder
+        # In the future, this could be enhanced with OCR or vision models
+        filename = os.path.basename(file_path)
+        yield Section(None, (
+            f"[Image: {filename}] - This is an uploaded image file. "
+            f"The image content can be viewed in the chat interface."
+        ))
+
+
+@register
+class TabularExtractor(Extractor):
+    """
+    For CSV/Excel, a concise summary of the table structure with a small
+    sample of rows. This summary is what gets chunked and embedded for RAG;
+    detailed tabular access goes through ``document_service`` helpers.
+    """
+    file_types = ('csv', 'xlsx', 'xls')
+
+    def sections(self, file_path):
+        from .document_service import _load_tabular_file
+
+        file_type = os.path.splitext(file_path)[1].lstrip('.').lower()
+        df = _load_tabular_file(file_path, file_type)
+        if df is None or df.empty:
+            yield Section(None, "[Tabular Data] Empty or unreadable table.")
+            return
+
+        preview_rows = min(10, len(df))
+        yield Section(None, "\n".join([
+            f"[Tabular Data Summary] Rows: {len(df)}, Columns: {len(df.columns)}",
+            f"Columns: {', '.join(map(str, df.columns))}",
+            "Sample rows (first " f"{preview_rows}):\n" + df.head(preview_rows).to_csv(index=False),
+        ]))
+
+
+def iter_sections(file_path, file_type) -> Iterator[Section]:
+    """Stream the sections of a file; unknown formats yield nothing."""
+    extractor = get_extractor(file_type)
+    if extractor is None:
+        return iter(())
+    return extractor.sections(file_path)
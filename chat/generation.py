@@ -0,0 +1,99 @@
+"""
+Registry of in-flight answer generations, for cancelling them.
+
+Each streaming chat response registers a ``Generation`` for its
+conversation and checks ``cancelled`` between model chunks; once it is set
+the stream stops reading, which closes the upstream Ollama response so the
+model stops generating. ``cancel`` flags generations running in this process
+directly and leaves a short-lived flag in the cache (``CHAT_CANCEL_CACHE``)
+for streams served by other worker processes, so that alias must point at a
+shared cache backend when running more than one process.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Seconds a cancel request stays visible to other processes
+CANCEL_TTL = 300
+
+# Seconds between cache lookups of one stream; in-process cancels are immediate
+CANCEL_POLL_INTERVAL = 0.25
+
+_active = {}
+_lock = threading.Lock()
+
+
+def _cache():
+    return caches[getattr(settings, 'CHAT_CANCEL_CACHE', 'default')]
+
+
+def _cancel_key(conversation_id):
+    return f'chat:cancel:{conversation_id}'
+
+
+class Generation:
+    """One answer being streamed for a conversation."""
+
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+        self.started = time.time()
+        self._event = threading.Event()
+        self._next_poll = 0.0
+
+    def cancel(self):
+        self._event.set()
+
+    def _poll_due(self):
+        now = time.monotonic()
+        if now < self._next_poll:
+            return False
+        self._next_poll = now + CANCEL_POLL_INTERVAL
+        return True
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and self._poll_due():
+            flag = _cache().get(_cancel_key(self.conversation_id))
+            if flag and flag >= self.started:
+                self._event.set()
+        return self._event.is_set()
+
+    async def acancelled(self) -> bool:
+        """``cancelled`` for async views, without blocking the event loop."""
+        if not self._event.is_set() and self._poll_due():
+            flag = await _cache().aget(_cancel_key(self.conversation_id))
+            if flag and flag >= self.started:
+                self._event.set()
+        return self._event.is_set()
+
+
+def start(conversation_id) -> Generation:
+    generation = Generation(conversation_id)
+    with _lock:
+        _active.setdefault(conversation_id, set()).add(generation)
+    return generation
+
+
+def finish(generation: Generation):
+    with _lock:
+        running = _active.get(generation.conversation_id)
+        if running:
+            running.discard(generation)
+            if not running:
+                del _active[generation.conversation_id]
+
+
+def cancel(conversation_id) -> int:
+    """
+    Stop every generation for ``conversation_id`` started before now.
+    Returns how many were running in this process.
+    """
+    # Timestamped, so a later answer in the same conversation is unaffected
+    _cache().set(_cancel_key(conversation_id), time.time(), CANCEL_TTL)
+    with _lock:
+        running = list(_active.get(conversation_id, ()))
+    for generation in running:
+        generation.cancel()
+    return len(running)
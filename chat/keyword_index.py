@@ -0,0 +1,252 @@
+"""
+Full-text (BM25) index over document chunks, and hybrid retrieval.
+
+On SQLite the chunks are indexed by an FTS5 external-content table that
+triggers keep in step with ``chat_documentchunk`` (created by migration
+0010), so ingestion and deletes need no extra code. PostgreSQL uses a GIN
+expression index with ``ts_rank``. Other databases have no keyword index and
+retrieval stays purely dense.
+
+Hybrid retrieval (``RAG_RETRIEVAL_MODE=hybrid``) takes the BM25 candidates
+first and dense-scores only those rows of the resident vector index instead
+of the whole library, then merges the BM25 and dense rankings with
+reciprocal rank fusion. When the keyword index finds fewer than ``top_k``
+candidates, the dense top hits are added so recall never drops below plain
+dense retrieval.
+"""
+import logging
+import re
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from . import ann_index, metrics
+from .models import Document
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'chat_documentchunk_fts'
+
+# Reciprocal rank fusion constant (Cormack et al.); dampens the top ranks
+RRF_K = 60
+
+# Keyword hits scoring below this fraction of the best hit get no BM25 rank
+MIN_RELATIVE_BM25 = 0.01
+
+
+def _query_terms(text: str) -> List[List[str]]:
+    """Words of the query, each split into the tokens the index stores."""
+    terms = []
+    for word in text.split():
+        parts = re.findall(r'\w+', word.lower())
+        if parts:
+            terms.append(parts)
+    return terms
+
+
+class KeywordIndex:
+    """Interface: BM25-style ranked chunk lookup scoped to one user."""
+    vendor = None
+
+    def search(
+        self, user_id: int, text: str, limit: int, document_ids: Optional[Iterable[int]] = None
+    ) -> List[Tuple[int, int, float]]:
+        """Up to ``limit`` ``(chunk_id, document_id, score)``, best first."""
+        raise NotImplementedError
+
+
+class SQLiteFTS5Index(KeywordIndex):
+    vendor = 'sqlite'
+
+    def _match_expression(self, text):
+        # Quote every word so user input can never be parsed as FTS5 query
+        # syntax; a word such as "INV-2024-001" becomes a phrase of its tokens.
+        phrases = ['"' + ' '.join(parts) + '"' for parts in _query_terms(text)]
+        return ' OR '.join(dict.fromkeys(phrases))
+
+    def search(self, user_id, text, limit, document_ids=None):
+        expression = self._match_expression(text)
+        if not expression:
+            return []
+        sql = (
+            f"SELECT c.id, c.document_id, bm25({FTS_TABLE}) AS rank "
+            f"FROM {FTS_TABLE} "
+            f"JOIN chat_documentchunk c ON c.id = {FTS_TABLE}.rowid "
+            f"JOIN chat_document d ON d.id = c.document_id "
+            f"WHERE {FTS_TABLE} MATCH %s AND d.user_id = %s AND d.status = %s"
+        )
+        params = [expression, user_id, Document.STATUS_READY]
+        if document_ids is not None:
+            document_ids = list(document_ids)
+            if not document_ids:
+                return []
+            sql += f" AND c.document_id IN ({', '.join(['%s'] * len(document_ids))})"
+            params.extend(document_ids)
+        sql += " ORDER BY rank LIMIT %s"
+        params.append(limit)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            # bm25() is lower-is-better; flip it so higher means more relevant
+            return [(chunk_id, doc_id, -rank) for chunk_id, doc_id, rank in cursor.fetchall()]
+
+
+class PostgresFullTextIndex(KeywordIndex):
+    vendor = 'postgresql'
+    config = 'english'
+
+    def search(self, user_id, text, limit, document_ids=None):
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+        from .models import DocumentChunk
+
+        words = [' '.join(parts) for parts in _query_terms(text)]
+        if not words:
+            return []
+        query = SearchQuery(' OR '.join(words), config=self.config, search_type='websearch')
+        vector = SearchVector('content', config=self.config)  # matches the GIN index
+        rows = DocumentChunk.objects.annotate(rank=SearchRank(vector, query)).filter(
+            rank__gt=0,
+            document__user_id=user_id,
+            document__status=Document.STATUS_READY,
+        )
+        if document_ids is not None:
+            rows = rows.filter(document_id__in=list(document_ids))
+        rows = rows.order_by('-rank').values_list('id', 'document_id', 'rank')[:limit]
+        return [(chunk_id, doc_id, float(rank)) for chunk_id, doc_id, rank in rows]
+
+
+def repair_sqlite_triggers(using='default'):
+    """
+    Recreate the FTS5 sync triggers if they are missing and reindex.
+
+    SQLite migrations that alter ``chat_documentchunk`` rebuild the table,
+    which silently drops its triggers; this runs after every ``migrate``.
+    """
+    import importlib
+
+    from django.db import connections
+
+    conn = connections[using]
+    if conn.vendor != 'sqlite':
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name LIKE %s",
+            [f'{FTS_TABLE}%'],
+        )
+        names = {row[0] for row in cursor.fetchall()}
+        if FTS_TABLE not in names or len(names & {f'{FTS_TABLE}_ai', f'{FTS_TABLE}_ad', f'{FTS_TABLE}_au'}) == 3:
+            return
+        logger.info(f"Recreating {FTS_TABLE} triggers and reindexing")
+        schema = importlib.import_module('chat.migrations.0010_documentchunk_fts')
+        for statement in schema.SQLITE_FORWARD:
+            cursor.execute(statement)
+
+
+BACKENDS = {backend.vendor: backend for backend in (SQLiteFTS5Index, PostgresFullTextIndex)}
+
+_backend = None
+_backend_checked = False
+
+
+def get_keyword_index() -> Optional[KeywordIndex]:
+    """The keyword index for the default database, or None if unsupported."""
+    global _backend, _backend_checked
+    if not _backend_checked:
+        backend_cls = BACKENDS.get(connection.vendor)
+        if backend_cls is SQLiteFTS5Index and FTS_TABLE not in connection.introspection.table_names():
+            logger.error(f"{FTS_TABLE} is missing (SQLite built without FTS5?); keyword search disabled")
+            backend_cls = None
+        _backend = backend_cls() if backend_cls else None
+        _backend_checked = True
+    return _backend
+
+
+def _fuse(rankings: List[List[int]]) -> dict:
+    """Reciprocal rank fusion of several best-first lists of row positions."""
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return fused
+
+
+def _rows_for(snapshot, chunk_ids) -> np.ndarray:
+    """Snapshot row positions of ``chunk_ids``, in the same order; unknown ids are dropped."""
+    wanted = np.asarray(list(chunk_ids), dtype=np.int64)
+    rows = np.flatnonzero(np.isin(snapshot.chunk_ids, wanted))
+    if not rows.size:
+        return rows
+    found = snapshot.chunk_ids[rows]
+    order = np.argsort(found)
+    slots = np.minimum(np.searchsorted(found[order], wanted), order.shape[0] - 1)
+    present = found[order][slots] == wanted
+    return rows[order[slots[present]]]
+
+
+def hybrid_search(
+    index,
+    query_text: str,
+    query_vector,
+    top_k: int,
+    document_ids: Optional[Iterable[int]] = None,
+    per_document_k: Optional[int] = None,
+) -> List[Tuple[int, int, float]]:
+    """
+    Hybrid BM25 + dense top-k over a resident ``vector_index`` index.
+    Returns ``(chunk_id, document_id, cosine score)`` ordered by fused rank.
+    """
+    keyword_index = get_keyword_index()
+    if keyword_index is None:
+        return ann_index.search(index, query_vector, top_k, document_ids, per_document_k)
+    if document_ids is not None:
+        document_ids = list(document_ids)
+
+    limit = getattr(settings, 'RAG_HYBRID_CANDIDATES', 200)
+    with metrics.timer('retrieval.keyword_search'):
+        keyword_hits = keyword_index.search(index.user_id, query_text, limit, document_ids)
+
+    snapshot = index.snapshot()
+    query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+    if query.shape[0] != snapshot.matrix.shape[1]:
+        return []
+
+    keyword_rows = _rows_for(snapshot, [chunk_id for chunk_id, _, _ in keyword_hits])
+    # Hits that only share terms found in nearly every chunk (BM25 ~ 0) stay
+    # candidates but earn no keyword rank; their order would be arbitrary.
+    best = keyword_hits[0][2] if keyword_hits else 0.0
+    ranked_ids = [chunk_id for chunk_id, _, score in keyword_hits if score > best * MIN_RELATIVE_BM25]
+    keyword_ranking = _rows_for(snapshot, ranked_ids).tolist()
+    candidates = keyword_rows
+    if keyword_rows.shape[0] < top_k:
+        # Too few keyword matches to choose from; bring in the dense best
+        metrics.increment('retrieval.hybrid_dense_fallback')
+        dense_hits = ann_index.search(index, query, top_k, document_ids, per_document_k)
+        candidates = np.concatenate([
+            keyword_rows, _rows_for(snapshot, [chunk_id for chunk_id, _, _ in dense_hits])
+        ])
+    candidates = np.unique(candidates)
+    if not candidates.size:
+        return []
+    metrics.increment('retrieval.hybrid_candidates', int(candidates.shape[0]))
+
+    # Dense scores for the candidates only
+    scores = snapshot.matrix[candidates] @ query
+    cosine = dict(zip(candidates.tolist(), scores.tolist()))
+    dense_ranking = candidates[np.argsort(-scores, kind='stable')].tolist()
+    fused = _fuse([keyword_ranking, dense_ranking])
+
+    results = []
+    per_document = {}
+    for row in sorted(fused, key=fused.get, reverse=True):
+        document_id = int(snapshot.document_ids[row])
+        if per_document_k and per_document.get(document_id, 0) >= per_document_k:
+            continue
+        per_document[document_id] = per_document.get(document_id, 0) + 1
+        results.append((int(snapshot.chunk_ids[row]), document_id, float(cosine[row])))
+        if len(results) == top_k:
+            break
+    return results
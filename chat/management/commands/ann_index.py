@@ -0,0 +1,102 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from chat import ann_index, vector_index
+from chat.models import Document, DocumentChunk
+
+
+class Command(BaseCommand):
+    help = 'Rebuild, verify or drop the per-user ANN (IVF) retrieval shards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['rebuild', 'verify', 'drop'])
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='User id (repeatable; default: every user with chunks)')
+        parser.add_argument('--nlist', type=int, help='Number of IVF lists (default: ~4*sqrt(N))')
+        parser.add_argument('--nprobe', type=int, help='Lists probed per query (default: RAG_ANN_NPROBE)')
+        parser.add_argument('--queries', type=int, default=100, help='Sample queries for verify (default: 100)')
+        parser.add_argument('--top-k', type=int, default=5, help='k for recall@k (default: 5)')
+        parser.add_argument('--noise', type=float, default=0.05,
+                            help='Gaussian noise added to sampled chunk vectors used as queries')
+
+    def handle(self, *args, **options):
+        users = options['users'] or list(
+            DocumentChunk.objects.filter(document__status=Document.STATUS_READY)
+            .values_list('document__user_id', flat=True).distinct()
+        )
+        if not users:
+            self.stdout.write(self.style.SUCCESS('No users with processed documents.'))
+            return
+
+        for user_id in users:
+            if options['action'] == 'drop':
+                ann_index.drop_user(user_id)
+                self.stdout.write(f'User {user_id}: shard dropped')
+                continue
+
+            dim = self._dimension(user_id)
+            if dim is None:
+                self.stdout.write(f'User {user_id}: no embeddings, skipped')
+                continue
+
+            if options['action'] == 'rebuild':
+                started = time.perf_counter()
+                shard = ann_index.build_user(user_id, dim, nlist=options['nlist'])
+                elapsed = time.perf_counter() - started
+                if shard is None:
+                    self.stdout.write(f'User {user_id}: nothing to index')
+                else:
+                    self.stdout.write(
+                        f'User {user_id}: {len(shard)} rows in {shard.nlist} lists ({elapsed:.2f}s)'
+                    )
+            else:
+                self._verify(user_id, dim, options)
+
+        self.stdout.write(self.style.SUCCESS('Done!'))
+
+    def _dimension(self, user_id):
+        chunk = DocumentChunk.objects.filter(
+            Q(embedding_blob__isnull=False) | Q(embedding__isnull=False),
+            document__user_id=user_id,
+            document__status=Document.STATUS_READY,
+        ).order_by('-id').first()
+        if chunk is None:
+            return None
+        return chunk.vector.shape[0]
+
+    def _verify(self, user_id, dim, options):
+        shard = ann_index._current_shard(user_id)
+        if shard is None:
+            raise CommandError(f'User {user_id} has no ANN shard; run "ann_index rebuild" first')
+
+        index = vector_index.get_user_index(user_id, dim)
+        snapshot = index.snapshot()
+        view = ann_index._view_for(shard, snapshot)
+        self.stdout.write(
+            f'User {user_id}: {len(index)} indexed rows, {len(shard)} in shard, '
+            f'{view.uncovered_rows.shape[0]} not yet in shard, {view.stale_entries} stale entries'
+        )
+
+        rng = np.random.default_rng(0)
+        picks = rng.choice(len(index), min(options['queries'], len(index)), replace=False)
+        queries = snapshot.matrix[picks] + rng.normal(scale=options['noise'], size=(len(picks), dim))
+        queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+        top_k, nprobe = options['top_k'], options['nprobe']
+        started = time.perf_counter()
+        for query in queries:
+            index.search(query, top_k)
+        exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+        started = time.perf_counter()
+        for query in queries:
+            ann_index.search(index, query, top_k, nprobe=nprobe, force=True)
+        ann_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+        recall = ann_index.measure_recall(index, queries, top_k=top_k, nprobe=nprobe)
+        self.stdout.write(
+            f'  recall@{top_k}: {recall:.3f}  exact: {exact_ms:.2f} ms/query  ann: {ann_ms:.2f} ms/query'
+        )
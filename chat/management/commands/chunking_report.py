@@ -0,0 +1,57 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.chunking import SPECIAL_TOKENS
+from chat.document_service import chunk_token_budget, iter_document_chunks, iter_section_chunks
+from chat.embeddings import get_embedding_backend
+from chat.extractors import iter_sections
+from chat.models import Document
+
+
+class Command(BaseCommand):
+    help = 'Compare tokens embedded and discarded by the word and token-aware chunkers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Files to chunk')
+        parser.add_argument('--document', type=int, action='append', dest='documents',
+                            help='Uploaded document id (repeatable)')
+
+    def handle(self, *args, **options):
+        files = [(path, os.path.splitext(path)[1].lstrip('.').lower()) for path in options['paths']]
+        for document in Document.objects.filter(id__in=options['documents'] or []):
+            files.append((document.file.path, document.file_type))
+        if not files:
+            raise CommandError('Pass file paths or --document ids')
+
+        backend = get_embedding_backend()
+        limit = backend.max_seq_length - SPECIAL_TOKENS
+        self.stdout.write(
+            f'Model {backend.version}: {limit} tokens per input, '
+            f'token chunks of {chunk_token_budget(backend)}'
+        )
+
+        for path, file_type in files:
+            sections = list(iter_sections(path, file_type))
+            document_tokens = sum(len(backend.token_offsets(text)) for _, text in sections)
+            self.stdout.write(f'\n{os.path.basename(path)}: {document_tokens} tokens')
+
+            started = time.perf_counter()
+            word_chunks = [content for content, _ in iter_section_chunks(sections)]
+            word_tokens = [len(backend.token_offsets(content)) for content in word_chunks]
+            self._row('words (500/50)', word_tokens, limit, time.perf_counter() - started)
+
+            started = time.perf_counter()
+            token_tokens = [chunk.token_count for chunk in iter_document_chunks(sections, backend)]
+            self._row('tokens', token_tokens, limit, time.perf_counter() - started)
+
+    def _row(self, label, tokens, limit, seconds):
+        embedded = sum(min(n, limit) for n in tokens)
+        discarded = sum(max(0, n - limit) for n in tokens)
+        total = embedded + discarded
+        share = 100 * discarded / total if total else 0.0
+        self.stdout.write(
+            f'  {label:<16} {len(tokens):6d} chunks  {embedded:9d} embedded  '
+            f'{discarded:9d} discarded ({share:5.1f}%)  {seconds:.2f}s'
+        )
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from chat.models import DocumentChunk, EMBEDDING_DTYPES
+
+
+class Command(BaseCommand):
+    help = 'Convert legacy JSON chunk embeddings to packed binary storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dtype',
+            default='float32',
+            choices=sorted(EMBEDDING_DTYPES),
+            help='Packed format to write (default: float32)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows converted per transaction (default: 500)',
+        )
+        parser.add_argument(
+            '--keep-json',
+            action='store_true',
+            help='Keep the legacy JSON column populated after conversion',
+        )
+        parser.add_argument(
+            '--vacuum',
+            action='store_true',
+            help='Run VACUUM afterwards to reclaim space (SQLite only)',
+        )
+
+    def handle(self, *args, **options):
+        dtype = options['dtype']
+        batch_size = options['batch_size']
+        keep_json = options['keep_json']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        pending = DocumentChunk.objects.filter(
+            embedding__isnull=False,
+            embedding_blob__isnull=True,
+        ).order_by('id')
+
+        total = pending.count()
+        if not total:
+            self.stdout.write(self.style.SUCCESS('No JSON embeddings left to convert!'))
+            return
+
+        self.stdout.write(f'Converting {total} embeddings to {dtype}...')
+
+        converted = 0
+        last_id = 0
+        while True:
+            batch = list(
+                pending.filter(id__gt=last_id).only('id', 'embedding')[:batch_size]
+            )
+            if not batch:
+                break
+
+            for chunk in batch:
+                legacy = chunk.embedding
+                chunk.set_vector(legacy, dtype)
+                if keep_json:
+                    chunk.embedding = legacy
+
+            with transaction.atomic():
+                DocumentChunk.objects.bulk_update(
+                    batch, ['embedding_blob', 'embedding_dtype', 'embedding']
+                )
+
+            converted += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f'  {converted}/{total}')
+
+        if options['vacuum']:
+            if connection.vendor != 'sqlite':
+                self.stdout.write(self.style.WARNING('--vacuum is only supported on SQLite; skipped'))
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute('VACUUM')
+
+        self.stdout.write(self.style.SUCCESS(f'Converted {converted} embeddings!'))
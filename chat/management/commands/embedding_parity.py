@@ -0,0 +1,94 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.embeddings import OnnxBackend, SentenceTransformerBackend
+from chat.models import DocumentChunk
+
+SAMPLE_TEXTS = [
+    'The balanced scorecard links strategy to operational measures.',
+    'Quarterly revenue grew by 12% compared to the previous year.',
+    'Customer satisfaction is tracked through monthly surveys.',
+    'Employees completed an average of 30 training hours.',
+    'Process cycle time was reduced after the automation project.',
+    'What are the key performance indicators for the finance perspective?',
+]
+
+
+class Command(BaseCommand):
+    help = 'Compare ONNX embedding backends against the PyTorch model loaded from the same directory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', action='append', dest='backends', choices=['onnx', 'onnx-int8'],
+                            help='Backend to check (repeatable; default: onnx and onnx-int8)')
+        parser.add_argument('--model-dir', default=None,
+                            help='Model directory (default: RAG_ONNX_MODEL_DIR)')
+        parser.add_argument('--samples', type=int, default=200,
+                            help='Stored chunks to encode (default: 200; built-in sentences if none)')
+        parser.add_argument('--batch-size', type=int, default=32)
+        parser.add_argument('--top-k', type=int, default=5,
+                            help='Neighbours compared for ranking agreement (default: 5)')
+        parser.add_argument('--min-cosine', type=float, default=0.99,
+                            help='Fail if any vector is less similar to the reference (default: 0.99)')
+
+    def handle(self, *args, **options):
+        model_dir = options['model_dir'] or settings.RAG_ONNX_MODEL_DIR
+        backends = options['backends'] or ['onnx', 'onnx-int8']
+        texts = list(
+            DocumentChunk.objects.order_by('?').values_list('content', flat=True)[:options['samples']]
+        ) or SAMPLE_TEXTS
+        self.stdout.write(f'Encoding {len(texts)} texts with models from {model_dir}')
+
+        reference = SentenceTransformerBackend(model_dir, trust_remote_code=True)
+        expected, seconds = self._encode(reference, texts, options['batch_size'])
+        self.stdout.write(f'  {reference.name:<22} {len(texts) / seconds:8.1f} texts/s')
+
+        failed = False
+        for name in backends:
+            backend = OnnxBackend(
+                model_dir,
+                model_file=settings.RAG_ONNX_MODEL_FILE,
+                quantize=(name == 'onnx-int8'),
+                max_length=min(settings.RAG_ONNX_MAX_LENGTH, reference.model.max_seq_length),
+                threads=settings.RAG_ONNX_THREADS,
+            )
+            actual, seconds = self._encode(backend, texts, options['batch_size'])
+            if actual.shape != expected.shape:
+                raise CommandError(f'{name}: shape {actual.shape} does not match reference {expected.shape}')
+
+            cosine = (actual * expected).sum(axis=1)
+            agreement = self._neighbour_agreement(expected, actual, options['top_k'])
+            ok = cosine.min() >= options['min_cosine']
+            failed |= not ok
+            style = self.style.SUCCESS if ok else self.style.ERROR
+            self.stdout.write(style(
+                f'  {name:<22} {len(texts) / seconds:8.1f} texts/s  '
+                f'cosine min {cosine.min():.5f} mean {cosine.mean():.5f}  '
+                f'top-{options["top_k"]} agreement {agreement:.3f}'
+            ))
+
+        if failed:
+            raise CommandError(f'Parity below {options["min_cosine"]} cosine similarity')
+        self.stdout.write(self.style.SUCCESS('Backends match the reference model!'))
+
+    def _encode(self, backend, texts, batch_size):
+        started = time.perf_counter()
+        vectors = backend.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+        return vectors, time.perf_counter() - started
+
+    def _neighbour_agreement(self, expected, actual, k):
+        """Mean overlap of each text's k nearest neighbours under both backends."""
+        k = min(k, len(expected) - 1)
+        if k < 1:
+            return 1.0
+        overlap = 0
+        sims_expected, sims_actual = expected @ expected.T, actual @ actual.T
+        np.fill_diagonal(sims_expected, -np.inf)
+        np.fill_diagonal(sims_actual, -np.inf)
+        top_expected = np.argsort(-sims_expected, axis=1)[:, :k]
+        top_actual = np.argsort(-sims_actual, axis=1)[:, :k]
+        for row_expected, row_actual in zip(top_expected, top_actual):
+            overlap += len(set(row_expected) & set(row_actual))
+        return overlap / (k * len(expected))
@@ -0,0 +1,59 @@
+import os
+import time
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.embedding_server import MicroBatcher, make_server
+from chat.embeddings import create_backend
+
+
+class Command(BaseCommand):
+    help = 'Serve one shared embedding model to all workers, batching concurrent requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=None,
+                            help='unix:///path or http://127.0.0.1:port (default: RAG_EMBEDDING_SERVER)')
+        parser.add_argument('--backend', default=None,
+                            choices=['sentence-transformers', 'onnx', 'onnx-int8'],
+                            help='Backend to serve (default: RAG_EMBEDDING_SERVER_BACKEND)')
+        parser.add_argument('--max-batch-size', type=int, default=None,
+                            help='Texts per forward pass (default: RAG_EMBEDDING_SERVER_MAX_BATCH)')
+        parser.add_argument('--max-wait-ms', type=float, default=None,
+                            help='How long to wait for more requests (default: RAG_EMBEDDING_SERVER_MAX_WAIT_MS)')
+
+    def handle(self, *args, **options):
+        address = options['address'] or settings.RAG_EMBEDDING_SERVER
+        backend_name = options['backend'] or settings.RAG_EMBEDDING_SERVER_BACKEND
+        if backend_name == 'remote':
+            raise CommandError('The embedding server cannot use the remote backend itself')
+        max_batch = options['max_batch_size'] or settings.RAG_EMBEDDING_SERVER_MAX_BATCH
+        max_wait_ms = options['max_wait_ms']
+        if max_wait_ms is None:
+            max_wait_ms = settings.RAG_EMBEDDING_SERVER_MAX_WAIT_MS
+
+        started = time.perf_counter()
+        backend = create_backend(backend_name)
+        backend.encode(['warmup'])
+        self.stdout.write(f'Loaded {backend.version} in {time.perf_counter() - started:.2f}s')
+
+        batcher = MicroBatcher(backend, max_batch_size=max_batch, max_wait=max_wait_ms / 1000)
+        batcher.start()
+        try:
+            server = make_server(address, batcher)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not listen on {address}: {e}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Embedding server listening on {address} (max batch {max_batch}, wait {max_wait_ms:g} ms)'
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            url = urlparse(address)
+            if url.scheme == 'unix' and os.path.exists(url.path):
+                os.unlink(url.path)
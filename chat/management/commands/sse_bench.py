@@ -0,0 +1,162 @@
+import json
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.sse import ChunkCoalescer
+
+SAMPLE_TEXT = (
+    'The balanced scorecard links strategy to operational measures across the financial, '
+    'customer, internal process and learning perspectives. Quarterly revenue grew by 12% '
+    'compared to the previous year, while customer satisfaction is tracked through monthly '
+    'surveys and process cycle time was reduced after the automation project. '
+)
+
+
+def _tokens(count):
+    """Word-piece sized chunks, as Ollama streams them."""
+    words = SAMPLE_TEXT.split(' ')
+    tokens = []
+    while len(tokens) < count:
+        for word in words:
+            # Long words arrive as several tokens
+            pieces = [word[i:i + 4] for i in range(0, len(word), 4)] or ['']
+            tokens.append(' ' + pieces[0])
+            tokens.extend(pieces[1:])
+    return tokens[:count]
+
+
+class _FakeClock:
+    """Token arrival times at a fixed generation rate, without sleeping."""
+
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        return self.now
+
+
+class Command(BaseCommand):
+    help = 'Measure SSE frames and CPU per chat stream with per-token frames versus coalesced frames'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=2000, help='Tokens per answer (default: 2000)')
+        parser.add_argument('--tokens-per-sec', type=float, default=30.0,
+                            help='Simulated generation speed (default: 30)')
+        parser.add_argument('--streams', type=int, default=50, help='Answers streamed per mode (default: 50)')
+        parser.add_argument('--interval-ms', type=float, default=None,
+                            help='Flush interval (default: SSE_FLUSH_INTERVAL_MS)')
+        parser.add_argument('--max-bytes', type=int, default=None,
+                            help='Flush size (default: SSE_FLUSH_BYTES)')
+
+    def handle(self, *args, **options):
+        if options['tokens'] < 1 or options['tokens_per_sec'] <= 0 or options['streams'] < 1:
+            raise CommandError('--tokens, --tokens-per-sec and --streams must be positive')
+        interval_ms = options['interval_ms']
+        if interval_ms is None:
+            interval_ms = settings.SSE_FLUSH_INTERVAL_MS
+        max_bytes = options['max_bytes']
+        if max_bytes is None:
+            max_bytes = settings.SSE_FLUSH_BYTES
+
+        tokens = _tokens(options['tokens'])
+        duration = len(tokens) / options['tokens_per_sec']
+        self.stdout.write(
+            f"{options['streams']} streams x {len(tokens)} tokens at {options['tokens_per_sec']:g} tokens/s "
+            f"({duration:.1f}s of generation each), frames written to a local socket"
+        )
+
+        baseline = self._run(tokens, options['streams'], options['tokens_per_sec'], self._per_token)
+        coalesced = self._run(
+            tokens, options['streams'], options['tokens_per_sec'],
+            lambda sock, stream, clock: self._coalesced(sock, stream, clock, interval_ms, max_bytes),
+        )
+        for label, (frames, sent, cpu) in (
+            ('per-token (before)', baseline),
+            (f'coalesced {interval_ms:g}ms/{max_bytes}B', coalesced),
+        ):
+            self.stdout.write(
+                f'  {label:<24} {frames:6d} frames/stream  {frames / duration:7.1f} frames/s  '
+                f'{sent / 1024:7.1f} KiB/stream  {cpu * 1000:7.2f} ms CPU/stream'
+            )
+        self.stdout.write(
+            f'  frames x{baseline[0] / max(coalesced[0], 1):.1f} fewer, CPU x{baseline[2] / max(coalesced[2], 1e-9):.1f} lower'
+        )
+
+    def _run(self, tokens, streams, tokens_per_sec, write_stream):
+        reader, writer = socket.socketpair()
+        drained = threading.Thread(target=self._drain, args=(reader,), daemon=True)
+        drained.start()
+        frames = sent = 0
+        cpu = 0.0
+        expected = ''.join(tokens)
+        try:
+            for _ in range(streams):
+                clock = _FakeClock(1.0 / tokens_per_sec)
+                started = time.thread_time()
+                stream_frames, stream_bytes, text, saved = write_stream(writer, self._arrivals(tokens, clock), clock)
+                cpu += time.thread_time() - started
+                if text != expected or saved != expected:
+                    raise CommandError('Streamed text differs from the generated text')
+                frames += stream_frames
+                sent += stream_bytes
+        finally:
+            writer.close()
+            drained.join()
+            reader.close()
+        return frames // streams, sent // streams, cpu / streams
+
+    @staticmethod
+    def _arrivals(tokens, clock):
+        for token in tokens:
+            clock.now += clock.step
+            yield token
+
+    @staticmethod
+    def _drain(sock):
+        while sock.recv(1 << 16):
+            pass
+
+    @staticmethod
+    def _per_token(sock, stream, clock):
+        # The event_stream loop before coalescing
+        full_response = ""
+        frames = sent = 0
+        received = []
+        for chunk in stream:
+            full_response += chunk
+            frame = f"data: {json.dumps({'chunk': chunk})}\n\n".encode()
+            sock.sendall(frame)
+            frames += 1
+            sent += len(frame)
+            received.append(chunk)
+        return frames, sent, ''.join(received), full_response
+
+    @staticmethod
+    def _coalesced(sock, stream, clock, interval_ms, max_bytes):
+        parts = []
+        coalescer = ChunkCoalescer(interval_ms, max_bytes, clock=clock)
+        frames = sent = 0
+        received = []
+
+        def send(text):
+            nonlocal frames, sent
+            frame = f"data: {json.dumps({'chunk': text})}\n\n".encode()
+            sock.sendall(frame)
+            frames += 1
+            sent += len(frame)
+            received.append(text)
+
+        for chunk in stream:
+            parts.append(chunk)
+            text = coalescer.push(chunk)
+            if text:
+                send(text)
+        text = coalescer.flush()
+        if text:
+            send(text)
+        return frames, sent, ''.join(received), ''.join(parts)
@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Imported in a fresh interpreter the way a web worker boots
+BOOT_SNIPPET = """
+import django
+django.setup()
+import {modules}
+"""
+
+DEFAULT_MODULES = ['bsc_ai.urls', 'chat.api_views', 'chat.views', 'chat.tasks']
+
+
+class Command(BaseCommand):
+    help = 'Report which imports dominate process start-up time (python -X importtime)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='Rows to show (default: 20)')
+        parser.add_argument('--module', action='append', dest='modules',
+                            help='Module to import after django.setup() (repeatable)')
+        parser.add_argument('--with-model', action='store_true',
+                            help='Also load the embedding model, as RAG_PRELOAD_EMBEDDING_MODEL would')
+
+    def handle(self, *args, **options):
+        modules = options['modules'] or DEFAULT_MODULES
+        snippet = BOOT_SNIPPET.format(modules=', '.join(modules))
+        if options['with_model']:
+            snippet += 'from chat.embeddings import get_embedding_backend\nget_embedding_backend()\n'
+
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'bsc_ai.settings')
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', snippet],
+            cwd=settings.BASE_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            raise CommandError(f'Boot import failed:\n{proc.stderr[-4000:]}')
+
+        rows = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            try:
+                self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+                rows.append((name.rstrip(), int(self_us), int(cumulative_us)))
+            except ValueError:
+                continue
+
+        if not rows:
+            raise CommandError('No import timings captured')
+
+        total_us = sum(self_us for _, self_us, _ in rows)
+        top = options['top']
+
+        self.stdout.write(f'Total import time: {total_us / 1e6:.2f}s across {len(rows)} modules\n')
+
+        self.stdout.write('Slowest top-level packages (self time, summed):')
+        by_package = defaultdict(int)
+        for name, self_us, _ in rows:
+            by_package[name.strip().split('.')[0]] += self_us
+        for package, self_us in sorted(by_package.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+            self.stdout.write(f'  {self_us / 1000:9.1f} ms  {100 * self_us / total_us:5.1f}%  {package}')
+
+        self.stdout.write('\nSlowest imports (cumulative):')
+        for name, _, cumulative_us in sorted(rows, key=lambda r: r[2], reverse=True)[:top]:
+            self.stdout.write(f'  {cumulative_us / 1000:9.1f} ms  {name}')
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.embeddings import get_embedding_backend
+
+
+class Command(BaseCommand):
+    help = 'Load the embedding model (and download it if needed) ahead of the first request'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        backend = get_embedding_backend()
+        loaded = time.perf_counter()
+        backend.encode(['warmup'], normalize_embeddings=True)
+        encoded = time.perf_counter()
+
+        self.stdout.write(f'Backend: {backend.version}')
+        self.stdout.write(f'  load:         {loaded - started:.2f}s')
+        self.stdout.write(f'  first encode: {encoded - loaded:.2f}s')
+        self.stdout.write(self.style.SUCCESS('Embedding model is warm!'))
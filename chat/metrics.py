@@ -0,0 +1,74 @@
+"""
+Process-local counters, timers and gauges.
+
+Every web or worker process keeps its own numbers; ``snapshot()`` reports
+the process that serves the request. Gauges are callables evaluated at
+snapshot time so components can expose sizes without pushing updates.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, int] = {}
+_timers: Dict[str, list] = {}  # name -> [count, total seconds, max seconds]
+_gauges: Dict[str, Callable[[], float]] = {}
+
+
+def increment(name: str, value: int = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        timer = _timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+
+@contextmanager
+def timer(name: str):
+    """Record the duration of the ``with`` block under ``name``."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+
+def register_gauge(name: str, func: Callable[[], float]) -> None:
+    with _lock:
+        _gauges[name] = func
+
+
+def get_counter(name: str) -> int:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+        timers = {
+            name: {
+                'count': count,
+                'avg_ms': round(total * 1000 / count, 3) if count else 0.0,
+                'max_ms': round(peak * 1000, 3),
+            }
+            for name, (count, total, peak) in _timers.items()
+        }
+        gauges = dict(_gauges)
+    return {
+        'counters': counters,
+        'timers': timers,
+        'gauges': {name: func() for name, func in gauges.items()},
+    }
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _timers.clear()
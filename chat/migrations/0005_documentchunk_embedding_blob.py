@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-16 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatattachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchunk',
+            name='embedding_blob',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='documentchunk',
+            name='embedding_dtype',
+            field=models.CharField(choices=[('float32', 'float32'), ('float16', 'float16')], default='float32', max_length=8),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.8 on 2026-10-16 09:30
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def processed_to_status(apps, schema_editor):
+    Document = apps.get_model('chat', 'Document')
+    for doc in Document.objects.annotate(n_chunks=Count('chunks')).iterator():
+        if doc.processed:
+            doc.status = 'ready'
+            doc.progress = 100
+        else:
+            doc.status = 'failed'
+            doc.error = 'Processed before ingestion status tracking; please re-upload.'
+        doc.chunk_count = doc.n_chunks
+        doc.total_chunks = doc.n_chunks
+        doc.save(update_fields=['status', 'progress', 'chunk_count', 'total_chunks', 'error'])
+
+
+def status_to_processed(apps, schema_editor):
+    Document = apps.get_model('chat', 'Document')
+    Document.objects.filter(status='ready').update(processed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_documentchunk_embedding_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('extracting', 'Extracting'), ('embedding', 'Embedding'), ('ready', 'Ready'), ('failed', 'Failed')], db_index=True, default='queued', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='chunk_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='total_chunks',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(processed_to_status, status_to_processed),
+        migrations.RemoveField(
+            model_name='document',
+            name='processed',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-16 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_document_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchunk',
+            name='page_number',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-16 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_documentchunk_page_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchunk',
+            name='char_start',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='documentchunk',
+            name='char_end',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='documentchunk',
+            name='token_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
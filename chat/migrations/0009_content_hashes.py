@@ -0,0 +1,43 @@
+# Generated by Django 5.2.8 on 2026-10-16 13:40
+
+import hashlib
+import os
+
+from django.db import migrations, models
+
+
+def hash_existing_files(apps, schema_editor):
+    Document = apps.get_model('chat', 'Document')
+    for doc in Document.objects.exclude(file='').iterator():
+        try:
+            path = doc.file.path
+        except (NotImplementedError, ValueError):
+            continue
+        if not os.path.exists(path):
+            continue
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        Document.objects.filter(id=doc.id).update(content_hash=digest.hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_documentchunk_offsets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='documentchunk',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.RunPython(hash_existing_files, migrations.RunPython.noop),
+    ]
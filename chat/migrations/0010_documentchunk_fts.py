@@ -0,0 +1,70 @@
+# Generated by Django 5.2.8 on 2026-10-16 14:55
+
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_documentchunk_fts USING fts5(
+        content,
+        content='chat_documentchunk',
+        content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_documentchunk_fts_ai AFTER INSERT ON chat_documentchunk BEGIN
+        INSERT INTO chat_documentchunk_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_documentchunk_fts_ad AFTER DELETE ON chat_documentchunk BEGIN
+        INSERT INTO chat_documentchunk_fts(chat_documentchunk_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_documentchunk_fts_au AFTER UPDATE OF content ON chat_documentchunk BEGIN
+        INSERT INTO chat_documentchunk_fts(chat_documentchunk_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_documentchunk_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    "INSERT INTO chat_documentchunk_fts(chat_documentchunk_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS chat_documentchunk_fts_ai",
+    "DROP TRIGGER IF EXISTS chat_documentchunk_fts_ad",
+    "DROP TRIGGER IF EXISTS chat_documentchunk_fts_au",
+    "DROP TABLE IF EXISTS chat_documentchunk_fts",
+]
+
+POSTGRES_FORWARD = [
+    "CREATE INDEX IF NOT EXISTS chat_documentchunk_content_fts "
+    "ON chat_documentchunk USING GIN (to_tsvector('english'::regconfig, COALESCE(content, '')))",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS chat_documentchunk_content_fts",
+]
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        for statement in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_content_hashes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            _run({'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRES_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-16 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_documentchunk_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='interrupted',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,6 +1,24 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
+import numpy as np
+
+
+# Packed embedding formats (explicit little-endian so blobs are portable)
+EMBEDDING_DTYPES = {
+    'float32': np.dtype('<f4'),
+    'float16': np.dtype('<f2'),
+}
+
+
+def pack_embedding(vector, dtype='float32'):
+    """Pack an embedding vector into bytes for DocumentChunk.embedding_blob"""
+    return np.asarray(vector).astype(EMBEDDING_DTYPES[dtype], copy=False).tobytes()
+
+
+def unpack_embedding(blob, dtype='float32'):
+    """Return a read-only NumPy view over a packed embedding (no copy)"""
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPES[dtype])
 
 
 class Conversation(models.Model):
@@ -33,6 +51,8 @@ class ChatMessage(models.Model):
     is_user_message = models.BooleanField()
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Answer cut short by a client disconnect or an explicit cancel
+    interrupted = models.BooleanField(default=False)
     
     class Meta:
         ordering = ['timestamp']
@@ -43,12 +63,30 @@ class ChatMessage(models.Model):
 
 class Document(models.Model):
     """Uploaded documents for RAG"""
+    STATUS_QUEUED = 'queued'
+    STATUS_EXTRACTING = 'extracting'
+    STATUS_EMBEDDING = 'embedding'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_EXTRACTING, 'Extracting'),
+        (STATUS_EMBEDDING, 'Embedding'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     title = models.CharField(max_length=255)
     file = models.FileField(upload_to='documents/%Y/%m/%d/')
     file_type = models.CharField(max_length=10)  # pdf, docx, txt
     uploaded_at = models.DateTimeField(auto_now_add=True)
-    processed = models.BooleanField(default=False)  # Whether embeddings are created
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    progress = models.PositiveSmallIntegerField(default=0)  # Percentage, 0-100
+    chunk_count = models.IntegerField(default=0)  # Chunks committed so far
+    total_chunks = models.IntegerField(null=True, blank=True)  # Known once text is extracted
+    error = models.TextField(blank=True, default='')
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)  # SHA-256 of the file
     
     class Meta:
         ordering = ['-uploaded_at']
@@ -56,13 +94,27 @@ class Document(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.title}"
 
+    @property
+    def processed(self):
+        """Whether embeddings are created (kept for API compatibility)"""
+        return self.status == self.STATUS_READY
+
 
 class DocumentChunk(models.Model):
     """Text chunks from documents with embeddings for RAG"""
+    EMBEDDING_DTYPE_CHOICES = [(name, name) for name in EMBEDDING_DTYPES]
+
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='chunks')
     content = models.TextField()  # Chunk of text
     chunk_index = models.IntegerField()  # Position in document
-    embedding = models.JSONField(null=True, blank=True)  # Store embedding vector
+    page_number = models.PositiveIntegerField(null=True, blank=True)  # Page the chunk starts on (PDF)
+    char_start = models.PositiveIntegerField(null=True, blank=True)  # Offsets into the extracted text
+    char_end = models.PositiveIntegerField(null=True, blank=True)
+    token_count = models.PositiveIntegerField(null=True, blank=True)  # Embedding model tokens
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)  # See chunk_hash()
+    embedding = models.JSONField(null=True, blank=True)  # Legacy JSON vector (see convert_embeddings)
+    embedding_blob = models.BinaryField(null=True, blank=True)  # Packed embedding vector
+    embedding_dtype = models.CharField(max_length=8, choices=EMBEDDING_DTYPE_CHOICES, default='float32')
     
     class Meta:
         ordering = ['document', 'chunk_index']
@@ -70,6 +122,24 @@ class DocumentChunk(models.Model):
     def __str__(self):
         return f"{self.document.title} - Chunk {self.chunk_index}"
 
+    @property
+    def vector(self):
+        """
+        Embedding as a NumPy array. Packed rows return a zero-copy view of
+        the stored bytes; legacy JSON rows are decoded on the fly.
+        """
+        if self.embedding_blob is not None:
+            return unpack_embedding(self.embedding_blob, self.embedding_dtype)
+        if self.embedding is not None:
+            return np.asarray(self.embedding, dtype=np.float32)
+        return None
+
+    def set_vector(self, vector, dtype='float32'):
+        """Store an embedding in packed form and drop any legacy JSON copy"""
+        self.embedding_blob = pack_embedding(vector, dtype)
+        self.embedding_dtype = dtype
+        self.embedding = None
+
 
 class ChatAttachment(models.Model):
     """Files attached to chat messages - links documents to conversations"""
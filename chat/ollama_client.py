@@ -1,133 +1,357 @@
+import asyncio
 import requests
 import json
-import os
 import logging
+import threading
+import weakref
+from collections import namedtuple
+from typing import Union
+
+import httpx
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .admission import QueueTimeout, get_admission_controller
+from .prompting import build_chat_messages
+
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
+# Streamed in place of the answer when the Ollama request fails
+ERROR_PREFIX = "⚠️ Error: "
 
 
-def get_ai_response_stream(messages, context=None):
-    """Stream response from AI Model (Llama 3.3 70b) with BSC branding, chat history, and optional RAG context"""
-    # System message that enforces brand identity and behavior
-    system_message = (
-        "You are an AI assistant developed by BSC (Broadband Systems Corporation) "
-        "in Rwanda to support digital innovation and national transformation. "
-        "You were created entirely by BSC's engineering team and do not mention Meta, Llama, Phi, Microsoft, "
-        "or any other external AI models or companies. "
-        "Always refer to yourself as 'AI assistant' or 'I, the AI assistant'. "
-        "Keep responses professional, helpful, and grounded in facts. "
-        "If asked about your origin, say: 'I was developed by BSC in Rwanda to advance local AI capabilities.' "
-    )
+class OllamaClient:
+    """
+    Ollama HTTP client over one pooled keep-alive session.
 
-    if context:
-        # Check if it's web search results or document context
-        # The context comes wrapped with [Real-time Data]: prefix from _combine_contexts
-        is_realtime = "[Real-time Data]" in context or "[Web Search Results" in context
-        print(f"[DEBUG] Context type detection - is_realtime: {is_realtime}")
-        
-        if is_realtime:
-            system_message += (
-                "\n\n**CRITICAL INSTRUCTION**: I am providing you with REAL-TIME DATA from a web search. "
-                "You MUST use this information to answer the user's question accurately. "
-                "Do NOT say you don't have real-time data - USE THE DATA PROVIDED BELOW. "
-                "Always cite the source when answering.\n\n"
-                "=== REAL-TIME SEARCH RESULTS ===\n"
-                f"{context}\n"
-                "=== END SEARCH RESULTS ===\n\n"
-                "Based on the search results above, answer the user's question directly and accurately."
-            )
-        else:
-            # Document context (RAG)
-            system_message += (
-                "\n\n**CRITICAL INSTRUCTION**: The user has uploaded documents. "
-                "I am providing you with EXCERPTS from their uploaded documents below. "
-                "You MUST use this document content to answer the user's question. "
-                "Do NOT say you cannot access documents or PDFs - the document content is provided below. "
-                "Answer questions based on the document excerpts provided.\n\n"
-                "=== UPLOADED DOCUMENT CONTENT ===\n"
-                f"{context[:6000]}\n"
-                "=== END DOCUMENT CONTENT ===\n\n"
-                "Use the document content above to answer the user's question directly."
-            )
-
-    # Build full message list with system message first
-    chat_messages = [{"role": "system", "content": system_message}]
-    chat_messages.extend(messages)
-    
-    # Debug: Print what we're sending
-    print(f"[DEBUG] System message length: {len(system_message)}")
-    if context:
-        print(f"[DEBUG] Context preview: {context[:300]}...")
-    
-    try:
-        base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-        print(f"[DEBUG] Ollama Base URL: {base_url}")
-        response = requests.post(
-            f"{base_url}/api/chat",
+    Connections to ``base_url`` are reused across requests and threads (up to
+    ``pool_size`` open at once). Connection failures are retried with
+    exponential backoff; a request that reached Ollama is never re-sent.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        keep_alive: str = "10m",
+        pool_size: int = 16,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 120.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=backoff,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _post_chat(self, messages, stream, model=None, options=None, timeout=None):
+        response = self.session.post(
+            f"{self.base_url}/api/chat",
             json={
-                "model": "llama3.3:70b",
-                "messages": chat_messages,
-                "stream": True,
-                "keep_alive": "10m",
-                "options": {
-                    "temperature": 0.1,
-                    "top_p": 0.95,
-                    "num_predict": -1,
-                    "num_ctx": 8192,
-                }
+                "model": model or self.model,
+                "messages": messages,
+                "stream": stream,
+                "keep_alive": self.keep_alive,
+                "options": options or {},
             },
-            stream=True,
-            timeout=120
+            stream=stream,
+            timeout=timeout or self.timeout,
+        )
+        response.raise_for_status()
+        return response
+
+    def chat(self, messages, model=None, options=None, timeout=None) -> dict:
+        """Non-streaming /api/chat call; returns the parsed JSON response."""
+        return self._post_chat(messages, False, model, options, timeout).json()
+
+    def chat_stream(self, messages, model=None, options=None, timeout=None):
+        """Yield message content pieces from a streaming /api/chat call."""
+        response = self._post_chat(messages, True, model, options, timeout)
+        try:
+            for line in response.iter_lines():
+                if line:
+                    try:
+                        data = json.loads(line)
+                        if "message" in data and "content" in data["message"]:
+                            yield data["message"]["content"]
+                    except ValueError:
+                        continue
+        finally:
+            # Returns the connection to the pool once the body is consumed
+            response.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_ollama_client() -> OllamaClient:
+    """The process-wide Ollama client, created on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OllamaClient(
+                    base_url=getattr(settings, 'OLLAMA_BASE_URL', 'http://localhost:11434'),
+                    model=getattr(settings, 'OLLAMA_MODEL', 'llama3.3:70b'),
+                    keep_alive=getattr(settings, 'OLLAMA_KEEP_ALIVE', '10m'),
+                    pool_size=getattr(settings, 'OLLAMA_POOL_SIZE', 16),
+                    connect_timeout=getattr(settings, 'OLLAMA_CONNECT_TIMEOUT', 5.0),
+                    read_timeout=getattr(settings, 'OLLAMA_READ_TIMEOUT', 120.0),
+                    retries=getattr(settings, 'OLLAMA_RETRIES', 2),
+                    backoff=getattr(settings, 'OLLAMA_RETRY_BACKOFF', 0.5),
+                )
+    return _client
+
+
+class AsyncOllamaClient:
+    """
+    asyncio counterpart of ``OllamaClient`` on an ``httpx.AsyncClient``, for
+    the ASGI streaming endpoint. A stream waiting for a free connection
+    queues instead of failing.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        keep_alive: str = "10m",
+        pool_size: int = 16,
+        max_connections: int = 256,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 120.0,
+        retries: int = 2,
+    ):
+        self.model = model
+        self.keep_alive = keep_alive
+        transport = httpx.AsyncHTTPTransport(
+            retries=retries,  # connection failures only
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=pool_size),
+        )
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            transport=transport,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None),
+        )
+
+    async def chat_stream(self, messages, model=None, options=None):
+        """Yield message content pieces from a streaming /api/chat call."""
+        payload = {
+            "model": model or self.model,
+            "messages": messages,
+            "stream": True,
+            "keep_alive": self.keep_alive,
+            "options": options or {},
+        }
+        async with self.client.stream("POST", "/api/chat", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    try:
+                        data = json.loads(line)
+                        if "message" in data and "content" in data["message"]:
+                            yield data["message"]["content"]
+                    except ValueError:
+                        continue
+
+
+# httpx clients are bound to the event loop they were first used on
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_ollama_client() -> AsyncOllamaClient:
+    """The Ollama client for the running event loop, created on first use."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncOllamaClient(
+            base_url=getattr(settings, 'OLLAMA_BASE_URL', 'http://localhost:11434'),
+            model=getattr(settings, 'OLLAMA_MODEL', 'llama3.3:70b'),
+            keep_alive=getattr(settings, 'OLLAMA_KEEP_ALIVE', '10m'),
+            pool_size=getattr(settings, 'OLLAMA_POOL_SIZE', 16),
+            max_connections=getattr(settings, 'OLLAMA_ASYNC_MAX_CONNECTIONS', 256),
+            connect_timeout=getattr(settings, 'OLLAMA_CONNECT_TIMEOUT', 5.0),
+            read_timeout=getattr(settings, 'OLLAMA_READ_TIMEOUT', 120.0),
+            retries=getattr(settings, 'OLLAMA_RETRIES', 2),
+        )
+    return client
+
+
+# Model registry: which model and sampling options serve each kind of task.
+# Models come from OLLAMA_TASK_MODELS (falling back to OLLAMA_MODEL) and the
+# options below can be overridden per task through OLLAMA_TASK_OPTIONS.
+ModelProfile = namedtuple('ModelProfile', ['model', 'options', 'timeout'])
+
+TASK_CHAT = 'chat'
+TASK_TOOL_ROUTING = 'tool_routing'
+TASK_SUMMARIZATION = 'summarization'
+TASK_TITLE = 'title'
+
+TASK_OPTIONS = {
+    TASK_CHAT: {"temperature": 0.1, "top_p": 0.95, "num_predict": -1},
+    TASK_TOOL_ROUTING: {"temperature": 0.0, "top_p": 0.9, "num_predict": 512, "num_ctx": 4096},
+    TASK_SUMMARIZATION: {"temperature": 0.2, "top_p": 0.9, "num_predict": 512, "num_ctx": 8192},
+    TASK_TITLE: {"temperature": 0.3, "top_p": 0.9, "num_predict": 24, "num_ctx": 2048},
+}
+
+# Read timeouts (seconds) for the non-streaming tasks; None uses OLLAMA_READ_TIMEOUT
+TASK_TIMEOUTS = {
+    TASK_CHAT: None,
+    TASK_TOOL_ROUTING: 60,
+    TASK_SUMMARIZATION: None,
+    TASK_TITLE: 30,
+}
+
+
+def get_model_profile(task: str, model=None, options=None) -> ModelProfile:
+    """
+    Model, sampling options and read timeout for ``task``. ``model`` and
+    ``options`` are per-call overrides on top of the configured profile.
+    """
+    if task not in TASK_OPTIONS:
+        raise ValueError(f"Unknown LLM task '{task}'")
+    task_options = dict(TASK_OPTIONS[task])
+    if task == TASK_CHAT:
+        # Prompts are budgeted against OLLAMA_NUM_CTX (see prompting)
+        task_options["num_ctx"] = getattr(settings, 'OLLAMA_NUM_CTX', 8192)
+    task_options.update(getattr(settings, 'OLLAMA_TASK_OPTIONS', {}).get(task, {}))
+    task_options.update(options or {})
+    if model is None:
+        model = getattr(settings, 'OLLAMA_TASK_MODELS', {}).get(task) or getattr(settings, 'OLLAMA_MODEL', 'llama3.3:70b')
+    timeout = TASK_TIMEOUTS[task] or getattr(settings, 'OLLAMA_READ_TIMEOUT', 120.0)
+    return ModelProfile(model, task_options, timeout)
+
+
+def get_ai_response_stream(messages, context=None, model=None, options=None,
+                           ticket=None, user_id=None, priority='interactive'):
+    """
+    Stream response from the chat model (``OLLAMA_TASK_MODELS['chat']``).
+
+    ``messages`` normally come from ``prompting.build_chat_messages`` and
+    already start with the BSC system prompt. Plain history (optionally with a
+    legacy ``context`` string) is assembled through the same prompt builder.
+    ``model`` and ``options`` override the chat profile's model and sampling
+    options for this call.
+
+    Generation waits for an admission slot (see ``admission``) as
+    ``user_id`` at ``priority``, unless the caller passes an already
+    admitted ``ticket``, which it keeps and releases itself.
+    """
+    if messages and messages[0].get("role") == "system":
+        chat_messages = messages
+    else:
+        documents, realtime_context = (), ''
+        if context:
+            if "[Real-time Data]" in context or "[Web Search Results" in context:
+                realtime_context = context
+            else:
+                documents = [context]
+        history = list(messages[:-1]) if messages else []
+        question = messages[-1]["content"] if messages else ""
+        chat_messages, _ = build_chat_messages(
+            history, question, documents=documents, realtime_context=realtime_context
         )
-        
-        for line in response.iter_lines():
-            if line:
-                try:
-                    data = json.loads(line)
-                    if "message" in data and "content" in data["message"]:
-                        yield data["message"]["content"]
-                except:
-                    continue
+
+    profile = get_model_profile(TASK_CHAT, model, options)
+    try:
+        if ticket is None:
+            with get_admission_controller(profile.model).admit(user_id, priority):
+                yield from get_ollama_client().chat_stream(chat_messages, model=profile.model, options=profile.options)
+        else:
+            yield from get_ollama_client().chat_stream(chat_messages, model=profile.model, options=profile.options)
     except Exception as e:
-        print(f"[ERROR] Ollama Request Failed: {str(e)}")
-        yield f"⚠️ Error: {str(e)}"
+        logger.error(f"Ollama Request Failed: {e}")
+        yield f"{ERROR_PREFIX}{str(e)}"
+
 
-def get_ai_response(messages, context=None):
+async def aget_ai_response_stream(messages, model=None, options=None,
+                                  ticket=None, user_id=None, priority='interactive'):
+    """
+    Async version of ``get_ai_response_stream`` for prompts already built by
+    ``prompting.build_chat_messages`` (system message first).
+    """
+    profile = get_model_profile(TASK_CHAT, model, options)
+    try:
+        if ticket is None:
+            async with get_admission_controller(profile.model).aadmit(user_id, priority):
+                async for chunk in get_async_ollama_client().chat_stream(
+                    messages, model=profile.model, options=profile.options
+                ):
+                    yield chunk
+        else:
+            async for chunk in get_async_ollama_client().chat_stream(
+                messages, model=profile.model, options=profile.options
+            ):
+                yield chunk
+    except Exception as e:
+        logger.error(f"Ollama Request Failed: {e}")
+        yield f"{ERROR_PREFIX}{str(e)}"
+
+def get_ai_response(messages, context=None, model=None, options=None, user_id=None, priority='interactive'):
     """Get full response from AI Model (non-streaming wrapper)"""
     full_response = ""
-    for chunk in get_ai_response_stream(messages, context):
+    for chunk in get_ai_response_stream(messages, context, model=model, options=options,
+                                        user_id=user_id, priority=priority):
         full_response += chunk
     return full_response
 
 
-def _ollama_chat(messages, stream: bool, options: dict, timeout: int = 120) -> dict:
+def _ollama_chat(messages, stream: bool, task: str = TASK_CHAT, options: dict = None, timeout: int = None,
+                 model=None, user_id=None, priority=None, deadline=None) -> Union[dict, requests.Response]:
     """
-    Low-level helper to call Ollama /api/chat.
-    When stream=False, returns the parsed JSON response.
+    Low-level helper to call Ollama /api/chat on the pooled client with the
+    registry profile for ``task``, holding an admission slot for the
+    duration of the call. The slot comes from the pool of the profile's
+    model; ``priority`` defaults to ``task`` for everything but chat, so
+    short calls queue ahead of answers. ``options``, ``timeout`` and
+    ``model`` override the profile. With a ``deadline`` (e.g. a
+    ``context_gathering.SourceDeadline``) the slot is given up once it
+    expires and the read timeout is capped to the time left.
+    When stream=False, returns the parsed JSON response; otherwise the
+    streamed response, read to the end before the slot is released.
     """
-    base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-    response = requests.post(
-        f"{base_url}/api/chat",
-        json={
-            "model": "llama3.3:70b",
-            "messages": messages,
-            "stream": stream,
-            "keep_alive": "10m",
-            "options": options,
-        },
-        stream=stream,
-        timeout=timeout,
-    )
-    response.raise_for_status()
-    return response.json()
+    client = get_ollama_client()
+    profile = get_model_profile(task, model, options)
+    timeout = (client.timeout[0], timeout or profile.timeout)
+    if priority is None:
+        priority = 'interactive' if task == TASK_CHAT else 'task'
+    cancelled = (lambda: deadline.expired) if deadline is not None else None
+    with get_admission_controller(profile.model).admit(user_id, priority, cancelled=cancelled):
+        if deadline is not None:
+            if deadline.expired:
+                raise QueueTimeout('Deadline passed before an LLM slot was free')
+            timeout = (timeout[0], min(timeout[1], deadline.remaining()))
+        if stream:
+            response = client._post_chat(messages, True, profile.model, profile.options, timeout)
+            response.content  # consume the stream while the slot is held
+            return response
+        return client.chat(messages, model=profile.model, options=profile.options, timeout=timeout)
 
 
-def get_web_tool_call(user_message: str) -> dict:
+def get_web_tool_call(user_message: str, user_id=None, deadline=None) -> dict:
     """
-    Ask the model to decide which Tavily tool (if any) to run.
+    Ask the model to decide which Tavily tool (if any) to run, giving up at
+    ``deadline`` (see ``_ollama_chat``).
 
     Returns a dict with shape:
       {"tool": "none"} OR {"tool": "tavily.search"|"tavily.extract"|"tavily.crawl"|"tavily.map"|"tavily.research", "args": {...}}
+    When routing itself fails the result is {"tool": "none", "error": "..."}.
     """
     routing_system = (
         "You are a tool router. You decide whether to call Tavily web tools.\n"
@@ -159,13 +383,9 @@ def get_web_tool_call(user_message: str) -> dict:
         data = _ollama_chat(
             messages=messages,
             stream=False,
-            options={
-                "temperature": 0.0,
-                "top_p": 0.9,
-                "num_predict": 512,
-                "num_ctx": 4096,
-            },
-            timeout=60,
+            task=TASK_TOOL_ROUTING,
+            user_id=user_id,
+            deadline=deadline,
         )
         content = (data.get("message") or {}).get("content") or ""
 
@@ -181,5 +401,5 @@ def get_web_tool_call(user_message: str) -> dict:
             return {"tool": "none"}
         return tool_call
     except Exception as e:
-        print(f"[WARN] Web tool routing failed: {e}")
-        return {"tool": "none"}
\ No newline at end of file
+        logger.warning(f"Web tool routing failed: {e}")
+        return {"tool": "none", "error": str(e)}
\ No newline at end of file
@@ -0,0 +1,263 @@
+"""
+Token-budgeted prompt assembly for the chat model.
+
+Every chat request goes through ``build_chat_messages``, which lays out:
+
+1. the fixed system prompt (identical on every request, so Ollama can reuse
+   its cached prefix),
+2. as much recent history as fits, newest first,
+3. one final user turn holding the retrieved context followed by the question.
+
+Retrieved context appears exactly once. Sizes are measured in tokens of the
+chat model's tokenizer (``LLM_TOKENIZER_PATH``, a Hugging Face
+``tokenizer.json``) and must fit within ``num_ctx`` minus the room reserved
+for the answer. Without a tokenizer file the counts are a conservative
+characters-per-token estimate.
+"""
+import logging
+import math
+import threading
+from collections import namedtuple
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = (
+    "You are an AI assistant developed by BSC (Broadband Systems Corporation) "
+    "in Rwanda to support digital innovation and national transformation. "
+    "You were created entirely by BSC's engineering team and do not mention Meta, Llama, Phi, Microsoft, "
+    "or any other external AI models or companies. "
+    "Always refer to yourself as 'AI assistant' or 'I, the AI assistant'. "
+    "Keep responses professional, helpful, and grounded in facts. "
+    "If asked about your origin, say: 'I was developed by BSC in Rwanda to advance local AI capabilities.' "
+)
+
+REALTIME_HEADER = (
+    "**CRITICAL INSTRUCTION**: I am providing you with REAL-TIME DATA from a web search. "
+    "You MUST use this information to answer the user's question accurately. "
+    "Do NOT say you don't have real-time data - USE THE DATA PROVIDED BELOW. "
+    "Always cite the source when answering.\n\n"
+    "=== REAL-TIME SEARCH RESULTS ===\n"
+)
+REALTIME_FOOTER = "\n=== END SEARCH RESULTS ==="
+
+DOCUMENT_HEADER = (
+    "**CRITICAL INSTRUCTION**: The user has uploaded documents. "
+    "I am providing you with EXCERPTS from their uploaded documents below. "
+    "You MUST use this document content to answer the user's question. "
+    "Do NOT say you cannot access documents or PDFs - the document content is provided below. "
+    "Answer questions based on the document excerpts provided.\n\n"
+    "=== UPLOADED DOCUMENT CONTENT ===\n"
+)
+DOCUMENT_FOOTER = "\n=== END DOCUMENT CONTENT ==="
+
+QUESTION_HEADER = "Using the content above, answer the user's question directly:\n"
+
+# Role header and end-of-turn tokens the chat template adds per message
+MESSAGE_OVERHEAD_TOKENS = 5
+
+# Below this, a truncated history message or web result is not worth sending
+MIN_USEFUL_TOKENS = 48
+
+PromptStats = namedtuple('PromptStats', 'system history context question total budget dropped_chunks')
+
+
+class TokenCounter:
+    """Counts and truncates text in chat-model tokens."""
+
+    # Llama 3 averages ~4 characters per token on English; estimate low so
+    # estimated prompts stay inside the real context window.
+    CHARS_PER_TOKEN = 3.2
+
+    def __init__(self, tokenizer_path: str = ''):
+        self._tokenizer = None
+        if tokenizer_path:
+            try:
+                from tokenizers import Tokenizer
+
+                self._tokenizer = Tokenizer.from_file(tokenizer_path)
+                self._tokenizer.no_truncation()
+            except Exception as e:
+                logger.error(f"Could not load chat tokenizer {tokenizer_path}, estimating tokens: {e}")
+
+    @property
+    def exact(self) -> bool:
+        return self._tokenizer is not None
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._tokenizer is None:
+            return math.ceil(len(text) / self.CHARS_PER_TOKEN)
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Longest prefix of ``text`` within ``max_tokens`` tokens."""
+        if max_tokens <= 0:
+            return ''
+        if self._tokenizer is None:
+            return text[:int(max_tokens * self.CHARS_PER_TOKEN)]
+        offsets = self._tokenizer.encode(text, add_special_tokens=False).offsets
+        if len(offsets) <= max_tokens:
+            return text
+        return text[:offsets[max_tokens - 1][1]]
+
+
+_counter = None
+_counter_lock = threading.Lock()
+
+
+def get_token_counter() -> TokenCounter:
+    global _counter
+    if _counter is None:
+        with _counter_lock:
+            if _counter is None:
+                _counter = TokenCounter(getattr(settings, 'LLM_TOKENIZER_PATH', ''))
+    return _counter
+
+
+def format_document_results(results: Iterable[dict]) -> List[str]:
+    """One citation-labelled block per retrieved chunk, best first."""
+    blocks = []
+    for result in results:
+        source = result['document_title']
+        if result.get('page_number'):
+            source += f", page {result['page_number']}"
+        blocks.append(f"[From: {source}]\n{result['content']}\n---")
+    return blocks
+
+
+def load_history(conversation, limit: Optional[int] = None) -> List[dict]:
+    """
+    Earlier turns of a conversation, oldest first, excluding the user message
+    that was just saved for the current request.
+    """
+    from .models import ChatMessage
+
+    limit = limit or getattr(settings, 'PROMPT_HISTORY_MESSAGES', 3)
+    recent = list(
+        ChatMessage.objects.filter(conversation=conversation)
+        .order_by('-timestamp')
+        .values_list('is_user_message', 'content')[:limit + 1]
+    )[1:]
+    return [
+        {"role": "user" if is_user else "assistant", "content": content}
+        for is_user, content in reversed(recent)
+    ]
+
+
+def build_chat_messages(
+    history: List[dict],
+    question: str,
+    documents: Iterable[str] = (),
+    realtime_context: str = '',
+    num_ctx: Optional[int] = None,
+):
+    """
+    Assemble the message list for one chat turn within the token budget.
+
+    ``documents`` are pre-formatted context blocks in rank order (see
+    ``format_document_results``); whole blocks are dropped from the end when
+    they do not fit. ``realtime_context`` (web, weather, stock data) is
+    truncated instead. Returns ``(messages, PromptStats)``.
+    """
+    counter = get_token_counter()
+    num_ctx = num_ctx or getattr(settings, 'OLLAMA_NUM_CTX', 8192)
+    budget = num_ctx - getattr(settings, 'PROMPT_RESPONSE_TOKENS', 1024)
+
+    def cost(text):
+        return counter.count(text) + MESSAGE_OVERHEAD_TOKENS
+
+    system_tokens = cost(SYSTEM_PROMPT)
+    remaining = budget - system_tokens
+
+    # The question always goes in; only a pathological one is cut
+    question_tokens = cost(question)
+    if question_tokens > remaining // 2:
+        question = counter.truncate(question, remaining // 2 - MESSAGE_OVERHEAD_TOKENS)
+        question_tokens = cost(question)
+    remaining -= question_tokens
+
+    # Retrieved context next: it is what the answer depends on
+    context_share = getattr(settings, 'PROMPT_CONTEXT_SHARE', 0.75)
+    context_budget = int(remaining * context_share)
+    sections = []
+    context_tokens = 0
+
+    if realtime_context:
+        frame = counter.count(REALTIME_HEADER + REALTIME_FOOTER)
+        allowed = context_budget - frame
+        if allowed >= MIN_USEFUL_TOKENS:
+            body = counter.truncate(realtime_context, allowed)
+            sections.append(REALTIME_HEADER + body + REALTIME_FOOTER)
+            context_tokens += frame + counter.count(body)
+
+    documents = list(documents)
+    kept = []
+    if documents:
+        frame = counter.count(DOCUMENT_HEADER + DOCUMENT_FOOTER)
+        used = frame
+        for block in documents:
+            block_tokens = counter.count(block + "\n\n")
+            if context_tokens + used + block_tokens > context_budget:
+                break
+            kept.append(block)
+            used += block_tokens
+        if kept:
+            sections.append(DOCUMENT_HEADER + "\n\n".join(kept) + DOCUMENT_FOOTER)
+            context_tokens += used
+    dropped = len(documents) - len(kept)
+
+    if sections:
+        content = "\n\n".join(sections) + "\n\n" + QUESTION_HEADER + question
+        # The question turn also carries the separators and QUESTION_HEADER
+        question_tokens = cost(content) - context_tokens
+    else:
+        content = question
+    remaining = budget - system_tokens - question_tokens - context_tokens
+
+    # History last, newest first, with whatever is left
+    kept_history = []
+    history_tokens = 0
+    for message in reversed(history):
+        message_tokens = cost(message['content'])
+        if history_tokens + message_tokens > remaining:
+            room = remaining - history_tokens - MESSAGE_OVERHEAD_TOKENS
+            if room >= MIN_USEFUL_TOKENS:
+                # Keep the start of the oldest turn that partly fits
+                kept_history.append({
+                    "role": message['role'],
+                    "content": counter.truncate(message['content'], room),
+                })
+                history_tokens += room + MESSAGE_OVERHEAD_TOKENS
+            break
+        kept_history.append(message)
+        history_tokens += message_tokens
+    kept_history.reverse()
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    messages.extend(kept_history)
+    messages.append({"role": "user", "content": content})
+
+    stats = PromptStats(
+        system=system_tokens,
+        history=history_tokens,
+        context=context_tokens,
+        question=question_tokens,
+        total=system_tokens + history_tokens + context_tokens + question_tokens,
+        budget=budget,
+        dropped_chunks=dropped,
+    )
+    metrics.increment('prompt.requests')
+    metrics.increment('prompt.tokens', stats.total)
+    metrics.increment('prompt.context_chunks_dropped', dropped)
+    logger.info(
+        f"Prompt tokens{'' if counter.exact else ' (estimated)'}: system={stats.system} "
+        f"history={stats.history} ({len(kept_history)}/{len(history)} msgs) context={stats.context} "
+        f"question={stats.question} total={stats.total}/{budget}"
+    )
+    return messages, stats
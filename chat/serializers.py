@@ -61,8 +61,8 @@ class ChatMessageSerializer(serializers.ModelSerializer):
     """Serializer for individual chat messages"""
     class Meta:
         model = ChatMessage
-        fields = ['id', 'is_user_message', 'content', 'timestamp']
-        read_only_fields = ['id', 'timestamp']
+        fields = ['id', 'is_user_message', 'content', 'timestamp', 'interrupted']
+        read_only_fields = ['id', 'timestamp', 'interrupted']
 
 
 class DocumentSerializer(serializers.ModelSerializer):
@@ -71,8 +71,11 @@ class DocumentSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Document
-        fields = ['id', 'title', 'file_type', 'uploaded_at', 'processed', 'file_url']
-        read_only_fields = ['id', 'uploaded_at', 'processed', 'file_type', 'file_url']
+        fields = [
+            'id', 'title', 'file_type', 'uploaded_at', 'processed',
+            'status', 'progress', 'chunk_count', 'total_chunks', 'file_url',
+        ]
+        read_only_fields = fields
     
     def get_file_url(self, obj):
         request = self.context.get('request')
@@ -0,0 +1,44 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from . import keyword_index, vector_index
+from .models import Document
+
+
+@receiver(post_delete, sender=Document)
+def drop_deleted_document_from_index(sender, instance, **kwargs):
+    """Keep the resident vector index in step with document deletes."""
+    vector_index.remove_document(instance.user_id, instance.id)
+
+
+@receiver(post_save, sender=Document)
+def drop_unprocessed_document_from_index(sender, instance, created, **kwargs):
+    """A document that is not ready must not be served from stale rows."""
+    if not created and not instance.processed:
+        vector_index.remove_document(instance.user_id, instance.id)
+
+
+@receiver(post_delete, sender=Document)
+def delete_unreferenced_file(sender, instance, **kwargs):
+    """
+    Uploads with identical content share one stored file, so it is removed
+    only when the last document referencing it is gone (and only once the
+    delete has committed).
+    """
+    name = instance.file.name
+    if not name:
+        return
+
+    def delete_if_unreferenced():
+        if not Document.objects.filter(file=name).exists():
+            instance.file.storage.delete(name)
+
+    transaction.on_commit(delete_if_unreferenced)
+
+
+@receiver(post_migrate)
+def repair_keyword_index(sender, using, **kwargs):
+    """Table rebuilds during SQLite migrations drop the FTS5 triggers."""
+    if sender.name == 'chat':
+        keyword_index.repair_sqlite_triggers(using)
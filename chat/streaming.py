@@ -0,0 +1,293 @@
+"""
+Server-Sent Events stream of one chat answer.
+
+``AnswerStream`` is shared by the web chat view and the sync and async API
+views. It produces the frames those endpoints send:
+
+- ``{"status": "started", "conversation_id": n}`` straight away,
+- ``{"status": "routing" | "searching_web" | "retrieving_documents"}`` while
+  the context sources run (when the view hands over ``sources``),
+- ``{"status": "queued", "position": n}`` while waiting for a generation slot
+  (only when the slot is not free straight away),
+- ``{"status": "generating"}`` once the model starts, with ``"missing"``
+  listing context sources that timed out or failed, and ``"cached": true``
+  when the answer is replayed from ``answer_cache`` instead,
+- ``{"chunk": "..."}`` with the answer text, coalesced by ``ChunkCoalescer``,
+- ``{"chart_data": {...}}`` when there is one,
+- ``{"done": true, "conversation_id": n}``, with ``"interrupted": true`` when
+  the answer was cancelled,
+- or ``{"error": "..."}``.
+
+Idle stretches before generation are filled with ``: keep-alive`` comments.
+
+It saves the assistant message, including partial answers when the client
+disconnects or the generation is cancelled.
+"""
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+
+from . import answer_cache, generation as generations
+from .admission import get_admission_controller
+from .context_gathering import ContextGathering
+from .models import ChatMessage
+from .ollama_client import aget_ai_response_stream, get_ai_response_stream
+from .sse import HEARTBEAT, ChunkCoalescer, Heartbeat
+
+logger = logging.getLogger(__name__)
+
+# Seconds between cancel checks while context is gathered
+GATHER_TICK = 0.25
+
+
+def _frame(data: dict) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+
+class AnswerStream:
+    """
+    Either pass ready ``messages`` (and ``chart_data``), or context
+    ``sources`` (see ``context_gathering``) plus ``build(context)`` returning
+    ``(messages, chart_data)``; the sources then run inside the stream, after
+    the response has been opened.
+    """
+
+    def __init__(self, conversation, user, messages=None, chart_data=None, priority='interactive',
+                 sources=None, build=None):
+        self.conversation = conversation
+        self.user = user
+        self.messages = messages
+        self.chart_data = chart_data
+        self.priority = priority
+        self.sources = sources
+        self.build = build
+        self.missing = []
+
+    def _message(self, content, interrupted):
+        # An interrupted answer is kept only if something was generated
+        if interrupted and not content:
+            return None
+        return dict(
+            conversation=self.conversation,
+            user=self.user,
+            is_user_message=False,
+            content=content,
+            interrupted=interrupted,
+        )
+
+    def _save(self, content, interrupted):
+        fields = self._message(content, interrupted)
+        if fields:
+            ChatMessage.objects.create(**fields)
+
+    async def _asave(self, content, interrupted):
+        fields = self._message(content, interrupted)
+        if fields:
+            await ChatMessage.objects.acreate(**fields)
+
+    def _use_context(self, context):
+        self.messages, self.chart_data = self.build(context)
+        self.missing = context.timed_out + context.failed
+
+    def _generating_frame(self, cached=False):
+        status = {'status': 'generating'}
+        if self.missing:
+            status['missing'] = self.missing
+        if cached:
+            status['cached'] = True
+        return _frame(status)
+
+    def _closing_frames(self, interrupted):
+        if self.chart_data and not interrupted:
+            # Optionally send chart data for the client to render
+            yield _frame({'chart_data': self.chart_data})
+        done = {'done': True, 'conversation_id': self.conversation.id}
+        if interrupted:
+            done['interrupted'] = True
+        yield _frame(done)
+
+    def frames(self):
+        parts = []
+        coalescer = ChunkCoalescer()
+        heartbeat = Heartbeat()
+        interrupted = saved = False
+        generation = generations.start(self.conversation.id)
+        ticket = gathering = None
+        try:
+            yield _frame({'status': 'started', 'conversation_id': self.conversation.id})
+
+            # Gather context inside the stream, reporting each stage
+            if self.sources is not None:
+                gathering = ContextGathering(self.sources)
+                for stage in gathering.events(tick=GATHER_TICK):
+                    if generation.cancelled:
+                        interrupted = True
+                        break
+                    if stage:
+                        heartbeat.sent()
+                        yield _frame({'status': stage})
+                    elif heartbeat.due():
+                        yield HEARTBEAT
+                if not interrupted:
+                    self._use_context(gathering.result())
+
+            cached = cache_key = None
+            if not interrupted:
+                cache_key = answer_cache.cache_key(self.messages, self.conversation.chat_type)
+                cached = answer_cache.lookup(cache_key)
+            if cached is not None:
+                # Replayed without queueing for the model
+                yield self._generating_frame(cached=True)
+                for text in answer_cache.replay(cached):
+                    parts.append(text)
+                    yield _frame({'chunk': text})
+
+            # Wait for a generation slot, reporting the queue position
+            elif not interrupted:
+                ticket = get_admission_controller().enqueue(self.user.id, self.priority)
+                last_position = None
+                for position in ticket.wait():
+                    if generation.cancelled:
+                        interrupted = True
+                        break
+                    if position != last_position:
+                        last_position = position
+                        heartbeat.sent()
+                        yield _frame({'status': 'queued', 'position': position})
+                    elif heartbeat.due():
+                        yield HEARTBEAT
+
+            if cached is None and not interrupted:
+                yield self._generating_frame()
+                stream = get_ai_response_stream(self.messages, ticket=ticket)
+                try:
+                    for chunk in stream:
+                        if generation.cancelled:
+                            interrupted = True
+                            break
+                        parts.append(chunk)
+                        text = coalescer.push(chunk)
+                        if text:
+                            yield _frame({'chunk': text})
+                finally:
+                    # Closes the Ollama response at once, which stops generation
+                    stream.close()
+                text = coalescer.flush()
+                if text:
+                    yield _frame({'chunk': text})
+                if not interrupted:
+                    answer_cache.store(cache_key, ''.join(parts))
+
+            self._save(''.join(parts), interrupted)
+            saved = True
+            yield from self._closing_frames(interrupted)
+
+        except GeneratorExit:
+            # Client disconnected; keep what was generated so far
+            if not saved:
+                self._save(''.join(parts), True)
+            raise
+        except Exception as e:
+            logger.error(f"Chat stream failed: {e}")
+            yield _frame({'error': str(e)})
+        finally:
+            if gathering is not None:
+                # Sources still running after a cancel or disconnect give up
+                gathering.cancel()
+            if ticket is not None:
+                ticket.release()
+            generations.finish(generation)
+
+    async def aframes(self):
+        parts = []
+        coalescer = ChunkCoalescer()
+        heartbeat = Heartbeat()
+        interrupted = saved = False
+        generation = generations.start(self.conversation.id)
+        ticket = gathering = None
+        try:
+            yield _frame({'status': 'started', 'conversation_id': self.conversation.id})
+
+            if self.sources is not None:
+                gathering = ContextGathering(self.sources, asyncio.get_running_loop())
+                async for stage in gathering.aevents(tick=GATHER_TICK):
+                    if await generation.acancelled():
+                        interrupted = True
+                        break
+                    if stage:
+                        heartbeat.sent()
+                        yield _frame({'status': stage})
+                    elif heartbeat.due():
+                        yield HEARTBEAT
+                if not interrupted:
+                    # Prompt assembly reads the conversation history
+                    await sync_to_async(self._use_context)(gathering.result())
+
+            cached = cache_key = None
+            if not interrupted:
+                # Embedding the question is CPU work; keep it off the event loop
+                cache_key = await sync_to_async(answer_cache.cache_key, thread_sensitive=False)(
+                    self.messages, self.conversation.chat_type
+                )
+                cached = answer_cache.lookup(cache_key)
+            if cached is not None:
+                yield self._generating_frame(cached=True)
+                for text in answer_cache.replay(cached):
+                    parts.append(text)
+                    yield _frame({'chunk': text})
+
+            elif not interrupted:
+                ticket = await get_admission_controller().aenqueue(self.user.id, self.priority)
+                last_position = None
+                async for position in ticket.await_positions():
+                    if await generation.acancelled():
+                        interrupted = True
+                        break
+                    if position != last_position:
+                        last_position = position
+                        heartbeat.sent()
+                        yield _frame({'status': 'queued', 'position': position})
+                    elif heartbeat.due():
+                        yield HEARTBEAT
+
+            if cached is None and not interrupted:
+                yield self._generating_frame()
+                stream = aget_ai_response_stream(self.messages, ticket=ticket)
+                try:
+                    async for chunk in stream:
+                        if await generation.acancelled():
+                            interrupted = True
+                            break
+                        parts.append(chunk)
+                        text = coalescer.push(chunk)
+                        if text:
+                            yield _frame({'chunk': text})
+                finally:
+                    await stream.aclose()
+                text = coalescer.flush()
+                if text:
+                    yield _frame({'chunk': text})
+                if not interrupted:
+                    answer_cache.store(cache_key, ''.join(parts))
+
+            await self._asave(''.join(parts), interrupted)
+            saved = True
+            for frame in self._closing_frames(interrupted):
+                yield frame
+
+        except asyncio.CancelledError:
+            # Django cancels the response task when the client disconnects
+            if not saved:
+                await self._asave(''.join(parts), True)
+            raise
+        except Exception as e:
+            logger.error(f"Chat stream failed: {e}")
+            yield _frame({'error': str(e)})
+        finally:
+            if gathering is not None:
+                gathering.cancel()
+            if ticket is not None:
+                await ticket.arelease()
+            generations.finish(generation)
@@ -1,11 +1,12 @@
 from celery import shared_task
 from .ollama_client import get_ai_response
 from .models import ChatMessage
+from .document_service import process_document
 
 @shared_task
 def process_ai_response(user_id, message_id, messages):
     """Process AI response in background"""
-    ai_response = get_ai_response(messages)
+    ai_response = get_ai_response(messages, user_id=user_id, priority='background')
     
     # Save AI response
     ChatMessage.objects.create(
@@ -15,3 +16,15 @@ def process_ai_response(user_id, message_id, messages):
     )
     
     return ai_response
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def ingest_document(document_id):
+    """
+    Extract, chunk and embed an uploaded document in the background.
+
+    The message is acknowledged only after the task finishes, so if the
+    worker dies mid-run the broker redelivers it and process_document
+    resumes after the last committed chunk window.
+    """
+    return process_document(document_id)
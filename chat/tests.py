@@ -1,3 +1,1692 @@
-from django.test import TestCase
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
 
-# Create your tests here.
+import billiard
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (
+    admission, ann_index, answer_cache, document_service, embeddings, keyword_index, tool_routing,
+    vector_index, web_search,
+)
+from . import generation as generations
+from .admission import AdmissionController, QueueFull, QueueTimeout
+from .answer_cache import AnswerCache
+from .api_views import ChatMessageMixin
+from .chunking import iter_token_chunks
+from .context_gathering import ContextGathering, SourceDeadline
+from .embedding_server import MicroBatcher, RemoteBackend, make_server
+from .embeddings import EmbeddingBackend
+from .extractors import PdfExtractor
+from .models import (
+    ChatAttachment, ChatMessage, Conversation, Document, DocumentChunk, pack_embedding, unpack_embedding,
+)
+from .prompting import DOCUMENT_HEADER, SYSTEM_PROMPT, build_chat_messages, load_history
+from .sse import HEARTBEAT, ChunkCoalescer, Heartbeat
+from .streaming import AnswerStream
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def _word_offsets(text):
+    """One token per whitespace-separated word"""
+    return [(m.start(), m.end()) for m in re.finditer(r'\S+', text)]
+
+
+def _pdf_bytes(pages):
+    """A minimal PDF with one line of text per page."""
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for text in pages:
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'.encode()
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (len(objects))
+        )
+        kids.append(b'%d 0 R' % len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(kids), len(kids))
+    out, offsets = bytearray(b'%PDF-1.4\n'), []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _pdf_sections_in_daemon(path, results):
+    """Extract like a Celery prefork child, reporting whether the pool was used."""
+    with mock.patch.object(PdfExtractor, '_parallel_sections', autospec=True,
+                           side_effect=PdfExtractor._parallel_sections) as parallel:
+        pages = [section.page for section in PdfExtractor().sections(path)]
+    results.put((pages, parallel.called))
+
+
+
+class EmbeddingStorageTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='packer')
+        self.document = Document.objects.create(
+            user=user, title='a.txt', file_type='txt', status=Document.STATUS_READY
+        )
+        self.vector = np.array([0.1, -0.25, 0.5, 1.0], dtype=np.float32)
+
+    def test_float32_round_trips_exactly(self):
+        chunk = DocumentChunk(document=self.document, content='x', chunk_index=0)
+        chunk.set_vector(self.vector)
+        chunk.save()
+        stored = DocumentChunk.objects.get(id=chunk.id)
+        np.testing.assert_array_equal(stored.vector, self.vector)
+        self.assertEqual(len(stored.embedding_blob), 16)
+        self.assertIsNone(stored.embedding)
+
+    def test_float16_halves_the_storage(self):
+        blob = pack_embedding(self.vector, 'float16')
+        self.assertEqual(len(blob), 8)
+        np.testing.assert_allclose(unpack_embedding(blob, 'float16'), self.vector, atol=1e-3)
+
+    def test_legacy_json_rows_stay_readable(self):
+        chunk = DocumentChunk.objects.create(
+            document=self.document, content='x', chunk_index=0, embedding=self.vector.tolist()
+        )
+        np.testing.assert_allclose(chunk.vector, self.vector)
+
+    def test_convert_embeddings_packs_legacy_rows(self):
+        legacy = [
+            DocumentChunk.objects.create(
+                document=self.document, content=f'{i}', chunk_index=i, embedding=self.vector.tolist()
+            )
+            for i in range(3)
+        ]
+        call_command('convert_embeddings', '--dtype', 'float16', '--batch-size', '2', stdout=io.StringIO())
+        for chunk in DocumentChunk.objects.filter(id__in=[c.id for c in legacy]):
+            self.assertIsNone(chunk.embedding)
+            self.assertEqual(chunk.embedding_dtype, 'float16')
+            np.testing.assert_allclose(chunk.vector, self.vector, atol=1e-3)
+
+class VectorIndexTests(TestCase):
+    dim = 4
+
+    def setUp(self):
+        vector_index.invalidate_user()
+        self.user = User.objects.create(username='reader')
+        self.document = self._document('a.txt')
+        self.chunks = [
+            self._chunk(self.document, i, vector)
+            for i, vector in enumerate([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
+        ]
+
+    def tearDown(self):
+        vector_index.invalidate_user()
+
+    def _document(self, title, status=Document.STATUS_READY):
+        return Document.objects.create(user=self.user, title=title, file_type='txt', status=status)
+
+    def _chunk(self, document, index, vector):
+        chunk = DocumentChunk(document=document, content=f'chunk {index}', chunk_index=index)
+        chunk.set_vector(_unit(vector))
+        chunk.save()
+        return chunk
+
+    def test_index_matches_database_fingerprint(self):
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.fingerprint, vector_index._db_fingerprint(self.user.id))
+        self.assertIs(vector_index.get_user_index(self.user.id, self.dim), index)
+
+    def test_rebuilds_when_chunks_change_behind_its_back(self):
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        # Written without going through add_document, as another worker would
+        added = self._chunk(self.document, 3, [0, 0, 0, 1])
+
+        rebuilt = vector_index.get_user_index(self.user.id, self.dim)
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(len(rebuilt), 4)
+        self.assertEqual(rebuilt.search(_unit([0, 0, 0, 1]), 1)[0][0], added.id)
+
+    def test_rebuilds_on_dimension_change(self):
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        self.assertIsNot(vector_index.get_user_index(self.user.id, 8), index)
+
+    def test_unready_documents_are_not_indexed(self):
+        pending = self._document('b.txt', status=Document.STATUS_EMBEDDING)
+        self._chunk(pending, 0, [1, 1, 0, 0])
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.fingerprint, vector_index._db_fingerprint(self.user.id))
+
+    def test_add_document_keeps_fingerprint_in_step(self):
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        document = self._document('c.txt')
+        chunks = [self._chunk(document, i, [1, 0, 1, 0]) for i in range(2)]
+
+        vector_index.add_document(
+            self.user.id, document.id, [([c.id for c in chunks], [c.vector for c in chunks])]
+        )
+        self.assertEqual(index.fingerprint, vector_index._db_fingerprint(self.user.id))
+        self.assertIs(vector_index.get_user_index(self.user.id, self.dim), index)
+
+    def test_search_filters_by_document(self):
+        other = self._document('d.txt')
+        self._chunk(other, 0, [1, 0, 0, 0])
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        hits = index.search(_unit([1, 0, 0, 0]), 5, document_ids=[self.document.id])
+        self.assertEqual({document_id for _, document_id, _ in hits}, {self.document.id})
+        self.assertEqual(hits[0][0], self.chunks[0].id)
+
+
+
+class KeywordIndexTests(TestCase):
+    dim = 4
+
+    def setUp(self):
+        vector_index.invalidate_user()
+        self.addCleanup(vector_index.invalidate_user)
+        self.user = User.objects.create(username='searcher')
+        self.document = Document.objects.create(
+            user=self.user, title='a.txt', file_type='txt', status=Document.STATUS_READY
+        )
+        self.invoice = self._chunk('Invoice INV-2024-001 is overdue', [0, 0, 1, 0])
+        self.similar = self._chunk('Payment reminders go out monthly', [1, 0, 0, 0])
+        self.other = self._chunk('The canteen opens at noon', [0, 1, 0, 0])
+
+    def _chunk(self, content, vector, document=None):
+        document = document or self.document
+        position = DocumentChunk.objects.filter(document=document).count()
+        chunk = DocumentChunk(document=document, content=content, chunk_index=position)
+        chunk.set_vector(_unit(vector))
+        chunk.save()
+        return chunk
+
+    def test_search_matches_identifiers_as_phrases(self):
+        hits = keyword_index.get_keyword_index().search(self.user.id, 'status of INV-2024-001?', 10)
+        self.assertEqual([chunk_id for chunk_id, _, _ in hits], [self.invoice.id])
+
+    def test_query_syntax_is_not_interpreted(self):
+        index = keyword_index.get_keyword_index()
+        self.assertEqual(index.search(self.user.id, 'NEAR( "invoice OR * -', 10)[0][0], self.invoice.id)
+        self.assertEqual(index.search(self.user.id, '"*"', 10), [])
+
+    def test_search_is_scoped_to_the_users_ready_documents(self):
+        stranger = User.objects.create(username='stranger')
+        theirs = Document.objects.create(
+            user=stranger, title='b.txt', file_type='txt', status=Document.STATUS_READY
+        )
+        self._chunk('Invoice INV-2024-001 paid', [0, 0, 1, 0], theirs)
+        pending = Document.objects.create(
+            user=self.user, title='c.txt', file_type='txt', status=Document.STATUS_EMBEDDING
+        )
+        self._chunk('Invoice INV-2024-001 draft', [0, 0, 1, 0], pending)
+        hits = keyword_index.get_keyword_index().search(self.user.id, 'INV-2024-001', 10)
+        self.assertEqual([chunk_id for chunk_id, _, _ in hits], [self.invoice.id])
+
+    def test_hybrid_ranks_exact_terms_above_dense_neighbours(self):
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        hits = keyword_index.hybrid_search(index, 'when is INV-2024-001 due', _unit([1, 0, 0.2, 0]), 2)
+        self.assertEqual([chunk_id for chunk_id, _, _ in hits], [self.invoice.id, self.similar.id])
+        # Scores stay cosine similarities, not fused ranks
+        self.assertAlmostEqual(hits[1][2], float(_unit([1, 0, 0.2, 0]) @ _unit([1, 0, 0, 0])), places=5)
+
+    def test_hybrid_falls_back_to_dense_without_keyword_hits(self):
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        hits = keyword_index.hybrid_search(index, 'lunch', _unit([0, 1, 0, 0]), 1)
+        self.assertEqual(hits[0][0], self.other.id)
+
+    def test_hybrid_respects_document_scope(self):
+        index = vector_index.get_user_index(self.user.id, self.dim)
+        self.assertEqual(
+            keyword_index.hybrid_search(index, 'invoice', _unit([0, 0, 1, 0]), 3, document_ids=[]), []
+        )
+
+class TokenChunkingTests(SimpleTestCase):
+    sections = [
+        (1, 'The first sentence is here. A second one follows it closely.\n\nNew paragraph starts now.'),
+        (2, ' '.join(f'word{i}' for i in range(40)) + '. Short end.'),
+    ]
+
+    def _document_text(self):
+        return ''.join(text + '\n' for _, text in self.sections)
+
+    def _chunks(self, chunk_tokens=8, overlap_tokens=0):
+        return list(iter_token_chunks(self.sections, _word_offsets, chunk_tokens, overlap_tokens))
+
+    def test_offsets_point_into_the_document_text(self):
+        text = self._document_text()
+        for chunk in self._chunks():
+            self.assertEqual(text[chunk.char_start:chunk.char_end], chunk.text)
+
+    def test_chunks_stay_within_the_token_limit(self):
+        for chunk_tokens in (3, 8, 16):
+            for chunk in self._chunks(chunk_tokens, overlap_tokens=2):
+                self.assertLessEqual(chunk.token_count, chunk_tokens)
+                self.assertEqual(chunk.token_count, len(_word_offsets(chunk.text)))
+
+    def test_every_token_is_covered_once_without_overlap(self):
+        chunks = self._chunks()
+        words = [word for chunk in chunks for word in chunk.text.split()]
+        self.assertEqual(words, self._document_text().split())
+
+    def test_pages_follow_sections(self):
+        chunks = self._chunks()
+        self.assertEqual(chunks[0].page, 1)
+        self.assertEqual(chunks[-1].page, 2)
+
+    def test_overlap_repeats_trailing_sentences(self):
+        sections = [(None, 'One two. Three four. Five six. Seven eight.')]
+        chunks = list(iter_token_chunks(sections, _word_offsets, 4, 2))
+        self.assertEqual([c.text for c in chunks], ['One two. Three four.', 'Three four. Five six.',
+                                                    'Five six. Seven eight.'])
+
+    def test_rejects_empty_chunks(self):
+        with self.assertRaises(ValueError):
+            self._chunks(chunk_tokens=0)
+
+
+class AnswerCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.cache = AnswerCache(threshold=0.95, ttl=60, max_entries=2, max_bytes=1 << 20, clock=lambda: self.now)
+
+    def test_hit_for_a_near_identical_question(self):
+        self.cache.put('ctx', _unit([1, 0, 0]), 'answer')
+        self.assertEqual(self.cache.get('ctx', _unit([1, 0.05, 0])), 'answer')
+
+    def test_miss_for_a_different_question(self):
+        self.cache.put('ctx', _unit([1, 0, 0]), 'answer')
+        self.assertIsNone(self.cache.get('ctx', _unit([1, 1, 0])))
+
+    def test_contexts_are_isolated(self):
+        self.cache.put('ctx', _unit([1, 0, 0]), 'answer')
+        self.assertIsNone(self.cache.get('other', _unit([1, 0, 0])))
+
+    def test_entries_expire(self):
+        self.cache.put('ctx', _unit([1, 0, 0]), 'answer')
+        self.now = 61
+        self.assertIsNone(self.cache.get('ctx', _unit([1, 0, 0])))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('a', _unit([1, 0, 0]), 'first')
+        self.cache.put('b', _unit([1, 0, 0]), 'second')
+        self.cache.get('a', _unit([1, 0, 0]))
+        self.cache.put('c', _unit([1, 0, 0]), 'third')
+        self.assertIsNone(self.cache.get('b', _unit([1, 0, 0])))
+        self.assertEqual(self.cache.get('a', _unit([1, 0, 0])), 'first')
+
+
+@override_settings(ANSWER_CACHE_ENABLED=True, ANSWER_CACHE_CHAT_TYPES=['general'])
+class AnswerCacheKeyTests(SimpleTestCase):
+
+    def setUp(self):
+        backend = mock.Mock(version='test-model')
+        patches = [
+            mock.patch.object(answer_cache, 'encode_query', side_effect=self._encode),
+            mock.patch.object(answer_cache, 'get_embedding_backend', return_value=backend),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    @staticmethod
+    def _encode(question):
+        return _unit([1, 0, 0] if 'bsc' in question.lower() else [0, 1, 0])
+
+    def _key(self, question, history=(), documents=(), chat_type='general'):
+        messages, _ = build_chat_messages(list(history), question, documents=documents)
+        return answer_cache.cache_key(messages, chat_type)
+
+    def test_same_context_shares_a_group(self):
+        self.assertEqual(self._key('What is BSC?').context, self._key('what is bsc').context)
+
+    def test_history_and_documents_change_the_group(self):
+        plain = self._key('What is BSC?')
+        with_history = self._key('What is BSC?', history=[{'role': 'user', 'content': 'hello'}])
+        with_documents = self._key('What is BSC?', documents=['[From: a.txt]\nBSC text\n---'])
+        self.assertEqual(len({plain.context, with_history.context, with_documents.context}), 3)
+
+    def test_disabled_chat_types_are_not_cached(self):
+        self.assertIsNone(self._key('What is BSC?', chat_type='document'))
+
+    def test_store_and_lookup(self):
+        answer_cache._cache.clear()
+        self.addCleanup(answer_cache._cache.clear)
+        answer_cache.store(self._key('What is BSC?'), 'An answer.')
+        self.assertEqual(answer_cache.lookup(self._key('what is bsc')), 'An answer.')
+        self.assertIsNone(answer_cache.lookup(self._key('What is the weather?')))
+        self.assertIsNone(answer_cache.lookup(self._key('What is BSC?', history=[{'role': 'user', 'content': 'hi'}])))
+
+
+@override_settings(LLM_TOKENIZER_PATH='', PROMPT_RESPONSE_TOKENS=256, PROMPT_CONTEXT_SHARE=0.75)
+class BuildChatMessagesTests(SimpleTestCase):
+
+    def test_layout(self):
+        messages, stats = build_chat_messages(
+            [{'role': 'user', 'content': 'Hi'}, {'role': 'assistant', 'content': 'Hello'}],
+            'What does the report say?',
+            documents=['[From: report.pdf]\nRevenue grew.\n---'],
+            num_ctx=4096,
+        )
+        self.assertEqual(messages[0], {'role': 'system', 'content': SYSTEM_PROMPT})
+        self.assertEqual([m['content'] for m in messages[1:3]], ['Hi', 'Hello'])
+        self.assertTrue(messages[-1]['content'].startswith(DOCUMENT_HEADER))
+        self.assertTrue(messages[-1]['content'].endswith('What does the report say?'))
+        self.assertEqual(sum('Revenue grew.' in m['content'] for m in messages), 1)
+        self.assertEqual(stats.dropped_chunks, 0)
+
+    def test_documents_beyond_the_budget_are_dropped_from_the_end(self):
+        documents = [f'[From: doc{i}.txt]\n' + f'fact {i} ' * 200 + '\n---' for i in range(10)]
+        messages, stats = build_chat_messages([], 'Summarize.', documents=documents, num_ctx=2048)
+        self.assertLessEqual(stats.total, stats.budget)
+        self.assertGreater(stats.dropped_chunks, 0)
+        kept = len(documents) - stats.dropped_chunks
+        self.assertGreater(kept, 0)
+        self.assertIn('[From: doc0.txt]', messages[-1]['content'])
+        self.assertNotIn(f'[From: doc{kept}.txt]', messages[-1]['content'])
+
+    def test_history_keeps_the_newest_turns(self):
+        history = [
+            {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'turn {i} ' + 'x' * 600}
+            for i in range(20)
+        ]
+        messages, stats = build_chat_messages(history, 'And now?', num_ctx=2048)
+        self.assertLessEqual(stats.total, stats.budget)
+        kept = messages[1:-1]
+        self.assertLess(len(kept), len(history))
+        self.assertTrue(kept[-1]['content'].startswith('turn 19 '))
+        self.assertEqual(messages[-1], {'role': 'user', 'content': 'And now?'})
+
+    def test_long_realtime_context_is_truncated_to_fit(self):
+        messages, stats = build_chat_messages([], 'News?', realtime_context='headline ' * 5000, num_ctx=2048)
+        self.assertLessEqual(stats.total, stats.budget)
+        self.assertLess(len(messages[-1]['content']), len('headline ' * 5000))
+
+
+class LoadHistoryTests(TestCase):
+
+    def test_default_is_the_last_three_turns_before_the_question(self):
+        user = User.objects.create(username='talker')
+        conversation = Conversation.objects.create(user=user, title='Chat')
+        for i in range(6):
+            ChatMessage.objects.create(conversation=conversation, user=user, is_user_message=i % 2 == 0,
+                                       content=f'message {i}')
+        history = load_history(conversation)
+        self.assertEqual([m['content'] for m in history], ['message 2', 'message 3', 'message 4'])
+        self.assertEqual(history[0]['role'], 'user')
+
+
+@unittest.skipIf(admission.fcntl is None, 'admission control needs fcntl')
+class AdmissionTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.controller = AdmissionController(self.directory, slots=1, max_queue=8, poll_interval=0.01)
+
+    def _admitted(self, user_id):
+        ticket = self.controller.enqueue(user_id)
+        self.assertTrue(ticket.try_admit())
+        self.addCleanup(ticket.release)
+        return ticket
+
+    def test_waits_for_the_slot_and_takes_it_on_release(self):
+        first = self._admitted(1)
+        second = self.controller.enqueue(2)
+        self.addCleanup(second.release)
+        self.assertFalse(second.try_admit())
+        self.assertEqual(second.position, 1)
+
+        first.release()
+        self.assertTrue(second.try_admit())
+        self.assertEqual(self.controller.queue_length(), 0)
+
+    def test_release_is_idempotent_and_frees_the_slot(self):
+        ticket = self._admitted(1)
+        ticket.release()
+        ticket.release()
+        self.assertEqual(len(self.controller.free_slots()), 1)
+
+    def test_busy_user_is_served_in_turn_with_others(self):
+        self._admitted('a')
+        burst = [self.controller.enqueue('a') for _ in range(3)]
+        other = self.controller.enqueue('b')
+        for ticket in burst + [other]:
+            self.addCleanup(ticket.release)
+            ticket.try_admit()
+        self.assertEqual([t.position for t in burst], [1, 3, 4])
+        self.assertEqual(other.position, 2)
+
+    def test_interactive_goes_before_background(self):
+        self._admitted(1)
+        background = self.controller.enqueue(2, 'background')
+        interactive = self.controller.enqueue(3, 'interactive')
+        for ticket in (background, interactive):
+            self.addCleanup(ticket.release)
+            ticket.try_admit()
+        self.assertEqual((interactive.position, background.position), (1, 2))
+
+    def test_released_waiter_leaves_the_queue(self):
+        self._admitted(1)
+        waiting = self.controller.enqueue(2)
+        self.assertEqual(self.controller.queue_length(), 1)
+        waiting.release()
+        self.assertEqual(self.controller.queue_length(), 0)
+
+    def test_cancelled_wait_gives_up_its_ticket(self):
+        self._admitted(1)
+        waiting = self.controller.enqueue(2)
+        with self.assertRaises(QueueTimeout):
+            list(waiting.wait(cancelled=lambda: True))
+        self.assertTrue(waiting.released)
+        self.assertEqual(self.controller.queue_length(), 0)
+
+    def test_full_queue_is_refused(self):
+        controller = AdmissionController(self.directory, slots=1, max_queue=1)
+        self._admitted(1)
+        waiting = controller.enqueue(2)
+        self.addCleanup(waiting.release)
+        with self.assertRaises(QueueFull):
+            controller.enqueue(3)
+        with self.assertRaises(QueueFull):
+            controller.check_capacity()
+
+    def test_task_calls_go_before_chat(self):
+        self._admitted(1)
+        chat = self.controller.enqueue(2, 'interactive')
+        routing = self.controller.enqueue(3, 'task')
+        for ticket in (chat, routing):
+            self.addCleanup(ticket.release)
+            ticket.try_admit()
+        self.assertEqual((routing.position, chat.position), (1, 2))
+
+    def test_background_is_not_starved(self):
+        self._admitted(1)
+        background = self.controller.enqueue(2, 'background')
+        interactive = self.controller.enqueue(3, 'interactive')
+        for ticket in (background, interactive):
+            self.addCleanup(ticket.release)
+        self.controller.background_max_wait = 0
+        background.try_admit()
+        interactive.try_admit()
+        self.assertEqual((background.position, interactive.position), (1, 2))
+
+
+class AdmissionPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        pool_settings = override_settings(
+            LLM_ADMISSION_DIR=directory, LLM_SLOTS=2, LLM_MODEL_SLOTS={'small:3b': 4},
+            OLLAMA_MODEL='big:70b', OLLAMA_TASK_MODELS={},
+        )
+        pool_settings.enable()
+        self.addCleanup(pool_settings.disable)
+        controllers = mock.patch.dict(admission._controllers, clear=True)
+        controllers.start()
+        self.addCleanup(controllers.stop)
+
+    def test_one_pool_per_model(self):
+        chat = admission.get_admission_controller()
+        self.assertIs(admission.get_admission_controller('big:70b'), chat)
+        self.assertEqual(len(chat.slots), 2)
+        small = admission.get_admission_controller('small:3b')
+        self.assertIsNot(small, chat)
+        self.assertEqual(len(small.slots), 4)
+
+    def test_routing_on_the_chat_model_uses_the_chat_slots(self):
+        from . import ollama_client
+
+        client = mock.Mock(timeout=(5, 120))
+        client.chat.return_value = {'message': {'content': '{"tool": "none"}'}}
+        chat_pool = admission.get_admission_controller()
+        with mock.patch.object(ollama_client, 'get_ollama_client', return_value=client), \
+                mock.patch.object(chat_pool, 'admit', wraps=chat_pool.admit) as admit:
+            ollama_client.get_web_tool_call('what is the capital of Rwanda', user_id=1)
+        self.assertEqual(admit.call_args.args[1], 'task')
+        self.assertEqual(client.chat.call_args.kwargs['model'], 'big:70b')
+
+
+
+class UploadDedupTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_settings = override_settings(MEDIA_ROOT=media)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        scheduler = mock.patch.object(document_service, 'schedule_document_processing')
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def _upload(self, user, name='notes.txt', content=b'same bytes'):
+        return document_service.store_uploaded_document(
+            user, SimpleUploadedFile(name, content), name, 'txt'
+        )
+
+    def test_reupload_returns_the_existing_document(self):
+        document, reused = self._upload(self.alice)
+        again, reused_again = self._upload(self.alice, name='copy.txt')
+        self.assertFalse(reused)
+        self.assertTrue(reused_again)
+        self.assertEqual(again.id, document.id)
+        self.assertEqual(Document.objects.count(), 1)
+
+    def test_files_are_not_shared_between_users(self):
+        alices, _ = self._upload(self.alice, name='alice-private.txt')
+        bobs, reused = self._upload(self.bob, name='report.txt')
+        self.assertFalse(reused)
+        self.assertNotEqual(bobs.file.name, alices.file.name)
+        self.assertNotIn('alice', bobs.file.name)
+
+    def test_failed_upload_lends_its_file_to_the_retry(self):
+        failed, _ = self._upload(self.alice)
+        Document.objects.filter(id=failed.id).update(status=Document.STATUS_FAILED)
+        retry, reused = self._upload(self.alice)
+        self.assertFalse(reused)
+        self.assertNotEqual(retry.id, failed.id)
+        self.assertEqual(retry.file.name, failed.file.name)
+
+    def test_shared_file_is_deleted_with_its_last_document(self):
+        failed, _ = self._upload(self.alice)
+        Document.objects.filter(id=failed.id).update(status=Document.STATUS_FAILED)
+        retry, _ = self._upload(self.alice)
+        storage, name = retry.file.storage, retry.file.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            failed.delete()
+        self.assertTrue(storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            retry.delete()
+        self.assertFalse(storage.exists(name))
+
+
+class ToolContextDeadlineTests(SimpleTestCase):
+    message = 'look up the latest on https://example.com'
+
+    def setUp(self):
+        self.view = ChatMessageMixin()
+        self.user = mock.Mock(id=1)
+        self.deadline = SourceDeadline(time.monotonic() + 30)
+
+    def _expire(self, result):
+        def slow(*args, **kwargs):
+            self.deadline.abandon()  # the gathering gave up while this ran
+            return result
+        return slow
+
+    def test_no_web_tool_runs_after_slow_routing(self):
+        route = self._expire({'tool': 'tavily.search', 'args': {}})
+        with mock.patch('chat.api_views.route_web_tool', side_effect=route), \
+                mock.patch('chat.api_views.execute_web_tool_call') as execute, \
+                mock.patch('chat.api_views.get_web_context') as fallback:
+            context = self.view._get_tool_context(self.user, self.message, deadline=self.deadline)
+        self.assertEqual(context, '')
+        execute.assert_not_called()
+        fallback.assert_not_called()
+
+    def test_no_fallback_after_slow_web_tool(self):
+        with mock.patch('chat.api_views.route_web_tool', return_value={'tool': 'tavily.extract'}), \
+                mock.patch('chat.api_views.execute_web_tool_call', side_effect=self._expire(None)) as execute, \
+                mock.patch('chat.api_views.get_web_context') as fallback:
+            context = self.view._get_tool_context(self.user, self.message, deadline=self.deadline)
+        self.assertEqual(context, '')
+        self.assertIs(execute.call_args.kwargs['deadline'], self.deadline)
+        fallback.assert_not_called()
+
+    def test_fallback_runs_within_the_deadline(self):
+        with mock.patch('chat.api_views.route_web_tool', return_value={'tool': 'none'}), \
+                mock.patch('chat.api_views.execute_web_tool_call', return_value=None), \
+                mock.patch('chat.api_views.get_web_context', return_value='page text') as fallback:
+            context = self.view._get_tool_context(self.user, self.message, deadline=self.deadline)
+        self.assertIn('page text', context)
+        self.assertIs(fallback.call_args.kwargs['deadline'], self.deadline)
+
+
+class WebToolTimeoutTests(SimpleTestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.crawl.return_value = {'results': []}
+        patches = [
+            mock.patch.object(web_search, '_get_tavily_client', return_value=self.client),
+            mock.patch.dict(web_search._WEB_CONTEXT_CACHE, clear=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_requests_time_out_with_the_deadline(self):
+        deadline = SourceDeadline(time.monotonic() + 5)
+        web_search.execute_web_tool_call(
+            {'tool': 'tavily.crawl', 'args': {'url': 'https://example.com'}}, 'q', deadline=deadline
+        )
+        self.assertLessEqual(self.client.crawl.call_args.kwargs['timeout'], 5)
+
+    def test_no_deadline_keeps_the_default_timeout(self):
+        web_search.execute_web_tool_call({'tool': 'tavily.crawl', 'args': {'url': 'https://example.com'}}, 'q')
+        self.assertEqual(self.client.crawl.call_args.kwargs['timeout'], 120)
+
+    def test_research_runs_as_search_under_a_deadline(self):
+        self.client.search.return_value = {'results': []}
+        deadline = SourceDeadline(time.monotonic() + 5)
+        web_search.execute_web_tool_call({'tool': 'tavily.research', 'args': {}}, 'q', deadline=deadline)
+        self.client.research.assert_not_called()
+        self.assertLessEqual(self.client.search.call_args.kwargs['timeout'], 5)
+
+
+class ContextGatheringTests(SimpleTestCase):
+
+    def test_slow_source_is_left_out_and_abandoned(self):
+        seen = {}
+
+        def slow(report, deadline):
+            while not deadline.expired:
+                time.sleep(0.01)
+            seen['expired'] = True
+            return 'too late'
+
+        gathering = ContextGathering({
+            'slow': (slow, 0.05),
+            'fast': (lambda report, deadline: 'context', 5),
+        })
+        with self.assertLogs('chat.context_gathering', 'WARNING'):
+            list(gathering.events())
+        self.assertEqual(gathering.values, {'fast': 'context'})
+        self.assertEqual(gathering.timed_out, ['slow'])
+        for _ in range(100):
+            if seen:
+                break
+            time.sleep(0.01)
+        self.assertTrue(seen.get('expired'))
+
+    def test_cancel_abandons_running_sources(self):
+        started = threading.Event()
+        deadlines = []
+
+        def source(report, deadline):
+            deadlines.append(deadline)
+            started.set()
+            while not deadline.expired:
+                time.sleep(0.01)
+
+        gathering = ContextGathering({'tools': (source, 30)})
+        self.assertTrue(started.wait(5))
+        gathering.cancel()
+        self.assertTrue(deadlines[0].expired)
+
+
+class _BorrowingBackend(EmbeddingBackend):
+    """Fails like a fast tokenizer when two threads use it at once."""
+    name = 'borrowing'
+    dimension = 2
+    version = 'borrowing-1'
+    max_seq_length = 16
+
+    def __init__(self):
+        self.busy = threading.Lock()
+        self.batches = []
+
+    def _borrow(self):
+        if not self.busy.acquire(blocking=False):
+            raise RuntimeError('Already borrowed')
+        time.sleep(0.005)
+        self.busy.release()
+
+    def _encode(self, texts, batch_size):
+        self._borrow()
+        self.batches.append(len(texts))
+        return np.array([[len(text), 1.0] for text in texts], dtype=np.float32)
+
+    def token_offsets(self, text):
+        self._borrow()
+        return _word_offsets(text)
+
+
+class EmbeddingServerTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.backend = _BorrowingBackend()
+        batcher = MicroBatcher(self.backend, max_batch_size=8, max_wait=0.02)
+        batcher.start()
+        address = f'unix://{directory}/embed.sock'
+        server = make_server(address, batcher)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.client = RemoteBackend(address, timeout=5)
+
+    def _concurrently(self, calls):
+        errors = []
+
+        def run(call):
+            try:
+                call()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(call,)) for call in calls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_tokenize_and_encode_do_not_share_the_tokenizer(self):
+        calls = [lambda: self.client.token_offsets('two words')] * 6
+        calls += [lambda: self.client.encode(['a', 'bb'])] * 6
+        self.assertEqual(self._concurrently(calls), [])
+
+    def test_concurrent_requests_share_batches(self):
+        vectors = []
+        calls = [lambda: vectors.append(self.client.encode(['abc', 'de']))] * 4
+        self.assertEqual(self._concurrently(calls), [])
+        self.assertLess(len(self.backend.batches), 4)
+        np.testing.assert_array_equal(vectors[0], [[3, 1], [2, 1]])
+
+
+@override_settings(RAG_EXTRACT_WORKERS=2, RAG_PDF_PARALLEL_MIN_PAGES=4, RAG_PDF_PAGES_PER_TASK=2)
+class PdfExtractionTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = f'{directory}/report.pdf'
+        with open(self.path, 'wb') as f:
+            f.write(_pdf_bytes([f'page {number}' for number in range(1, 8)]))
+
+    def test_parallel_extraction_keeps_page_order(self):
+        sections = list(PdfExtractor().sections(self.path))
+        self.assertEqual([section.page for section in sections], list(range(1, 8)))
+        self.assertEqual(sections[2].text, 'page 3')
+
+    def test_small_pdfs_are_read_inline(self):
+        with override_settings(RAG_PDF_PARALLEL_MIN_PAGES=64), \
+                mock.patch.object(PdfExtractor, '_parallel_sections') as parallel:
+            pages = [section.page for section in PdfExtractor().sections(self.path)]
+        self.assertEqual(pages, list(range(1, 8)))
+        parallel.assert_not_called()
+
+    def test_runs_in_parallel_inside_daemonic_workers(self):
+        results = billiard.Queue()
+        worker = billiard.Process(target=_pdf_sections_in_daemon, args=(self.path, results), daemon=True)
+        worker.start()
+        pages, parallel = results.get(timeout=30)
+        worker.join()
+        self.assertEqual(pages, list(range(1, 8)))
+        self.assertTrue(parallel)
+
+
+class OllamaChatTests(SimpleTestCase):
+
+    def setUp(self):
+        from . import ollama_client
+
+        self.ollama_client = ollama_client
+        self.client = mock.Mock(timeout=(5, 120))
+        no_slots = override_settings(LLM_SLOTS=0)
+        no_slots.enable()
+        self.addCleanup(no_slots.disable)
+        patches = [
+            mock.patch.object(ollama_client, 'get_ollama_client', return_value=self.client),
+            mock.patch.dict(admission._controllers, clear=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_streamed_response_is_returned_read(self):
+        response = mock.Mock()
+        self.client._post_chat.return_value = response
+        result = self.ollama_client._ollama_chat([{'role': 'user', 'content': 'hi'}], stream=True)
+        self.assertIs(result, response)
+
+    def test_routing_failure_is_logged(self):
+        self.client.chat.side_effect = ConnectionError('refused')
+        with self.assertLogs('chat.ollama_client', 'WARNING') as logs:
+            tool_call = self.ollama_client.get_web_tool_call('look up the news')
+        self.assertEqual(tool_call, {'tool': 'none', 'error': 'refused'})
+        self.assertIn('Web tool routing failed: refused', logs.output[0])
+
+
+class _WordBackend(EmbeddingBackend):
+    """One token per word; vectors derived from the text, and encode can be made to fail."""
+    name = 'words'
+    dimension = 4
+    version = 'words-1'
+    max_seq_length = 12
+
+    def __init__(self, fail_on_call=None):
+        self.fail_on_call = fail_on_call
+        self.encoded = []
+
+    def _encode(self, texts, batch_size):
+        if len(self.encoded) + 1 == self.fail_on_call:
+            raise RuntimeError('worker lost')
+        self.encoded.append(list(texts))
+        return np.array([[len(text), text.count('1'), text.count('2'), 1] for text in texts], dtype=np.float32)
+
+    def token_offsets(self, text):
+        return _word_offsets(text)
+
+
+class IngestionTests(TestCase):
+    text = ' '.join(f'w{number}' for number in range(120))
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_settings = override_settings(MEDIA_ROOT=media)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        patches = [
+            mock.patch.object(document_service, 'EMBED_BATCH_SIZE', 4),
+            mock.patch.object(document_service, 'CHUNK_OVERLAP_TOKENS', 2),
+            mock.patch.object(document_service, 'schedule_document_processing'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.user = User.objects.create_user('ingest')
+
+    def _document(self, user=None, name='words.txt'):
+        document, _ = document_service.store_uploaded_document(
+            user or self.user, SimpleUploadedFile(name, self.text.encode()), name, 'txt'
+        )
+        return document
+
+    def _process(self, document, backend):
+        with mock.patch.object(document_service, 'get_embedding_backend', return_value=backend):
+            return document_service.process_document(document.id)
+
+    def _chunks(self, document):
+        return list(DocumentChunk.objects.filter(document=document).order_by('chunk_index')
+                    .values_list('chunk_index', 'content'))
+
+    def test_interrupted_run_resumes_after_committed_windows(self):
+        document = self._document()
+        with self.assertLogs('chat.document_service', 'ERROR'):
+            self.assertFalse(self._process(document, _WordBackend(fail_on_call=3)))
+        document.refresh_from_db()
+        self.assertEqual(document.status, Document.STATUS_FAILED)
+        self.assertEqual(DocumentChunk.objects.filter(document=document).count(), 8)
+
+        resumed = _WordBackend()
+        self.assertTrue(self._process(document, resumed))
+        document.refresh_from_db()
+        clean = self._document(User.objects.create_user('clean'))
+        self._process(clean, _WordBackend())
+
+        chunks = self._chunks(document)
+        self.assertEqual(chunks, self._chunks(clean))
+        self.assertEqual([index for index, _ in chunks], list(range(len(chunks))))
+        self.assertEqual((document.status, document.chunk_count), (Document.STATUS_READY, len(chunks)))
+        # Only the chunks after the committed windows were read and encoded again
+        self.assertEqual(sum(map(len, resumed.encoded)), len(chunks) - 8)
+
+    def test_identical_chunks_reuse_stored_embeddings(self):
+        first = self._document()
+        self._process(first, _WordBackend())
+        backend = _WordBackend()
+        second = self._document(User.objects.create_user('other'))
+        self.assertTrue(self._process(second, backend))
+        self.assertEqual(backend.encoded, [])
+        blobs = [
+            list(DocumentChunk.objects.filter(document=document).order_by('chunk_index')
+                 .values_list('embedding_blob', flat=True))
+            for document in (first, second)
+        ]
+        self.assertEqual(blobs[1], blobs[0])
+
+
+def _events(frames):
+    """Decoded ``data:`` frames of an SSE stream, skipping keep-alive comments."""
+    return (json.loads(frame[len('data: '):]) for frame in frames if frame.startswith('data: '))
+
+
+class AnswerStreamTestCase(TestCase):
+    """Streams a conversation's answer from a stand-in model, one frame per chunk."""
+
+    def setUp(self):
+        stream_settings = override_settings(LLM_SLOTS=0, SSE_FLUSH_INTERVAL_MS=0, SSE_FLUSH_BYTES=0)
+        stream_settings.enable()
+        self.addCleanup(stream_settings.disable)
+        controllers = mock.patch.dict(admission._controllers, clear=True)
+        controllers.start()
+        self.addCleanup(controllers.stop)
+        caches['default'].clear()
+        self.user = User.objects.create_user('asker')
+        self.conversation = Conversation.objects.create(user=self.user, title='Greeting')
+        self.closed = []
+
+    def _model(self, chunks):
+        def stream(messages, ticket=None):
+            try:
+                yield from chunks
+            finally:
+                self.closed.append(True)
+        patch = mock.patch('chat.streaming.get_ai_response_stream', side_effect=stream)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _answer_stream(self, **kwargs):
+        kwargs.setdefault('messages', [{'role': 'user', 'content': 'hi'}])
+        return AnswerStream(self.conversation, self.user, **kwargs)
+
+
+class CancelGenerationTests(AnswerStreamTestCase):
+
+    def test_cancel_stops_the_stream_and_keeps_the_partial_answer(self):
+        self._model(['Hello', ' there', ', friend'])
+        events = []
+        for event in _events(self._answer_stream().frames()):
+            events.append(event)
+            if 'chunk' in event:
+                self.assertEqual(generations.cancel(self.conversation.id), 1)
+
+        self.assertEqual([event.get('chunk') for event in events if 'chunk' in event], ['Hello'])
+        self.assertEqual(events[-1], {'done': True, 'conversation_id': self.conversation.id, 'interrupted': True})
+        self.assertEqual(self.closed, [True])
+        message = ChatMessage.objects.get(conversation=self.conversation)
+        self.assertEqual((message.content, message.interrupted), ('Hello', True))
+
+    def test_disconnect_closes_the_model_stream(self):
+        self._model(['Hello', ' there', ', friend'])
+        frames = self._answer_stream().frames()
+        for frame in frames:
+            if '"chunk"' in frame:
+                break
+        frames.close()
+        self.assertEqual(self.closed, [True])
+        self.assertTrue(ChatMessage.objects.get(conversation=self.conversation).interrupted)
+
+    def test_finished_answer_is_not_interrupted(self):
+        self._model(['Hello', ' there'])
+        events = list(_events(self._answer_stream().frames()))
+        self.assertNotIn('interrupted', events[-1])
+        self.assertEqual(generations._active, {})
+        self.assertEqual(ChatMessage.objects.get(conversation=self.conversation).content, 'Hello there')
+
+    def test_cancel_reaches_generations_in_other_processes(self):
+        # Not registered here, as if streamed by another worker
+        elsewhere = generations.Generation(self.conversation.id)
+        self.assertEqual(generations.cancel(self.conversation.id), 0)
+        self.assertTrue(elsewhere.cancelled)
+
+    def test_earlier_cancel_leaves_later_answers_alone(self):
+        generations.cancel(self.conversation.id)
+        later = generations.Generation(self.conversation.id)
+        later.started += 1
+        self.assertFalse(later.cancelled)
+
+    def test_cancel_view(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        running = generations.start(self.conversation.id)
+        self.addCleanup(generations.finish, running)
+        response = client.post(reverse('api:cancel_generation', args=[self.conversation.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(running.cancelled)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ChunkCoalescerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = _Clock()
+
+    def test_merges_chunks_until_the_interval_passes(self):
+        coalescer = ChunkCoalescer(interval_ms=50, max_bytes=0, clock=self.clock)
+        self.assertIsNone(coalescer.push('Hel'))
+        self.clock.now = 0.02
+        self.assertIsNone(coalescer.push('lo'))
+        self.clock.now = 0.05
+        self.assertEqual(coalescer.push(' there'), 'Hello there')
+        self.assertIsNone(coalescer.flush())
+
+    def test_flushes_once_enough_text_is_pending(self):
+        coalescer = ChunkCoalescer(interval_ms=0, max_bytes=8, clock=self.clock)
+        self.assertIsNone(coalescer.push('1234'))
+        self.assertEqual(coalescer.push('56789'), '123456789')
+
+    def test_both_triggers_off_sends_every_chunk(self):
+        coalescer = ChunkCoalescer(interval_ms=0, max_bytes=0, clock=self.clock)
+        self.assertEqual([coalescer.push(text) for text in ['a', '', 'b']], ['a', None, 'b'])
+
+    def test_flush_returns_the_rest(self):
+        coalescer = ChunkCoalescer(interval_ms=50, max_bytes=512, clock=self.clock)
+        coalescer.push('tail')
+        self.assertEqual(coalescer.flush(), 'tail')
+
+
+class CoalescedStreamTests(AnswerStreamTestCase):
+
+    def test_answer_text_is_unchanged_in_fewer_frames(self):
+        tokens = [f'word{number} ' for number in range(40)]
+        self._model(tokens)
+        with override_settings(SSE_FLUSH_INTERVAL_MS=0, SSE_FLUSH_BYTES=64):
+            chunks = [event['chunk'] for event in _events(self._answer_stream().frames()) if 'chunk' in event]
+        self.assertEqual(''.join(chunks), ''.join(tokens))
+        self.assertLess(len(chunks), len(tokens) / 4)
+        self.assertEqual(ChatMessage.objects.get(conversation=self.conversation).content, ''.join(tokens))
+
+
+class HeartbeatTests(SimpleTestCase):
+
+    def test_due_after_an_idle_interval(self):
+        clock = _Clock()
+        heartbeat = Heartbeat(interval_s=15, clock=clock)
+        clock.now = 14
+        self.assertFalse(heartbeat.due())
+        clock.now = 15
+        self.assertTrue(heartbeat.due())
+        self.assertFalse(heartbeat.due())  # counts as sent
+
+    def test_other_frames_reset_the_interval(self):
+        clock = _Clock()
+        heartbeat = Heartbeat(interval_s=15, clock=clock)
+        clock.now = 10
+        heartbeat.sent()
+        clock.now = 20
+        self.assertFalse(heartbeat.due())
+
+    def test_zero_interval_turns_heartbeats_off(self):
+        clock = _Clock()
+        heartbeat = Heartbeat(interval_s=0, clock=clock)
+        clock.now = 1000
+        self.assertFalse(heartbeat.due())
+
+
+class StreamProgressTests(AnswerStreamTestCase):
+
+    def _gathering_stream(self, sources):
+        def build(context):
+            return [{'role': 'user', 'content': context.values.get('tools') or 'hi'}], None
+        return self._answer_stream(messages=None, sources=sources, build=build)
+
+    def test_started_frame_goes_out_before_context_is_gathered(self):
+        self._model(['ok'])
+        ran = threading.Event()
+
+        def tools(report, deadline):
+            ran.set()
+            return ''
+
+        frames = self._gathering_stream({'tools': (tools, 5)}).frames()
+        self.assertEqual(json.loads(next(frames)[len('data: '):]),
+                         {'status': 'started', 'conversation_id': self.conversation.id})
+        self.assertFalse(ran.is_set())
+        list(frames)
+        self.assertTrue(ran.is_set())
+
+    def test_sources_report_their_stages(self):
+        self._model(['ok'])
+
+        def tools(report, deadline):
+            report('routing')
+            report('searching_web')
+            return 'web results'
+
+        events = list(_events(self._gathering_stream({'tools': (tools, 5)}).frames()))
+        statuses = [event['status'] for event in events if 'status' in event]
+        self.assertEqual(statuses, ['started', 'routing', 'searching_web', 'generating'])
+
+    def test_missed_sources_are_listed_when_generation_starts(self):
+        self._model(['ok'])
+
+        def slow(report, deadline):
+            while not deadline.expired:
+                time.sleep(0.01)
+
+        with self.assertLogs('chat.context_gathering', 'WARNING'):
+            events = list(_events(self._gathering_stream({
+                'documents': (slow, 0.05),
+                'tools': (lambda report, deadline: 'web results', 5),
+            }).frames()))
+        self.assertIn({'status': 'generating', 'missing': ['documents']}, events)
+        self.assertEqual(events[-1]['done'], True)
+
+    def test_idle_gathering_sends_keep_alive_comments(self):
+        self._model(['ok'])
+
+        def slow(report, deadline):
+            time.sleep(0.3)
+            return ''
+
+        with override_settings(SSE_HEARTBEAT_INTERVAL=0.05), \
+                mock.patch('chat.streaming.GATHER_TICK', 0.02):
+            frames = list(self._gathering_stream({'tools': (slow, 5)}).frames())
+        self.assertIn(HEARTBEAT, frames)
+        self.assertLess(frames.index(HEARTBEAT), frames.index('data: {"status": "generating"}\n\n'))
+
+
+class PreRouteTests(SimpleTestCase):
+
+    def test_url_is_extracted(self):
+        decision = tool_routing.pre_route('Summarise www.example.com/about.')
+        self.assertEqual(decision['tool'], 'tavily.extract')
+        self.assertEqual(decision['args']['urls'], ['https://www.example.com/about'])
+
+    def test_sitemap_request_maps_the_site(self):
+        decision = tool_routing.pre_route('Show the sitemap of https://example.com')
+        self.assertEqual((decision['tool'], decision['args']['url']), ('tavily.map', 'https://example.com'))
+
+    def test_latest_from_one_site_crawls_it(self):
+        decision = tool_routing.pre_route('What are the latest headlines on https://igihe.com')
+        self.assertEqual(decision['tool'], 'tavily.crawl')
+        self.assertFalse(decision['args']['allow_external'])
+
+    def test_news_without_a_url_searches_news(self):
+        today = tool_routing.pre_route('Breaking news about Kigali')
+        self.assertEqual((today['tool'], today['args']['topic'], today['args']['time_range']),
+                         ('tavily.search', 'news', 'day'))
+        self.assertEqual(tool_routing.pre_route('Any news on the budget?')['args']['time_range'], 'week')
+
+    def test_ambiguous_messages_are_left_to_the_router(self):
+        self.assertIsNone(tool_routing.pre_route('Search for the population of Rwanda'))
+
+
+class RouterDecisionCacheTests(SimpleTestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = tool_routing.RouterDecisionCache(2)
+        cache.put('a', {'tool': 'none'})
+        cache.put('b', {'tool': 'none'})
+        cache.get('a')
+        cache.put('c', {'tool': 'none'})
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(len(cache), 2)
+
+    def test_zero_size_caches_nothing(self):
+        cache = tool_routing.RouterDecisionCache(0)
+        cache.put('a', {'tool': 'none'})
+        self.assertEqual(len(cache), 0)
+
+
+class RouteWebToolTests(SimpleTestCase):
+
+    def setUp(self):
+        cache = mock.patch.object(tool_routing, '_decision_cache', tool_routing.RouterDecisionCache(8))
+        cache.start()
+        self.addCleanup(cache.stop)
+
+    def test_rules_skip_the_llm(self):
+        with mock.patch.object(tool_routing, 'get_web_tool_call') as router:
+            self.assertEqual(tool_routing.route_web_tool('read https://example.com')['tool'], 'tavily.extract')
+        router.assert_not_called()
+
+    def test_llm_decisions_are_reused_for_the_same_message(self):
+        decision = {'tool': 'tavily.search', 'args': {'query': 'population of Rwanda'}}
+        with mock.patch.object(tool_routing, 'get_web_tool_call', return_value=decision) as router:
+            first = tool_routing.route_web_tool('Search the population of Rwanda', user_id=1)
+            again = tool_routing.route_web_tool('  search the POPULATION of rwanda ', user_id=2)
+        self.assertEqual(router.call_count, 1)
+        self.assertEqual(first, again)
+
+    def test_failed_routing_is_not_cached(self):
+        with mock.patch.object(tool_routing, 'get_web_tool_call',
+                               return_value={'tool': 'none', 'error': 'timeout'}) as router:
+            tool_routing.route_web_tool('Search the population of Rwanda')
+            tool_routing.route_web_tool('Search the population of Rwanda')
+        self.assertEqual(router.call_count, 2)
+
+    def test_deadline_is_passed_to_the_router(self):
+        deadline = SourceDeadline(time.monotonic() + 5)
+        with mock.patch.object(tool_routing, 'get_web_tool_call', return_value={'tool': 'none'}) as router:
+            tool_routing.route_web_tool('Search the population of Rwanda', deadline=deadline)
+        self.assertIs(router.call_args.kwargs['deadline'], deadline)
+
+
+class AnnIndexTests(TestCase):
+    dim = 8
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        ann_settings = override_settings(
+            RAG_ANN_ENABLED=True, RAG_ANN_MIN_CHUNKS=100, RAG_ANN_NPROBE=4, RAG_ANN_DIR=directory
+        )
+        ann_settings.enable()
+        self.addCleanup(ann_settings.disable)
+        for cache in (ann_index._shards, ann_index._views):
+            patch = mock.patch.dict(cache, clear=True)
+            patch.start()
+            self.addCleanup(patch.stop)
+        vector_index.invalidate_user()
+        self.addCleanup(vector_index.invalidate_user)
+
+        self.rng = np.random.default_rng(7)
+        self.user = User.objects.create(username='librarian')
+        self.document = Document.objects.create(
+            user=self.user, title='a.txt', file_type='txt', status=Document.STATUS_READY
+        )
+        self.centres = self.rng.normal(size=(8, self.dim))
+        self.chunks = self._chunks(400)
+
+    def _chunks(self, count):
+        start = DocumentChunk.objects.filter(document=self.document).count()
+        rows = []
+        for i in range(count):
+            vector = self.centres[i % len(self.centres)] + 0.1 * self.rng.normal(size=self.dim)
+            chunk = DocumentChunk(document=self.document, content=f'{start + i}', chunk_index=start + i)
+            chunk.set_vector(_unit(vector))
+            rows.append(chunk)
+        return DocumentChunk.objects.bulk_create(rows)
+
+    def _index(self):
+        return vector_index.get_user_index(self.user.id, self.dim)
+
+    def test_probed_search_matches_exact_search(self):
+        shard = ann_index.build_user(self.user.id, self.dim)
+        self.assertEqual(len(shard), 400)
+        queries = [_unit(centre) for centre in self.centres]
+        self.assertGreaterEqual(ann_index.measure_recall(self._index(), queries, top_k=5), 0.9)
+
+    def test_shard_survives_a_reload(self):
+        built = ann_index.build_user(self.user.id, self.dim)
+        ann_index._shards.clear()
+        loaded = ann_index._current_shard(self.user.id)
+        np.testing.assert_array_equal(loaded.chunk_ids, built.chunk_ids)
+        np.testing.assert_array_equal(loaded.assignments, built.assignments)
+
+    def test_chunks_added_after_the_build_are_found(self):
+        ann_index.build_user(self.user.id, self.dim)
+        self.centres = np.array([[0, 0, 0, 0, 0, 0, 0, 1.0]])
+        added = self._chunks(1)[0]
+        hits = ann_index.search(self._index(), _unit(self.centres[0]), 1)
+        self.assertEqual(hits[0][0], added.id)
+
+    def test_update_user_appends_to_the_shard(self):
+        ann_index.build_user(self.user.id, self.dim)
+        added = self._chunks(3)
+        ann_index.update_user(self.user.id, [([c.id for c in added], [c.vector for c in added])], self.dim)
+        self.assertEqual(len(ann_index._current_shard(self.user.id)), 403)
+
+    def test_small_scopes_use_exact_search(self):
+        ann_index.build_user(self.user.id, self.dim)
+        with mock.patch.object(ann_index, 'candidate_rows') as probe:
+            ann_index.search(self._index(), _unit(self.centres[0]), 3, document_ids=[self.document.id + 1])
+        probe.assert_not_called()
+
+
+class IngestionSchedulingTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('uploader')
+        self.document = Document.objects.create(user=self.user, title='a.txt', file_type='txt')
+
+    def test_task_is_queued_once_the_upload_commits(self):
+        with mock.patch('chat.tasks.ingest_document.delay') as delay, \
+                mock.patch.object(document_service, 'process_document') as inline:
+            with self.captureOnCommitCallbacks(execute=True):
+                document_service.schedule_document_processing(self.document.id)
+                delay.assert_not_called()
+        delay.assert_called_once_with(self.document.id)
+        inline.assert_not_called()
+
+    def test_unreachable_broker_falls_back_to_inline(self):
+        with mock.patch('chat.tasks.ingest_document.delay', side_effect=OSError('broker down')), \
+                mock.patch.object(document_service, 'process_document') as inline, \
+                self.assertLogs('chat.document_service', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                document_service.schedule_document_processing(self.document.id)
+        inline.assert_called_once_with(self.document.id)
+
+    def test_sync_mode_processes_inline(self):
+        with mock.patch.object(document_service, 'INGEST_ASYNC', False), \
+                mock.patch('chat.tasks.ingest_document.delay') as delay, \
+                mock.patch.object(document_service, 'process_document') as inline:
+            with self.captureOnCommitCallbacks(execute=True):
+                document_service.schedule_document_processing(self.document.id)
+        delay.assert_not_called()
+        inline.assert_called_once_with(self.document.id)
+
+    def test_failure_is_recorded_and_reported(self):
+        with mock.patch.object(document_service, 'get_extractor', side_effect=ValueError('bad file')), \
+                self.assertLogs('chat.document_service', 'ERROR'):
+            self.assertFalse(document_service.process_document(self.document.id))
+        client = APIClient()
+        client.force_authenticate(self.user)
+        status = client.get(reverse('api:document_status', args=[self.document.id])).json()
+        self.assertEqual((status['status'], status['processed'], status['error']),
+                         (Document.STATUS_FAILED, False, 'bad file'))
+
+    def test_ready_documents_are_not_processed_again(self):
+        Document.objects.filter(id=self.document.id).update(status=Document.STATUS_READY)
+        with mock.patch.object(document_service, 'get_extractor') as extractor:
+            self.assertTrue(document_service.process_document(self.document.id))
+        extractor.assert_not_called()
+
+
+class QueryEmbeddingCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.backend = _WordBackend()
+        patches = [
+            mock.patch.object(embeddings, 'get_embedding_backend', return_value=self.backend),
+            mock.patch.object(embeddings, '_query_cache', embeddings.QueryEmbeddingCache(1 << 20)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_repeated_queries_are_encoded_once(self):
+        first = embeddings.encode_query('What  is BSC?')
+        again = embeddings.encode_query('What is BSC?')
+        self.assertIs(again, first)
+        self.assertEqual(self.backend.encoded, [['What is BSC?']])
+        self.assertAlmostEqual(float(np.linalg.norm(first)), 1.0, places=5)
+
+    def test_cached_vectors_are_read_only(self):
+        with self.assertRaises(ValueError):
+            embeddings.encode_query('What is BSC?')[0] = 0
+
+    def test_other_backend_versions_miss(self):
+        embeddings.encode_query('What is BSC?')
+        self.backend.version = 'words-2'
+        embeddings.encode_query('What is BSC?')
+        self.assertEqual(len(self.backend.encoded), 2)
+
+    def test_bounded_by_bytes_in_lru_order(self):
+        vector = np.zeros(4, dtype=np.float32)
+        cost = embeddings.QueryEmbeddingCache._cost(('v', 'a'), vector)
+        cache = embeddings.QueryEmbeddingCache(2 * cost)
+        cache.put(('v', 'a'), vector)
+        cache.put(('v', 'b'), vector)
+        cache.get(('v', 'a'))
+        cache.put(('v', 'c'), vector)
+        self.assertIsNone(cache.get(('v', 'b')))
+        self.assertIsNotNone(cache.get(('v', 'a')))
+        self.assertEqual(cache.nbytes, 2 * cost)
+
+    def test_entries_larger_than_the_cache_are_skipped(self):
+        cache = embeddings.QueryEmbeddingCache(64)
+        cache.put(('v', 'a'), np.zeros(64, dtype=np.float32))
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+
+class AsyncStreamViewTests(AnswerStreamTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        async def stream(messages, ticket=None):
+            try:
+                for chunk in ['Hello', ' there']:
+                    yield chunk
+            finally:
+                self.closed.append(True)
+
+        patches = [
+            mock.patch('chat.streaming.aget_ai_response_stream', side_effect=stream),
+            mock.patch.object(ChatMessageMixin, '_context_sources', return_value={}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    async def _post(self, url):
+        return await self.async_client.post(
+            url, {'message': 'hi'}, content_type='application/json', headers=self.headers
+        )
+
+    async def _frames(self, response):
+        return [frame.decode() async for frame in response.streaming_content]
+
+    async def test_streams_an_answer_into_a_new_conversation(self):
+        response = await self._post(reverse('api:stream_message_new'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = list(_events(await self._frames(response)))
+        conversation = await Conversation.objects.filter(user=self.user).order_by('-id').afirst()
+        self.assertEqual(events[0], {'status': 'started', 'conversation_id': conversation.id})
+        self.assertEqual(''.join(event['chunk'] for event in events if 'chunk' in event), 'Hello there')
+        self.assertEqual(events[-1], {'done': True, 'conversation_id': conversation.id})
+        contents = [message.content async for message in
+                    ChatMessage.objects.filter(conversation=conversation).order_by('id')]
+        self.assertEqual(contents, ['hi', 'Hello there'])
+
+    async def test_requires_a_bearer_token(self):
+        self.headers = {}
+        with self.assertLogs('django.request', 'WARNING'):
+            response = await self._post(reverse('api:stream_message', args=[self.conversation.id]))
+        self.assertEqual(response.status_code, 401)
+
+    async def test_other_users_conversations_are_not_found(self):
+        stranger = await User.objects.acreate(username='stranger')
+        theirs = await Conversation.objects.acreate(user=stranger, title='Private')
+        with self.assertLogs('django.request', 'WARNING'):
+            response = await self._post(reverse('api:stream_message', args=[theirs.id]))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_cancel_stops_the_async_stream(self):
+        events = []
+        async for frame in self._answer_stream().aframes():
+            events.extend(_events([frame]))
+            if 'chunk' in events[-1]:
+                generations.cancel(self.conversation.id)
+        self.assertEqual([event['chunk'] for event in events if 'chunk' in event], ['Hello'])
+        self.assertTrue(events[-1]['interrupted'])
+        self.assertEqual(self.closed, [True])
+
+
+@override_settings(
+    OLLAMA_MODEL='big:70b', OLLAMA_TASK_MODELS={'tool_routing': 'small:3b'},
+    OLLAMA_TASK_OPTIONS={'tool_routing': {'num_ctx': 2048}}, OLLAMA_NUM_CTX=16384,
+    OLLAMA_READ_TIMEOUT=90,
+)
+class ModelProfileTests(SimpleTestCase):
+
+    def setUp(self):
+        from . import ollama_client
+
+        self.ollama_client = ollama_client
+
+    def test_tasks_get_their_configured_model(self):
+        self.assertEqual(self.ollama_client.get_model_profile('tool_routing').model, 'small:3b')
+        self.assertEqual(self.ollama_client.get_model_profile('title').model, 'big:70b')
+
+    def test_options_layer_defaults_settings_and_call(self):
+        routing = self.ollama_client.get_model_profile('tool_routing', options={'temperature': 0.5})
+        self.assertEqual(routing.options['num_ctx'], 2048)
+        self.assertEqual(routing.options['temperature'], 0.5)
+        self.assertEqual(routing.options['num_predict'], 512)
+
+    def test_chat_context_follows_the_prompt_budget(self):
+        chat = self.ollama_client.get_model_profile('chat')
+        self.assertEqual((chat.options['num_ctx'], chat.timeout), (16384, 90))
+
+    def test_per_call_model_override(self):
+        self.assertEqual(self.ollama_client.get_model_profile('chat', model='other:8b').model, 'other:8b')
+
+    def test_unknown_task_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.ollama_client.get_model_profile('translation')
+
+
+class AttachmentScopeTests(TestCase):
+
+    def setUp(self):
+        vector_index.invalidate_user()
+        self.addCleanup(vector_index.invalidate_user)
+        self.user = User.objects.create(username='attacher')
+        self.library = self._document('library.txt', [[1, 0, 0, 0]] * 10)
+        self.attached = self._document('attached.txt', [[1, 1, 0, 0], [1, 0, 2, 0], [0, 0, 0, 1]])
+        query = mock.patch.object(document_service, 'encode_query', return_value=_unit([1, 0, 0, 0]))
+        query.start()
+        self.addCleanup(query.stop)
+
+    def _document(self, title, vectors, status=Document.STATUS_READY):
+        document = Document.objects.create(user=self.user, title=title, file_type='txt', status=status)
+        for i, vector in enumerate(vectors):
+            chunk = DocumentChunk(document=document, content=f'{title} {i}', chunk_index=i)
+            chunk.set_vector(_unit(vector))
+            chunk.save()
+        return document
+
+    def test_scoped_search_ranks_only_the_attached_documents(self):
+        # The library outscores every attached chunk, so filtering a global
+        # top 5 afterwards would have left nothing
+        results = document_service.search_documents(
+            self.user.id, 'q', top_k=5, document_ids=[self.attached.id]
+        )
+        self.assertEqual([r['content'] for r in results],
+                         ['attached.txt 0', 'attached.txt 1', 'attached.txt 2'])
+
+    def test_hits_per_document_can_be_capped(self):
+        results = document_service.search_documents(self.user.id, 'q', top_k=5, per_document_k=2)
+        titles = [r['document_title'] for r in results]
+        self.assertEqual(titles.count('library.txt'), 2)
+        self.assertEqual(len(results), 4)
+
+    def test_document_chats_search_their_ready_attachments(self):
+        conversation = Conversation.objects.create(user=self.user, title='Docs', chat_type='document')
+        pending = self._document('pending.txt', [[1, 0, 0, 0]], status=Document.STATUS_EMBEDDING)
+        for document in (self.attached, pending):
+            ChatAttachment.objects.create(conversation=conversation, document=document)
+        with mock.patch('chat.api_views.search_documents', return_value=[]) as search:
+            ChatMessageMixin()._get_document_context(self.user, conversation, 'q', 'document')
+        self.assertEqual(search.call_args.kwargs['document_ids'], [self.attached.id])
+
+
+class LazyLoadingTests(SimpleTestCase):
+
+    def test_importing_the_views_loads_no_heavy_packages(self):
+        heavy = ['torch', 'sentence_transformers', 'PyPDF2', 'docx', 'pandas', 'tavily']
+        script = (
+            'import sys, django; django.setup(); '
+            'import chat.views, chat.api_views, chat.document_service; '
+            f'print([name for name in {heavy!r} if name in sys.modules])'
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='bsc_ai.settings', RAG_PRELOAD_EMBEDDING_MODEL='false')
+        result = subprocess.run(
+            [sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env,
+            capture_output=True, text=True, timeout=120,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], '[]')
+
+    def test_backend_is_created_once_under_concurrent_first_use(self):
+        created = []
+
+        def create_backend():
+            time.sleep(0.05)
+            created.append(_WordBackend())
+            return created[-1]
+
+        with mock.patch.object(embeddings, '_backend', None), \
+                mock.patch.object(embeddings, 'create_backend', side_effect=create_backend):
+            backends = []
+            threads = [threading.Thread(target=lambda: backends.append(embeddings.get_embedding_backend()))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(created), 1)
+        self.assertTrue(all(backend is created[0] for backend in backends))
+
+
+def _embedding_table_onnx(path, vocab_size, dim=4, seed=0):
+    """An ONNX 'transformer' whose hidden states are a fixed table lookup per token."""
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    table = np.random.default_rng(seed).normal(size=(vocab_size, dim)).astype(np.float32)
+    graph = helper.make_graph(
+        [helper.make_node('Gather', ['table', 'input_ids'], ['last_hidden_state'])],
+        'lookup',
+        [
+            helper.make_tensor_value_info('input_ids', TensorProto.INT64, ['batch', 'tokens']),
+            helper.make_tensor_value_info('attention_mask', TensorProto.INT64, ['batch', 'tokens']),
+        ],
+        [helper.make_tensor_value_info('last_hidden_state', TensorProto.FLOAT, ['batch', 'tokens', dim])],
+        [numpy_helper.from_array(table, 'table')],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+
+class OnnxBackendTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from tokenizers import Tokenizer
+
+        cls.model_dir = tempfile.mkdtemp()
+        tokenizer = os.path.join(settings.BASE_DIR, 'jina_emb', 'tokenizer.json')
+        shutil.copy(tokenizer, cls.model_dir)
+        _embedding_table_onnx(
+            os.path.join(cls.model_dir, 'model.onnx'), Tokenizer.from_file(tokenizer).get_vocab_size()
+        )
+        cls.backend = embeddings.OnnxBackend(cls.model_dir, max_length=16)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_dir)
+        super().tearDownClass()
+
+    def test_padding_does_not_change_a_vector(self):
+        alone = self.backend.encode('short text')
+        padded = self.backend.encode(['short text', 'a much longer sentence than the first one'])[0]
+        np.testing.assert_allclose(padded, alone, rtol=1e-5)
+
+    def test_length_sorted_batches_keep_input_order(self):
+        texts = ['one', 'three words here', 'two words', 'a sentence of six words']
+        batched = self.backend.encode(texts, batch_size=2)
+        for text, vector in zip(texts, batched):
+            np.testing.assert_allclose(vector, self.backend.encode(text), rtol=1e-5)
+
+    def test_dimension_and_version(self):
+        self.assertEqual(self.backend.dimension, 4)
+        self.assertEqual(self.backend.version, f'onnx:{os.path.basename(self.model_dir)}')
+
+    def test_token_offsets_are_not_truncated(self):
+        text = ' '.join(['word'] * 40)
+        self.assertEqual(len(self.backend.token_offsets(text)), 40)
+
+    def test_unknown_backend_is_rejected(self):
+        with self.assertRaises(ValueError):
+            embeddings.create_backend('tensorflow')
@@ -0,0 +1,174 @@
+"""
+Web tool routing with a deterministic fast path and a decision cache.
+
+``route_web_tool`` returns the same decision shape as
+``ollama_client.get_web_tool_call`` (``{"tool": "none"}`` or
+``{"tool": "tavily.*", "args": {...}}``) but asks the LLM router only when
+it has to:
+
+1. Rules resolve the unambiguous cases. A URL means ``tavily.extract``, or
+   ``tavily.map`` when a sitemap is asked for, or ``tavily.crawl`` when the
+   latest content of the site is asked for. News keywords without a URL
+   mean a ``tavily.search`` on the news topic.
+2. Earlier LLM decisions are reused from a bounded LRU cache keyed by the
+   normalized message.
+3. Anything else goes to the LLM router and its decision is cached.
+
+Metrics: ``tool_router.rule_hits``, ``tool_router.cache_hits``,
+``tool_router.llm_calls`` (with the ``tool_router.llm`` timer), and the gauges
+``tool_router.llm_call_rate`` and ``tool_router.saved_ms``, the router time
+avoided at the average measured LLM routing latency.
+"""
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from django.conf import settings
+
+from . import metrics
+from .ollama_client import get_web_tool_call
+
+URL_RE = re.compile(r"https?://[^\s<>\"')]+|www\.[^\s<>\"')]+", re.IGNORECASE)
+SITEMAP_RE = re.compile(r"\b(?:site ?map|list (?:all |of )?(?:the )?pages)\b")
+CRAWL_RE = re.compile(r"\b(?:crawl|all pages|latest|recent|news|headlines|updates?)\b")
+NEWS_RE = re.compile(r"\b(?:news|headlines|breaking)\b")
+TODAY_RE = re.compile(r"\b(?:today|tonight|yesterday|breaking|right now)\b")
+
+MAX_URLS = 5
+
+
+def normalize_message(text: str) -> str:
+    """Cache key for a message: NFKC, lower case, whitespace collapsed."""
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+def _urls(message: str):
+    urls = []
+    for match in URL_RE.findall(message):
+        url = match.rstrip('.,;:!?')
+        if not url.lower().startswith(('http://', 'https://')):
+            url = 'https://' + url
+        if url not in urls:
+            urls.append(url)
+    return urls[:MAX_URLS]
+
+
+def pre_route(message: str) -> Optional[dict]:
+    """Decision for messages the rules can settle on their own, else None."""
+    lower = normalize_message(message)
+    urls = _urls(message)
+    if urls:
+        if SITEMAP_RE.search(lower):
+            return {"tool": "tavily.map", "args": {"url": urls[0], "max_depth": 2, "max_breadth": 20, "limit": 30}}
+        if len(urls) == 1 and CRAWL_RE.search(lower):
+            return {"tool": "tavily.crawl", "args": {
+                "url": urls[0], "instructions": message, "max_depth": 1, "max_breadth": 20,
+                "limit": 20, "allow_external": False, "extract_depth": "advanced", "format": "markdown",
+            }}
+        return {"tool": "tavily.extract", "args": {
+            "urls": urls, "extract_depth": "advanced", "format": "markdown", "query": message,
+        }}
+    if NEWS_RE.search(lower):
+        return {"tool": "tavily.search", "args": {
+            "query": message, "topic": "news", "time_range": "day" if TODAY_RE.search(lower) else "week",
+            "search_depth": "advanced", "max_results": 6, "include_answer": "basic",
+            "include_raw_content": "markdown",
+        }}
+    return None
+
+
+class RouterDecisionCache:
+    """LRU map of normalized message to router decision, bounded by entry count."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            decision = self._entries.get(key)
+            if decision is not None:
+                self._entries.move_to_end(key)
+            return decision
+
+    def put(self, key: str, decision: dict) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = decision
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_decision_cache = RouterDecisionCache(getattr(settings, 'WEB_ROUTER_CACHE_SIZE', 1024))
+
+# Running LLM routing latency, to price the calls the fast paths avoid
+_llm_stats = {'calls': 0, 'seconds': 0.0, 'avoided': 0}
+_stats_lock = threading.Lock()
+
+
+def _saved_ms() -> float:
+    with _stats_lock:
+        if not _llm_stats['calls']:
+            return 0.0
+        return round(_llm_stats['avoided'] * _llm_stats['seconds'] * 1000 / _llm_stats['calls'], 1)
+
+
+def _llm_call_rate() -> float:
+    with _stats_lock:
+        decisions = _llm_stats['calls'] + _llm_stats['avoided']
+        return round(_llm_stats['calls'] / decisions, 3) if decisions else 0.0
+
+
+metrics.register_gauge('tool_router.cache_entries', lambda: len(_decision_cache))
+metrics.register_gauge('tool_router.llm_call_rate', _llm_call_rate)
+metrics.register_gauge('tool_router.saved_ms', _saved_ms)
+
+
+def _avoided(counter: str) -> None:
+    metrics.increment(counter)
+    with _stats_lock:
+        _llm_stats['avoided'] += 1
+
+
+def route_web_tool(message: str, user_id=None, deadline=None) -> dict:
+    """
+    Decide which Tavily tool (if any) serves ``message``; see the module
+    docstring. An LLM call gives up at ``deadline`` (see
+    ``ollama_client._ollama_chat``).
+    """
+    decision = pre_route(message)
+    if decision is not None:
+        _avoided('tool_router.rule_hits')
+        return decision
+
+    key = normalize_message(message)
+    decision = _decision_cache.get(key)
+    if decision is not None:
+        _avoided('tool_router.cache_hits')
+        return decision
+
+    metrics.increment('tool_router.llm_calls')
+    started = time.perf_counter()
+    decision = get_web_tool_call(message, user_id=user_id, deadline=deadline)
+    elapsed = time.perf_counter() - started
+    metrics.observe('tool_router.llm', elapsed)
+    with _stats_lock:
+        _llm_stats['calls'] += 1
+        _llm_stats['seconds'] += elapsed
+    # Failed routing is marked with "error" and retried next time
+    if not decision.get('error'):
+        _decision_cache.put(key, decision)
+    return decision
@@ -0,0 +1,332 @@
+"""
+Resident per-user vector index for document retrieval.
+
+Each user's processed chunk embeddings are held in one contiguous float32
+matrix so a query is scored with a single matrix-vector product and an
+``argpartition`` top-k, instead of decoding and scoring ORM rows one by one.
+
+Indexes are updated incrementally by ``process_document`` and by the model
+signals in ``chat.signals``. Other workers can change the chunk table too, so
+every lookup compares a cheap (row count, max chunk id) fingerprint against
+the database and rebuilds the index when it no longer matches.
+"""
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max, Q
+
+from .models import Document, DocumentChunk, unpack_embedding
+
+logger = logging.getLogger(__name__)
+
+_INITIAL_CAPACITY = 256
+
+IndexSnapshot = namedtuple('IndexSnapshot', 'matrix chunk_ids document_ids generation')
+
+
+def _indexed_chunks(user_id):
+    """Queryset of the chunks that belong in a user's index."""
+    return DocumentChunk.objects.filter(
+        Q(embedding_blob__isnull=False) | Q(embedding__isnull=False),
+        document__user_id=user_id,
+        document__status=Document.STATUS_READY,
+    )
+
+
+def _db_fingerprint(user_id) -> Tuple[int, int]:
+    stats = _indexed_chunks(user_id).aggregate(n=Count('id'), max_id=Max('id'))
+    return stats['n'] or 0, stats['max_id'] or 0
+
+
+class UserVectorIndex:
+    """Contiguous embedding matrix plus row metadata for one user."""
+
+    def __init__(self, user_id: int, dim: int):
+        self.user_id = user_id
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._matrix = np.empty((_INITIAL_CAPACITY, dim), dtype=np.float32)
+        self._chunk_ids = np.empty(_INITIAL_CAPACITY, dtype=np.int64)
+        self._document_ids = np.empty(_INITIAL_CAPACITY, dtype=np.int64)
+        self._size = 0
+        # Bumped on every mutation so derived structures know when to refresh
+        self.generation = 0
+        # Rows present in the database but not indexable (e.g. embeddings
+        # from a previous model with a different dimension), per document.
+        self._skipped: Dict[int, int] = {}
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def fingerprint(self) -> Tuple[int, int]:
+        size = self._size
+        max_id = int(self._chunk_ids[:size].max()) if size else 0
+        return size + sum(self._skipped.values()), max_id
+
+    def _reserve(self, extra: int):
+        needed = self._size + extra
+        capacity = self._matrix.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        chunk_ids = np.empty(capacity, dtype=np.int64)
+        document_ids = np.empty(capacity, dtype=np.int64)
+        matrix[:self._size] = self._matrix[:self._size]
+        chunk_ids[:self._size] = self._chunk_ids[:self._size]
+        document_ids[:self._size] = self._document_ids[:self._size]
+        self._matrix, self._chunk_ids, self._document_ids = matrix, chunk_ids, document_ids
+
+    def add(self, document_id: int, chunk_ids: Iterable[int], vectors) -> int:
+        """
+        Append rows for one document. Vectors with the wrong dimension are
+        counted as skipped so the fingerprint still matches the database.
+        """
+        chunk_ids = list(chunk_ids)
+        vectors = [np.asarray(v, dtype=np.float32).reshape(-1) for v in vectors]
+        keep = [i for i, v in enumerate(vectors) if v.shape[0] == self.dim]
+        skipped = len(vectors) - len(keep)
+
+        with self._lock:
+            if skipped:
+                self._skipped[document_id] = self._skipped.get(document_id, 0) + skipped
+            if not keep:
+                return 0
+            self._reserve(len(keep))
+            start, end = self._size, self._size + len(keep)
+            self._matrix[start:end] = np.stack([vectors[i] for i in keep])
+            self._chunk_ids[start:end] = [chunk_ids[i] for i in keep]
+            self._document_ids[start:end] = document_id
+            # Publish the new size last so concurrent readers only ever see
+            # fully written rows.
+            self._size = end
+            self.generation += 1
+        return len(keep)
+
+    def remove_document(self, document_id: int) -> int:
+        """Drop every row of a document. Returns the number of rows removed."""
+        with self._lock:
+            size = self._size
+            keep = self._document_ids[:size] != document_id
+            removed = int(size - keep.sum())
+            self._skipped.pop(document_id, None)
+            if not removed:
+                return 0
+            # Build fresh arrays instead of compacting in place so searches
+            # holding a snapshot of the old arrays are unaffected.
+            capacity = max(_INITIAL_CAPACITY, self._matrix.shape[0])
+            matrix = np.empty((capacity, self.dim), dtype=np.float32)
+            chunk_ids = np.empty(capacity, dtype=np.int64)
+            document_ids = np.empty(capacity, dtype=np.int64)
+            new_size = size - removed
+            matrix[:new_size] = self._matrix[:size][keep]
+            chunk_ids[:new_size] = self._chunk_ids[:size][keep]
+            document_ids[:new_size] = self._document_ids[:size][keep]
+            self._matrix, self._chunk_ids, self._document_ids = matrix, chunk_ids, document_ids
+            self._size = new_size
+            self.generation += 1
+        return removed
+
+    def snapshot(self) -> IndexSnapshot:
+        """
+        Consistent view of the current rows. Appends write past the snapshot
+        and removals swap in new arrays, so a snapshot never changes.
+        """
+        with self._lock:
+            size = self._size
+            return IndexSnapshot(
+                self._matrix[:size],
+                self._chunk_ids[:size],
+                self._document_ids[:size],
+                self.generation,
+            )
+
+    def search(
+        self,
+        query_vector,
+        top_k: int,
+        document_ids: Optional[Iterable[int]] = None,
+        per_document_k: Optional[int] = None,
+    ) -> List[Tuple[int, int, float]]:
+        """
+        Return up to ``top_k`` ``(chunk_id, document_id, score)`` tuples,
+        best first. Embeddings are normalized, so the dot product is the
+        cosine similarity.
+
+        ``document_ids`` restricts scoring to those documents' rows, and
+        ``per_document_k`` caps how many hits any single document may return.
+        """
+        return search_snapshot(
+            self.snapshot(), query_vector, top_k,
+            document_ids=document_ids, per_document_k=per_document_k,
+        )
+
+
+def search_snapshot(
+    snapshot: IndexSnapshot,
+    query_vector,
+    top_k: int,
+    document_ids: Optional[Iterable[int]] = None,
+    per_document_k: Optional[int] = None,
+    rows=None,
+) -> List[Tuple[int, int, float]]:
+    """
+    Exact top-k over a snapshot. ``rows`` optionally limits scoring to a
+    set of row positions (used by the ANN index to pass its candidates).
+    """
+    matrix, chunk_ids, doc_ids = snapshot.matrix, snapshot.chunk_ids, snapshot.document_ids
+    if not chunk_ids.shape[0] or top_k <= 0:
+        return []
+
+    query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+    if query.shape[0] != matrix.shape[1]:
+        return []
+
+    if document_ids is not None:
+        wanted = np.fromiter(document_ids, dtype=np.int64)
+        if rows is None:
+            rows = np.flatnonzero(np.isin(doc_ids, wanted))
+        else:
+            rows = rows[np.isin(doc_ids[rows], wanted)]
+
+    if rows is not None:
+        if not rows.size:
+            return []
+        scores = matrix[rows] @ query
+        scored_doc_ids = doc_ids[rows]
+    else:
+        scores = matrix @ query
+        scored_doc_ids = doc_ids
+
+    if per_document_k:
+        candidates = _top_per_document(scores, scored_doc_ids, per_document_k)
+    else:
+        candidates = np.arange(scores.shape[0])
+    positions = _top_k(scores, candidates, top_k)
+    top = rows[positions] if rows is not None else positions
+
+    return [
+        (int(chunk_ids[i]), int(doc_ids[i]), float(scores[p]))
+        for i, p in zip(top, positions)
+    ]
+
+
+def _top_k(scores, candidates, k):
+    """Positions of the ``k`` best ``candidates`` by score, best first."""
+    if candidates.shape[0] > k:
+        part = np.argpartition(scores[candidates], candidates.shape[0] - k)
+        candidates = candidates[part[candidates.shape[0] - k:]]
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+
+def _top_per_document(scores, doc_ids, k):
+    """Positions of the ``k`` best rows of every document."""
+    picked = []
+    for document_id in np.unique(doc_ids):
+        picked.append(_top_k(scores, np.flatnonzero(doc_ids == document_id), k))
+    return np.concatenate(picked)
+
+
+_indexes: "OrderedDict[int, UserVectorIndex]" = OrderedDict()
+_registry_lock = threading.Lock()
+_build_locks: Dict[int, threading.Lock] = {}
+
+
+def _max_resident_users() -> int:
+    return getattr(settings, 'RAG_INDEX_MAX_USERS', 64)
+
+
+def _build_index(user_id: int, dim: int) -> UserVectorIndex:
+    """Load every indexable chunk for a user into a fresh index."""
+    index = UserVectorIndex(user_id, dim)
+    rows = _indexed_chunks(user_id).order_by('document_id', 'id').values_list(
+        'id', 'document_id', 'embedding_blob', 'embedding_dtype', 'embedding'
+    )
+
+    current_doc = None
+    ids: List[int] = []
+    vectors: List = []
+    for chunk_id, document_id, blob, dtype, embedding in rows.iterator(chunk_size=2000):
+        if document_id != current_doc and ids:
+            index.add(current_doc, ids, vectors)
+            ids, vectors = [], []
+        current_doc = document_id
+        ids.append(chunk_id)
+        # Rows not yet converted by ``convert_embeddings`` still carry JSON
+        vectors.append(unpack_embedding(blob, dtype) if blob is not None else embedding)
+    if ids:
+        index.add(current_doc, ids, vectors)
+
+    logger.info(
+        f"Built vector index for user {user_id}: {len(index)} rows, dim={dim}"
+    )
+    return index
+
+
+def get_user_index(user_id: int, dim: int) -> UserVectorIndex:
+    """
+    Return the resident index for a user, (re)building it when it is missing,
+    has a different dimension, or no longer matches the database.
+    """
+    with _registry_lock:
+        index = _indexes.get(user_id)
+        if index is not None:
+            _indexes.move_to_end(user_id)
+        build_lock = _build_locks.setdefault(user_id, threading.Lock())
+
+    if index is not None and index.dim == dim and index.fingerprint == _db_fingerprint(user_id):
+        return index
+
+    with build_lock:
+        # Another thread may have rebuilt the index while we waited.
+        with _registry_lock:
+            index = _indexes.get(user_id)
+        if index is not None and index.dim == dim and index.fingerprint == _db_fingerprint(user_id):
+            return index
+
+        index = _build_index(user_id, dim)
+        with _registry_lock:
+            _indexes[user_id] = index
+            _indexes.move_to_end(user_id)
+            while len(_indexes) > _max_resident_users():
+                evicted, _ = _indexes.popitem(last=False)
+                _build_locks.pop(evicted, None)
+        return index
+
+
+def add_document(user_id: int, document_id: int, batches: Iterable[Tuple[List[int], List]]) -> None:
+    """
+    Append a freshly processed document to the user's index, if resident.
+    ``batches`` yields ``(chunk_ids, vectors)`` and is only read when it is.
+    """
+    with _registry_lock:
+        index = _indexes.get(user_id)
+    if index is None:
+        return
+    # Start from a clean slate in case the document is being reprocessed.
+    index.remove_document(document_id)
+    for chunk_ids, vectors in batches:
+        index.add(document_id, chunk_ids, vectors)
+
+
+def remove_document(user_id: int, document_id: int) -> None:
+    """Drop a document from the user's index, if resident."""
+    with _registry_lock:
+        index = _indexes.get(user_id)
+    if index is not None:
+        index.remove_document(document_id)
+
+
+def invalidate_user(user_id: Optional[int] = None) -> None:
+    """Forget the resident index for one user, or for everyone."""
+    with _registry_lock:
+        if user_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(user_id, None)
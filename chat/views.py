@@ -3,13 +3,16 @@ from django.contrib.auth.decorators import login_required
 from django.http import StreamingHttpResponse, JsonResponse
 from django.views.decorators.http import require_http_methods
 from .models import Conversation, ChatMessage, Document, DocumentChunk, ChatAttachment 
-from .ollama_client import get_ai_response_stream, get_web_tool_call
-from .document_service import process_document, search_documents
+from .document_service import search_documents, store_uploaded_document
+from .admission import QueueFull, get_admission_controller
+from .streaming import AnswerStream
+from .prompting import build_chat_messages, format_document_results, load_history
 import json
 import time
 import re
 from .tools import get_weather, get_stock_price
 from .web_search import get_web_context, execute_web_tool_call
+from .tool_routing import route_web_tool
 
 @login_required
 def chat_view(request, conversation_id=None):
@@ -63,6 +66,14 @@ def send_message(request, conversation_id=None):
     if not message_text:
         return JsonResponse({'error': 'Message cannot be empty'}, status=400)
 
+    # Shed load up front rather than queueing without bound
+    try:
+        get_admission_controller().check_capacity()
+    except QueueFull as e:
+        response = JsonResponse({'error': 'The assistant is busy. Please retry shortly.'}, status=503)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+
     # Get or create conversation
     if conversation_id:
         try:
@@ -124,7 +135,7 @@ def send_message(request, conversation_id=None):
                 "www.",
             ]
         ):
-            tool_call = get_web_tool_call(message_text)
+            tool_call = route_web_tool(message_text, user_id=request.user.id)
             web_context = execute_web_tool_call(
                 tool_call, original_query=message_text, user_id=request.user.id
             )
@@ -142,69 +153,34 @@ def send_message(request, conversation_id=None):
 
 
     # === STEP 2: Get document context (RAG) ===
-    context = None
+    doc_context = []
     if chat_type == 'document' or conversation.chat_type == 'document':
-        attachments = ChatAttachment.objects.filter(
+        document_ids = list(ChatAttachment.objects.filter(
             conversation=conversation,
-            document__processed=True  # ← Only processed docs
-        ).select_related('document')
-        document_ids = [att.document.id for att in attachments]
+            document__status=Document.STATUS_READY  # ← Only processed docs
+        ).values_list('document_id', flat=True))
 
         if document_ids:
-            results = search_documents(request.user.id, message_text, top_k=5)
-            results = [r for r in results if r['document_id'] in document_ids]
-
-            if results:
-                context_parts = []
-                for result in results:
-                    context_parts.append(f"[From: {result['document_title']}]\n{result['content']}\n---")
-                context = "\n\n".join(context_parts)
-                if len(context) > 12000:
-                    context = context[:12000] + "..."
-
-    # === STEP 3: Combine contexts ===
-    final_context = ""
-    if tool_context and "unavailable" not in tool_context:
-        final_context = f"[Real-time Data]: {tool_context}"
-    if context:
-        if final_context:
-            final_context += f"\n\n[Document Context]: {context}"
-        else:
-            final_context = f"[Document Context]: {context}"
-
-    # === STEP 4: Build chat history ===
-    previous_messages = ChatMessage.objects.filter(conversation=conversation).order_by('-timestamp')[:4]
-    previous_messages = list(reversed(previous_messages))
-
-    messages = []
-    for msg in previous_messages[:-1]:  # Exclude current message
-        role = "user" if msg.is_user_message else "assistant"
-        messages.append({"role": role, "content": msg.content})
-    messages.append({"role": "user", "content": message_text})
-
-
-    # === STEP 5: Stream response ===
-    def event_stream():
-        full_response = ""
-        try:
-            for chunk in get_ai_response_stream(messages, context=final_context):
-                full_response += chunk
-                yield f"data: {json.dumps({'chunk': chunk})}\n\n"  # ✅ CORRECT - added "data:"
-
-            ChatMessage.objects.create(
-                conversation=conversation,
-                user=request.user,
-                is_user_message=False,
-                content=full_response
+            results = search_documents(
+                request.user.id, message_text, top_k=5, document_ids=document_ids
             )
-            yield f"data: {json.dumps({'done': True, 'conversation_id': conversation.id})}\n\n"  # ✅ CORRECT
+            doc_context = format_document_results(results)
+
+    # === STEP 3: Assemble the prompt within the model's token budget ===
+    if not tool_context or "unavailable" in tool_context:
+        tool_context = ""
+    messages, _ = build_chat_messages(
+        load_history(conversation),
+        message_text,
+        documents=doc_context,
+        realtime_context=tool_context,
+    )
 
-        except Exception as e:
-            print(f"ERROR in event_stream: {e}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"  # ✅ CORRECT
 
+    # === STEP 4: Stream response ===
+    answer = AnswerStream(conversation, request.user, messages)
 
-    return StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    return StreamingHttpResponse(answer.frames(), content_type='text/event-stream')
 
 
 
@@ -252,6 +228,17 @@ def new_conversation(request):
     })
 
 
+def _failed_upload_response(document):
+    """400 for an upload whose ingestion already failed (inline processing), after deleting it"""
+    # Ingestion records its state with queryset updates
+    document.refresh_from_db(fields=['status', 'error'])
+    if document.status != Document.STATUS_FAILED:
+        return None
+    error = document.error
+    document.delete()
+    return JsonResponse({'error': f'Failed to process document: {error}'}, status=400)
+
+
 @login_required
 @require_http_methods(["POST"])
 def upload_document(request):
@@ -266,16 +253,12 @@ def upload_document(request):
     if file_type not in ['pdf', 'docx', 'txt']:
         return JsonResponse({'error': 'Unsupported file type'}, status=400)
     
-    # Save document
-    document = Document.objects.create(
-        user=request.user,
-        title=file_name,
-        file=file,
-        file_type=file_type
-    )
-    
-    # Process document in background
-    process_document(document.id)
+    # Save document (or reuse the user's identical earlier upload) and
+    # process it in background
+    document, _ = store_uploaded_document(request.user, file, file_name, file_type)
+    failed = _failed_upload_response(document)
+    if failed:
+        return failed
     
     return JsonResponse({
         'success': True,
@@ -299,20 +282,12 @@ def upload_inline_document(request):
     if file_type not in ['pdf', 'docx', 'txt']:
         return JsonResponse({'error': 'Unsupported file type. Please upload PDF, DOCX, or TXT'}, status=400)
     
-    # Save document
-    document = Document.objects.create(
-        user=request.user,
-        title=file_name,
-        file=file,
-        file_type=file_type
-    )
-    
-    # Process document
-    success = process_document(document.id)
-    
-    if not success:
-        document.delete()
-        return JsonResponse({'error': 'Failed to process document'}, status=400)
+    # Save document (or reuse the user's identical earlier upload) and
+    # process it in background; the page polls document-status
+    document, _ = store_uploaded_document(request.user, file, file_name, file_type)
+    failed = _failed_upload_response(document)
+    if failed:
+        return failed
     
     # Ensure we have a conversation
     if conversation_id:
@@ -359,12 +334,17 @@ def upload_inline_document(request):
 
 @login_required
 def document_status(request, document_id):
-    """Check if a document has finished processing"""
+    """Check if a document has finished processing (or failed, with the error)"""
     doc = get_object_or_404(Document, id=document_id, user=request.user)
-    return JsonResponse({
+    data = {
         'processed': doc.processed,
+        'status': doc.status,
+        'progress': doc.progress,
         'title': doc.title
-    })
+    }
+    if doc.status == Document.STATUS_FAILED:
+        data['error'] = doc.error
+    return JsonResponse(data)
 
 
 @login_required
@@ -1,9 +1,10 @@
 import logging
 import os
 import re
-from typing import Optional, Dict, Any, List, Tuple
+from typing import TYPE_CHECKING, Optional, Dict, Any, List, Tuple
 
-from tavily import TavilyClient
+if TYPE_CHECKING:
+    from tavily import TavilyClient
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +48,14 @@ def _set_cached(key: str, value: str) -> None:
     _WEB_CONTEXT_CACHE[key] = value
 
 
-def _get_tavily_client() -> Optional[TavilyClient]:
+def _timeout(default: float, deadline=None) -> float:
+    """Request timeout in seconds, cut to what is left of ``deadline`` (if any)."""
+    if deadline is None:
+        return default
+    return min(default, deadline.remaining())
+
+
+def _get_tavily_client() -> Optional["TavilyClient"]:
     """
     Initialize a Tavily client using the TAVILY_API_KEY environment variable.
     """
@@ -56,6 +64,9 @@ def _get_tavily_client() -> Optional[TavilyClient]:
         logger.warning("TAVILY_API_KEY is not set. Web search is disabled.")
         return None
     try:
+        # Imported lazily: the Tavily SDK pulls in tiktoken at import time
+        from tavily import TavilyClient
+
         return TavilyClient(api_key=api_key)
     except Exception as e:
         logger.error(f"Failed to initialize TavilyClient: {e}")
@@ -193,7 +204,7 @@ def _is_site_navigation_intent(query_lower: str) -> bool:
     )
 
 
-def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
+def get_web_context(query: str, user_id: Optional[int] = None, deadline=None) -> Optional[str]:
     """
     Use Tavily at full capacity (search, research, extract, crawl) to build
     a rich context string for a user query.
@@ -206,6 +217,9 @@ def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
     - If the query has no URL:
         - For time-sensitive / open-ended questions, we use tavily.research().
         - Otherwise we use tavily.search() with advanced depth.
+
+    With a ``deadline`` every Tavily request times out when it passes, and
+    research() (which takes no timeout) is replaced by search().
     """
     client = _get_tavily_client()
     if not client:
@@ -230,7 +244,7 @@ def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
                         max_depth=2,
                         max_breadth=20,
                         limit=50,
-                        timeout=90,
+                        timeout=_timeout(90, deadline),
                     )
                     urls = mapped.get("results") if isinstance(mapped, dict) else None
                     if isinstance(urls, list) and urls:
@@ -241,7 +255,7 @@ def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
                             format="markdown",
                             query=query,
                             chunks_per_source=3,
-                            timeout=30,
+                            timeout=_timeout(30, deadline),
                         )
                         return (
                             f"[Mapped URLs from: {url}]\n"
@@ -269,7 +283,7 @@ def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
                         extract_depth="advanced",
                         format="markdown",
                         chunks_per_source=3,
-                        timeout=120,
+                        timeout=_timeout(120, deadline),
                     )
                     return _format_crawl_results(url, crawl_result)
 
@@ -280,7 +294,7 @@ def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
                 format="markdown",
                 query=query,
                 chunks_per_source=3,
-                timeout=30,
+                timeout=_timeout(30, deadline),
             )
             context = _format_extract_result(url, extract_result)
             _set_cached(cache_key, context)
@@ -288,7 +302,7 @@ def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
 
         # 2. No URL: use research() for broad/time-sensitive queries, fallback to search()
         if _is_news_intent(query_lower) or any(kw in query_lower for kw in ["developments", "trends"]):
-            if hasattr(client, "research"):
+            if hasattr(client, "research") and deadline is None:
                 research_result = client.research(query)
                 answer = (
                     research_result.get("answer")
@@ -318,6 +332,7 @@ def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
                 include_answer="advanced",
                 include_raw_content="markdown",
                 max_results=8,
+                timeout=_timeout(60, deadline),
             )
             answer = search_result.get("answer")
             results = search_result.get("results", [])
@@ -335,6 +350,7 @@ def get_web_context(query: str, user_id: Optional[int] = None) -> Optional[str]:
             include_raw_content="markdown",
             include_answer="basic",
             max_results=6,
+            timeout=_timeout(60, deadline),
         )
         results = search_result.get("results", [])
         answer = search_result.get("answer")
@@ -353,12 +369,16 @@ def execute_web_tool_call(
     tool_call: Dict[str, Any],
     original_query: str,
     user_id: Optional[int] = None,
+    deadline=None,
 ) -> Optional[str]:
     """
     Execute a model-produced Tavily tool call and return formatted context text.
 
     Expected tool_call:
       {"tool":"none"} OR {"tool":"tavily.search|tavily.extract|tavily.crawl|tavily.map|tavily.research", "args": {...}}
+
+    With a ``deadline`` the request times out when it passes, and
+    tavily.research (which takes no timeout) runs as tavily.search.
     """
     if not isinstance(tool_call, dict):
         return None
@@ -367,6 +387,8 @@ def execute_web_tool_call(
     args = tool_call.get("args") or {}
     if tool in (None, "", "none"):
         return None
+    if tool == "tavily.research" and deadline is not None:
+        tool = "tavily.search"
 
     client = _get_tavily_client()
     if not client:
@@ -391,6 +413,7 @@ def execute_web_tool_call(
                 include_answer=args.get("include_answer") or "basic",
                 include_raw_content=args.get("include_raw_content") or "markdown",
                 max_results=max_results,
+                timeout=_timeout(60, deadline),
             )
             answer = search_result.get("answer")
             results = search_result.get("results", [])
@@ -431,7 +454,7 @@ def execute_web_tool_call(
                 format=args.get("format") or "markdown",
                 query=args.get("query") or original_query,
                 chunks_per_source=int(args.get("chunks_per_source") or 3),
-                timeout=30,
+                timeout=_timeout(30, deadline),
             )
             context = _format_extract_result(str(urls), extract_result)
             _set_cached(cache_key, context)
@@ -446,7 +469,7 @@ def execute_web_tool_call(
                 max_depth=int(args.get("max_depth") or 2),
                 max_breadth=int(args.get("max_breadth") or 20),
                 limit=int(args.get("limit") or 50),
-                timeout=90,
+                timeout=_timeout(90, deadline),
             )
             urls = mapped.get("results") if isinstance(mapped, dict) else None
             if isinstance(urls, list) and urls:
@@ -470,7 +493,7 @@ def execute_web_tool_call(
                 extract_depth=args.get("extract_depth") or "advanced",
                 format=args.get("format") or "markdown",
                 chunks_per_source=min(int(args.get("chunks_per_source") or 3), 5),
-                timeout=120,
+                timeout=_timeout(120, deadline),
             )
             context = _format_crawl_results(url, crawl_result)
             _set_cached(cache_key, context)